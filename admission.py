@@ -0,0 +1,98 @@
+import json
+import math
+import os
+import shutil
+import config
+import metrics
+from katsu_ingest import recent_throughput
+
+
+# limits on the work waiting in the ingest queue; 0 means no limit
+INGEST_MAX_QUEUED_RECORDS = int(os.getenv("INGEST_MAX_QUEUED_RECORDS", 0))
+INGEST_MAX_SPOOL_BYTES = int(os.getenv("INGEST_MAX_SPOOL_BYTES", 0))
+INGEST_USER_MAX_QUEUED_JOBS = int(os.getenv("INGEST_USER_MAX_QUEUED_JOBS", 0))
+INGEST_USER_MAX_QUEUED_RECORDS = int(os.getenv("INGEST_USER_MAX_QUEUED_RECORDS", 0))
+# new jobs are refused while DAEMON_PATH has less free space than this
+INGEST_MIN_FREE_BYTES = int(os.getenv("INGEST_MIN_FREE_BYTES", 1024 * 1024 * 1024))
+# bounds on the Retry-After sent with a refusal, in seconds
+RETRY_AFTER_DEFAULT = 60
+RETRY_AFTER_MAX = 3600
+
+
+def queued_jobs():
+    """
+    The metadata of every job that is queued, running or paused.
+    """
+    jobs = []
+    jobs_dir = os.path.join(config.DAEMON_PATH, "jobs")
+    try:
+        names = os.listdir(jobs_dir)
+    except FileNotFoundError:
+        return jobs
+    for name in names:
+        try:
+            with open(os.path.join(jobs_dir, name)) as f:
+                jobs.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return jobs
+
+
+def directory_bytes(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def retry_after(excess_records):
+    """
+    How long it should take the daemon to work through excess_records, at the rate of recent ingests.
+    """
+    rate = recent_throughput(os.path.join(config.DAEMON_PATH, "results")).get("*")
+    if not rate or excess_records <= 0:
+        return RETRY_AFTER_DEFAULT
+    return max(1, min(RETRY_AFTER_MAX, math.ceil(excess_records / rate)))
+
+
+def refuse(reason, message, excess_records=0):
+    metrics.ADMISSION_REJECTIONS.labels(reason).inc()
+    return {"error": message}, 429, {"Retry-After": str(retry_after(excess_records))}
+
+
+def check_admission(records=0, user=None):
+    """
+    Decide whether a job of records records, submitted by user, can be queued now. Returns None if it
+    can, or a 429 response with a Retry-After header based on how quickly the daemon is draining the
+    queue.
+    """
+    free_bytes = shutil.disk_usage(config.DAEMON_PATH).free
+    if free_bytes < INGEST_MIN_FREE_BYTES:
+        return refuse("disk", "the ingest server is low on disk space; please try again later")
+    if INGEST_MAX_SPOOL_BYTES > 0 and directory_bytes(os.path.join(config.DAEMON_PATH, "spool")) >= INGEST_MAX_SPOOL_BYTES:
+        return refuse("spool_bytes", "the ingest queue is full; please try again later")
+
+    jobs = queued_jobs()
+    queued_records = sum(job.get("records", 0) for job in jobs)
+    if INGEST_MAX_QUEUED_RECORDS > 0 and queued_records + records > INGEST_MAX_QUEUED_RECORDS:
+        if records > INGEST_MAX_QUEUED_RECORDS:
+            return {"error": f"this submission has {records} records, more than the maximum of {INGEST_MAX_QUEUED_RECORDS}; please split it"}, 413
+        return refuse("queued_records", f"the ingest queue is full ({queued_records} records waiting); please try again later",
+                      queued_records + records - INGEST_MAX_QUEUED_RECORDS)
+
+    if user is not None:
+        user_jobs = [job for job in jobs if job.get("submitter") == user]
+        if INGEST_USER_MAX_QUEUED_JOBS > 0 and len(user_jobs) >= INGEST_USER_MAX_QUEUED_JOBS:
+            return refuse("user_jobs", f"you already have {len(user_jobs)} ingests waiting, the maximum is {INGEST_USER_MAX_QUEUED_JOBS}",
+                          sum(job.get("records", 0) for job in user_jobs))
+        user_records = sum(job.get("records", 0) for job in user_jobs)
+        if INGEST_USER_MAX_QUEUED_RECORDS > 0 and user_records + records > INGEST_USER_MAX_QUEUED_RECORDS:
+            if records > INGEST_USER_MAX_QUEUED_RECORDS:
+                return {"error": f"this submission has {records} records, more than your maximum of {INGEST_USER_MAX_QUEUED_RECORDS}; please split it"}, 413
+            return refuse("user_records", f"you already have {user_records} records waiting, the maximum is {INGEST_USER_MAX_QUEUED_RECORDS}",
+                          user_records + records - INGEST_USER_MAX_QUEUED_RECORDS)
+    return None
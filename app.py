@@ -1,6 +1,9 @@
 from connexion import FlaskApp
-from flask import url_for, redirect
+from flask import url_for, redirect, request, g
 import os
+import time
+import metrics
+import profiling
 import candigv2_logging.logging
 
 candigv2_logging.logging.initialize()
@@ -10,6 +13,18 @@ logger = candigv2_logging.logging.CanDIGLogger(__file__)
 def root():
     return redirect(url_for('ingest_operations_get_service_info'))
 
+def start_timer():
+    g.request_start = time.monotonic()
+
+
+def record_request(response):
+    # label by route template, not the concrete URL, so that IDs don't create new time series
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.HTTP_REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+    if "request_start" in g:
+        metrics.HTTP_REQUEST_DURATION.labels(endpoint, request.method).observe(time.monotonic() - g.request_start)
+    return response
+
 def create_app():
     if not os.getenv("CANDIG_URL"):
         logger.warning("CANDIG_URL not found. CanDIG stack environment variables likely not set. Please do so before running the service.")
@@ -18,6 +33,12 @@ def create_app():
     connexionApp.add_api('ingest_openapi.yaml', pythonic_params=True, strict_validation=True)
     app = connexionApp.app
     app.add_url_rule('/', 'root', root)
+    app.add_url_rule('/metrics', 'metrics', metrics.metrics_response)
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    app.before_request(profiling.start_request_profile)
+    app.after_request(profiling.finish_request_profile)
+    app.teardown_request(profiling.stop_request_profile)
     return app
 
 if __name__ == '__main__':
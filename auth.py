@@ -3,13 +3,25 @@ import os
 import re
 import json
 import jwt
+import metrics
 import requests
+import threading
+import time
 import urllib.parse
+from http import HTTPStatus
+
+
+SERVICE_TOKEN_TTL = int(os.getenv("SERVICE_TOKEN_TTL", 3600))
+SERVICE_TOKEN_REFRESH_MARGIN = int(os.getenv("SERVICE_TOKEN_REFRESH_MARGIN", 300))
+
+# calls to Vault and OPA through authx are timed and counted in the service metrics
+vault = metrics.ServiceClient("vault", authx.auth)
+opa = metrics.ServiceClient("opa", authx.auth)
 
 
 def is_default_site_admin_set():
     if os.getenv("DEFAULT_SITE_ADMIN_USER") is not None:
-        result, status_code = authx.auth.get_service_store_secret("opa", key=f"site_roles")
+        result, status_code = vault.get_service_store_secret("opa", key=f"site_roles")
         if status_code == 200:
             if 'admin' in result['site_roles']:
                 return os.getenv("DEFAULT_SITE_ADMIN_USER") in ",".join(result['site_roles']['admin'])
@@ -26,18 +38,143 @@ def get_user_name(token):
 
 
 def is_site_admin(token):
-    if (authx.auth.is_site_admin(None, token=token)):
+    if (opa.is_site_admin(None, token=token)):
         return True
     return False
 
 
+def is_action_allowed_for_program(token, method=None, path=None, program=None):
+    return opa.is_action_allowed_for_program(token, method=method, path=path, program=program)
+
+
 def get_refresh_token(token):
-    client_secret = authx.auth.get_service_store_secret(service="keycloak", key="client-secret")
+    client_secret = vault.get_service_store_secret(service="keycloak", key="client-secret")
     return authx.auth.get_oauth_response(
         client_secret = client_secret,
         refresh_token=token
         )
 
+#####
+# Service tokens
+#####
+
+def token_lifetime(response, default_ttl):
+    """
+    The token in a response from authx.auth.create_service_token and the number of seconds it is
+    valid for. The lifetime is taken from the response if it is a dict with expires_in, ttl or
+    lease_duration, or from the exp claim of a JWT; opaque tokens are assumed to last default_ttl.
+    """
+    if isinstance(response, dict):
+        token = response.get("token", response.get("access_token"))
+        for key in ["expires_in", "ttl", "lease_duration"]:
+            if response.get(key) is not None:
+                return token, float(response[key])
+        response = token
+    try:
+        claims = jwt.decode(response, options={"verify_signature": False})
+        if "exp" in claims:
+            return response, claims["exp"] - time.time()
+    except jwt.exceptions.PyJWTError:
+        pass
+    return response, default_ttl
+
+
+class ServiceTokenProvider():
+    """
+    Caches the service token minted by authx, so that all of the daemon's workers share one token
+    instead of asking Vault for a new one on every call. Once start() is called, a background thread
+    mints a replacement refresh_margin seconds (at most half the token's lifetime) before the cached
+    token expires. Tokens without an expiry of their own are assumed to last ttl seconds.
+    """
+    def __init__(self, ttl=SERVICE_TOKEN_TTL, refresh_margin=SERVICE_TOKEN_REFRESH_MARGIN):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.margin = min(refresh_margin, ttl / 2)
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresher = None
+
+    def get(self):
+        with self.lock:
+            if self.token is None or time.monotonic() >= self.expires_at - self.margin:
+                self._refresh()
+            return self.token
+
+    def invalidate(self, token=None):
+        """
+        Drop the cached token, if it is still token, so that the next call mints a new one.
+        """
+        with self.lock:
+            if token is None or token == self.token:
+                self.token = None
+
+    def share(self):
+        """
+        The cached token and the seconds it has left, for another process to adopt.
+        """
+        with self.lock:
+            return self.token, self.expires_at - time.monotonic()
+
+    def adopt(self, token, seconds_left):
+        with self.lock:
+            self.token = token
+            self.expires_at = time.monotonic() + seconds_left
+
+    def start(self):
+        if self.refresher is not None and self.refresher.is_alive():
+            return
+        self.stopped.clear()
+        self.refresher = threading.Thread(target=self._refresh_loop, name="service-token-refresher", daemon=True)
+        self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
+
+    def _refresh(self):
+        self.token, lifetime = token_lifetime(vault.create_service_token(), self.ttl)
+        self.margin = min(self.refresh_margin, lifetime / 2)
+        self.expires_at = time.monotonic() + lifetime
+
+    def _refresh_loop(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                wait = self.expires_at - self.margin - time.monotonic()
+                if wait <= 0:
+                    try:
+                        self._refresh()
+                        wait = self.expires_at - self.margin - time.monotonic()
+                    except Exception:
+                        # Vault is unavailable: keep the current token and try again shortly
+                        wait = min(10, self.margin)
+            self.stopped.wait(max(wait, 1))
+
+
+service_token_provider = ServiceTokenProvider()
+
+
+def get_service_token():
+    return service_token_provider.get()
+
+
+def service_request(service, operation, method, url, headers, **kwargs):
+    """
+    metrics.request for a request authenticated with the service token in headers. If the service
+    answers 401, the token has been revoked or has expired early: it is replaced and the request is
+    sent once more. headers is updated in place, so later requests that share it use the new token.
+    """
+    response = metrics.request(service, operation, method, url, headers=headers, **kwargs)
+    if response.status_code == HTTPStatus.UNAUTHORIZED and "X-Service-Token" in headers:
+        service_token_provider.invalidate(headers["X-Service-Token"])
+        headers["X-Service-Token"] = get_service_token()
+        response = metrics.request(service, operation, method, url, headers=headers, **kwargs)
+    return response
+
+
 #####
 # AWS stuff
 #####
@@ -74,19 +211,24 @@ def parse_s3_credential(awsfile):
 def store_s3_credential(endpoint, bucket, access, secret, token):
     if not is_site_admin(token):
         return {"error": "Only site admins can store aws credentials"}, 403
-    return authx.auth.store_aws_credential(endpoint=endpoint, bucket=bucket, access=access, secret=secret)
+    return vault.store_aws_credential(endpoint=endpoint, bucket=bucket, access=access, secret=secret)
 
 
 def get_s3_credential(endpoint, bucket, token):
     if not is_site_admin(token):
         return {"error": "Only site admins can view aws credentials"}, 403
-    return authx.auth.get_aws_credential(endpoint=endpoint, bucket=bucket)
+    return vault.get_aws_credential(endpoint=endpoint, bucket=bucket)
+
+
+def get_service_s3_credential(endpoint, bucket):
+    # for ingest's own checks of a bucket: the credential is never returned to the user
+    return vault.get_aws_credential(endpoint=endpoint, bucket=bucket)
 
 
 def remove_s3_credential(endpoint, bucket, token):
     if not is_site_admin(token):
         return {"error": "Only site admins can remove aws credentials"}, 403
-    return authx.auth.remove_aws_credential(endpoint=endpoint, bucket=bucket)
+    return vault.remove_aws_credential(endpoint=endpoint, bucket=bucket)
 
 
 #####
@@ -96,7 +238,7 @@ def remove_s3_credential(endpoint, bucket, token):
 def get_role_type_in_opa(role_type, token):
     if not is_site_admin(token):
         return {"error": "Only site admins can view site roles"}, 403
-    result, status_code = authx.auth.get_service_store_secret("opa", key=f"site_roles")
+    result, status_code = vault.get_service_store_secret("opa", key=f"site_roles")
     if status_code == 200:
         if role_type in result['site_roles']:
             return {role_type: result['site_roles'][role_type]}, 200
@@ -107,11 +249,11 @@ def get_role_type_in_opa(role_type, token):
 def set_role_type_in_opa(role_type, members, token):
     if not is_site_admin(token):
         return {"error": "Only site admins can view site roles"}, 403
-    result, status_code = authx.auth.get_service_store_secret("opa", key=f"site_roles")
+    result, status_code = vault.get_service_store_secret("opa", key=f"site_roles")
     if status_code == 200:
         if role_type in result['site_roles']:
             result['site_roles'][role_type] = members
-            result, status_code = authx.auth.set_service_store_secret("opa", key=f"site_roles", value=json.dumps(result))
+            result, status_code = vault.set_service_store_secret("opa", key=f"site_roles", value=json.dumps(result))
             if status_code == 200:
                 return result['site_roles'][role_type], status_code
         return {"error": f"role type {role_type} does not exist"}, 404
@@ -124,24 +266,24 @@ def set_role_type_in_opa(role_type, members, token):
 
 def add_program_to_opa(program_dict, token):
     # check to see if the user is allowed to add program authorizations:
-    if not authx.auth.is_action_allowed_for_program(token, method="POST", path="/ingest/program", program=program_dict['program_id']):
+    if not opa.is_action_allowed_for_program(token, method="POST", path="/ingest/program", program=program_dict['program_id']):
         return {"error": f"User not authorized to add program authorizations for program {program_dict['program_id']}"}, 403
 
-    response, status_code = authx.auth.add_program_to_opa(program_dict)
+    response, status_code = opa.add_program_to_opa(program_dict)
     return response, status_code
 
 
 def get_program_in_opa(program_id, token):
     # check to see if the user is allowed to add program authorizations:
-    if not authx.auth.is_action_allowed_for_program(token, method="POST", path="/ingest/program", program=program_id):
+    if not opa.is_action_allowed_for_program(token, method="POST", path="/ingest/program", program=program_id):
         return {"error": "User not authorized to add program authorizations"}, 403
 
-    response, status_code = authx.auth.get_program_in_opa(program_id)
+    response, status_code = opa.get_program_in_opa(program_id)
     return response, status_code
 
 
 def list_programs_in_opa(token):
-    response, status_code = authx.auth.list_programs_in_opa()
+    response, status_code = opa.list_programs_in_opa()
     if status_code == 200:
         return response
     return {"error": response}, status_code
@@ -149,10 +291,10 @@ def list_programs_in_opa(token):
 
 def remove_program_from_opa(program_id, token):
     # check to see if the user is allowed to add program authorizations:
-    if not authx.auth.is_action_allowed_for_program(token, method="POST", path="/ingest/program", program=program_id):
+    if not opa.is_action_allowed_for_program(token, method="POST", path="/ingest/program", program=program_id):
         return {"error": "User not authorized to add program authorizations"}, 403
 
-    response, status_code = authx.auth.remove_program_from_opa(program_id)
+    response, status_code = opa.remove_program_from_opa(program_id)
     return response, status_code
 
 #####
@@ -161,7 +303,7 @@ def remove_program_from_opa(program_id, token):
 
 def add_pending_user_to_opa(user_token):
     # NB: any user that has been authenticated by the IDP should be able to add themselves to the pending user list
-    response, status_code = authx.auth.get_service_store_secret("opa", key=f"pending_users")
+    response, status_code = vault.get_service_store_secret("opa", key=f"pending_users")
     if status_code != 200:
         return response, status_code
 
@@ -179,7 +321,7 @@ def add_pending_user_to_opa(user_token):
 
     response["pending_users"][user_name] = user_dict
 
-    response, status_code = authx.auth.set_service_store_secret("opa", key=f"pending_users", value=json.dumps(response))
+    response, status_code = vault.set_service_store_secret("opa", key=f"pending_users", value=json.dumps(response))
     return response, status_code
 
 
@@ -187,7 +329,7 @@ def list_pending_users_in_opa(token):
     if not is_site_admin(token):
         return {"error": f"User not authorized to list pending users"}, 403
 
-    response, status_code = authx.auth.get_service_store_secret("opa", key=f"pending_users")
+    response, status_code = vault.get_service_store_secret("opa", key=f"pending_users")
     if status_code == 200:
         response = list(response["pending_users"].keys())
     return response, status_code
@@ -197,7 +339,7 @@ def approve_pending_user_in_opa(user_name, token):
     if not is_site_admin(token):
         return {"error": f"User not authorized to approve pending users"}, 403
 
-    response, status_code = authx.auth.get_service_store_secret("opa", key=f"pending_users")
+    response, status_code = vault.get_service_store_secret("opa", key=f"pending_users")
     if status_code != 200:
         return response, status_code
     pending_users = response["pending_users"]
@@ -206,7 +348,7 @@ def approve_pending_user_in_opa(user_name, token):
         response2, status_code = write_user_in_opa(user_dict, token)
         if status_code == 200:
             pending_users.pop(user_name)
-            response3, status_code = authx.auth.set_service_store_secret("opa", key=f"pending_users", value=json.dumps(response))
+            response3, status_code = vault.set_service_store_secret("opa", key=f"pending_users", value=json.dumps(response))
     else:
         return {"error": f"no pending user with ID {user_name}"}, 404
     return response, status_code
@@ -216,14 +358,14 @@ def reject_pending_user_in_opa(user_name, token):
     if not is_site_admin(token):
         return {"error": f"User not authorized to reject pending users"}, 403
 
-    response, status_code = authx.auth.get_service_store_secret("opa", key=f"pending_users")
+    response, status_code = vault.get_service_store_secret("opa", key=f"pending_users")
     if status_code != 200:
         return response, status_code
     pending_users = response["pending_users"]
 
     if user_name in pending_users:
         pending_users.pop(user_name)
-        response, status_code = authx.auth.set_service_store_secret("opa", key=f"pending_users", value=json.dumps(response))
+        response, status_code = vault.set_service_store_secret("opa", key=f"pending_users", value=json.dumps(response))
     else:
         return {"error": f"no pending user with ID {user_name}"}, 404
     return response, status_code
@@ -233,7 +375,7 @@ def clear_pending_users_in_opa(token):
     if not is_site_admin(token):
         return {"error": f"User not authorized to clear pending users"}, 403
 
-    response, status_code = authx.auth.set_service_store_secret("opa", key="pending_users", value=json.dumps({"pending_users": {}}))
+    response, status_code = vault.set_service_store_secret("opa", key="pending_users", value=json.dumps({"pending_users": {}}))
     return response, status_code
 
 #####
@@ -245,7 +387,7 @@ def write_user_in_opa(user_dict, token):
         return {"error": f"User not authorized to add users"}, 403
 
     safe_name = urllib.parse.quote_plus(user_dict['user']['user_name'])
-    response, status_code = authx.auth.set_service_store_secret("opa", key=f"users/{safe_name}", value=json.dumps(user_dict))
+    response, status_code = vault.set_service_store_secret("opa", key=f"users/{safe_name}", value=json.dumps(user_dict))
     return response, status_code
 
 
@@ -254,7 +396,7 @@ def get_user_in_opa(user_name, token):
         return {"error": f"User not authorized to view users"}, 403
 
     safe_name = urllib.parse.quote_plus(user_name)
-    response, status_code = authx.auth.get_service_store_secret("opa", key=f"users/{safe_name}")
+    response, status_code = vault.get_service_store_secret("opa", key=f"users/{safe_name}")
     return response, status_code
 
 
@@ -263,5 +405,5 @@ def remove_user_from_opa(user_name, token):
         return {"error": f"User not authorized to remove users"}, 403
 
     safe_name = urllib.parse.quote_plus(user_name)
-    response, status_code = authx.auth.delete_service_store_secret("opa", key=f"users/{safe_name}")
+    response, status_code = vault.delete_service_store_secret("opa", key=f"users/{safe_name}")
     return response, status_code
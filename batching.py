@@ -0,0 +1,189 @@
+import os
+import orjson
+
+
+# upper bounds for adaptively-sized batches posted to katsu
+KATSU_MAX_BATCH_BYTES = int(os.getenv("KATSU_MAX_BATCH_BYTES", 4 * 1024 * 1024))
+KATSU_MAX_BATCH_RECORDS = int(os.getenv("KATSU_MAX_BATCH_RECORDS", 10000))
+# batches that take longer than this many seconds shrink the next batch
+KATSU_TARGET_LATENCY = float(os.getenv("KATSU_TARGET_LATENCY", 10))
+
+
+class BatchSizer():
+    """
+    Decides how many records go into the next batch. A fixed sizer always returns batch_size.
+    An adaptive sizer grows the batch additively while katsu answers within target_latency and
+    halves it when a batch is slow, times out or gets a server error (AIMD), and never lets a batch
+    grow past max_bytes of serialized JSON. Batches that katsu rejects because of their records
+    don't change the size.
+    """
+    def __init__(self, batch_size=1000, adaptive=False, max_records=KATSU_MAX_BATCH_RECORDS,
+                 max_bytes=KATSU_MAX_BATCH_BYTES, target_latency=KATSU_TARGET_LATENCY):
+        self.size = batch_size
+        self.adaptive = adaptive
+        self.max_records = max(max_records, batch_size)
+        self.max_bytes = max_bytes if adaptive else None
+        self.target_latency = target_latency
+        self.step = max(1, batch_size // 10)
+        self.sizes = []
+        self.latencies = []
+
+    def record(self, batch_len, latency, overloaded=False, adjust=True):
+        """
+        Record a request of batch_len records. overloaded means that it timed out or got a server
+        error. Unless adjust is False (e.g. for the halves of a split batch), the size is adjusted.
+        """
+        self.sizes.append(batch_len)
+        self.latencies.append(latency)
+        if not self.adaptive or not adjust:
+            return
+        if overloaded or latency > self.target_latency:
+            self.size = max(1, self.size // 2)
+        else:
+            self.size = min(self.max_records, self.size + self.step)
+
+    def summary(self):
+        if len(self.sizes) == 0:
+            return {"batches": 0}
+        return {
+            "batches": len(self.sizes),
+            "min": min(self.sizes),
+            "max": max(self.sizes),
+            "mean": round(sum(self.sizes) / len(self.sizes), 1),
+            "adaptive": self.adaptive
+        }
+
+
+    def timings(self, slowest=3):
+        """
+        Total time spent waiting on katsu and the slowest requests, as (records, seconds).
+        """
+        batches = sorted(zip(self.sizes, self.latencies), key=lambda batch: batch[1], reverse=True)
+        return {
+            "http_seconds": round(sum(self.latencies), 4),
+            "requests": len(self.latencies),
+            "slowest_batches": [{"records": size, "seconds": round(latency, 4)} for size, latency in batches[:slowest]]
+        }
+
+
+def dumps(obj):
+    """
+    Serialize obj to compact JSON bytes.
+    """
+    return orjson.dumps(obj)
+
+
+def serialize_records(records):
+    for record in records:
+        yield dumps(record)
+
+
+def write_spool(records, path):
+    """
+    Write records to path as newline-delimited JSON, one pre-serialized record per line, so that the
+    daemon can build request bodies from the lines without parsing or re-serializing them.
+    Returns a reference to the spool file that can stand in for the list of records.
+    """
+    count = 0
+    with open(path, "wb") as f:
+        for record in serialize_records(records):
+            f.write(record)
+            f.write(b"\n")
+            count += 1
+    return {"spool": path, "count": count}
+
+
+def write_sharded_spool(records, path, shard_of, shards):
+    """
+    Write records to path like write_spool, grouped by shard_of(record), a number below shards, so
+    that each shard's records are one range of the file. Returns the reference to the whole spool
+    file and a list of references to the range of each shard (None for shards without records).
+    """
+    ranges = [None] * shards
+    with open(path, "wb") as f:
+        for record in sorted(records, key=shard_of):
+            shard = shard_of(record)
+            if ranges[shard] is None:
+                ranges[shard] = {"spool": path, "count": 0, "offset": f.tell()}
+            f.write(dumps(record))
+            f.write(b"\n")
+            ranges[shard]["count"] += 1
+            ranges[shard]["end"] = f.tell()
+    return {"spool": path, "count": len(records)}, ranges
+
+
+def is_spooled(records):
+    return isinstance(records, dict) and "spool" in records
+
+
+def record_count(records):
+    if is_spooled(records):
+        return records["count"]
+    return len(records)
+
+
+def read_records(records):
+    """
+    Yield serialized records, either straight from a spool file or by serializing an in-memory list.
+    A spool reference can be limited to the lines between the byte offsets "offset" and "end".
+    """
+    if not is_spooled(records):
+        yield from serialize_records(records)
+        return
+    with open(records["spool"], "rb") as f:
+        f.seek(records.get("offset", 0))
+        end = records.get("end")
+        for line in f:
+            line = line.rstrip(b"\n")
+            if len(line) > 0:
+                yield line
+            if end is not None and f.tell() >= end:
+                break
+
+
+def split_spool(spool, records_per_range):
+    """
+    Split a spool reference into references to ranges of at most records_per_range records each.
+    """
+    ranges = []
+    offset = 0
+    count = 0
+    with open(spool["spool"], "rb") as f:
+        while True:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            if len(line.strip()) > 0:
+                count += 1
+            if count == records_per_range:
+                ranges.append({"spool": spool["spool"], "count": count, "offset": offset, "end": f.tell()})
+                offset = f.tell()
+                count = 0
+        if count > 0:
+            ranges.append({"spool": spool["spool"], "count": count, "offset": offset, "end": f.tell()})
+    return ranges
+
+
+def iter_batches(records, sizer):
+    """
+    Group serialized records into batches. The sizer is consulted at every batch boundary, so
+    adjustments made while a batch is being posted apply to the next one.
+    """
+    batch = []
+    batch_bytes = 2
+    for record in records:
+        if len(batch) > 0:
+            too_many = len(batch) >= sizer.size
+            too_big = sizer.max_bytes is not None and batch_bytes + len(record) + 1 > sizer.max_bytes
+            if too_many or too_big:
+                yield batch
+                batch = []
+                batch_bytes = 2
+        batch.append(record)
+        batch_bytes += len(record) + 1
+    if len(batch) > 0:
+        yield batch
+
+
+def batch_body(batch):
+    return b"[" + b",".join(batch) + b"]"
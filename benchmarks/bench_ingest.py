@@ -0,0 +1,320 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.abspath(f"{BENCH_DIR}/..")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+import requests
+import config
+import synthetic_data
+from stand_ins import StandInConfig, start_stand_ins
+
+
+STAGES = ["prepare", "ingest_schemas", "check_genomic_data", "htsget_ingest", "daemon"]
+TOKEN = "benchmark"
+# katsu's schema.yml is downloaded once to this file and served by the katsu stand-in from then on
+SCHEMA_CACHE = os.path.join(BENCH_DIR, "schema.yml")
+
+# client-side latencies of every HTTP request made while a stage runs
+latencies = []
+
+
+def record_latencies():
+    original_request = requests.Session.request
+
+    def timed_request(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original_request(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    requests.Session.request = timed_request
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return round(peak / 1024, 1)
+
+
+def allow_all_programs():
+    """
+    Authorization is out of scope for these benchmarks: every program exists in OPA and every action
+    is allowed, and a fixed service token is used.
+    """
+    import auth
+    import katsu_ingest
+    import htsget_ingest
+    auth.get_program_in_opa = lambda program_id, token: ({"program_id": program_id}, 200)
+    auth.get_service_token = lambda: TOKEN
+    katsu_ingest.is_action_allowed_for_program = lambda *args, **kwargs: True
+    htsget_ingest.is_action_allowed_for_program = lambda *args, **kwargs: True
+
+
+def use_daemon_path(daemon_path):
+    """
+    Queue jobs in daemon_path. config was imported, and read DAEMON_PATH, before it was set in the
+    environment, so the modules that already hold a copy of it are pointed at daemon_path too.
+    """
+    import daemon
+    for directory in ["to_ingest", "results"]:
+        os.makedirs(os.path.join(daemon_path, directory), exist_ok=True)
+    os.environ["DAEMON_PATH"] = daemon_path
+    config.DAEMON_PATH = daemon_path
+    daemon.DAEMON_PATH = daemon_path
+
+
+def cached_schema(schema_url, refresh=False):
+    """
+    Returns the path of the cached copy of katsu's schema.yml, downloading it from schema_url if
+    there is no copy yet or refresh is set.
+    """
+    if refresh or not os.path.exists(SCHEMA_CACHE):
+        print(f"Downloading {schema_url} to {SCHEMA_CACHE}", file=sys.stderr)
+        response = requests.get(schema_url)
+        response.raise_for_status()
+        with open(SCHEMA_CACHE, "wb") as f:
+            f.write(response.content)
+    return SCHEMA_CACHE
+
+
+def schema_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def generate_dataset(args):
+    """
+    Clone the donors in tests/clinical_ingest.json, or generate donors from the MoH schema with
+    --generate. Either way the dataset is validated against the schema served by the katsu stand-in,
+    so no stage reads the schema from the network.
+    """
+    openapi_url = f"{os.environ['KATSU_URL']}/static/schema.yml"
+    if args.generate:
+        generator = synthetic_data.SchemaGenerator(synthetic_data.read_openapi(args.schema), args.seed)
+        donors = synthetic_data.generate_donors(args.donors, args.programs, generator=generator)
+        return {"openapi_url": openapi_url, "donors": list(donors)}
+    with open(os.path.join(REPO_DIR, "tests", "clinical_ingest.json")) as f:
+        template = json.load(f)
+    donors = synthetic_data.generate_donors(args.donors, args.programs, template=template)
+    return {"openapi_url": openapi_url, "donors": list(donors)}
+
+
+def setup_stage(stage, args, stand_in_config):
+    """
+    Build the input for a stage. Nothing done here is timed.
+    """
+    import katsu_ingest
+    import htsget_ingest
+    dataset = generate_dataset(args)
+    genomic_samples = list(synthetic_data.generate_genomic_samples(dataset["donors"]))
+    for sample in genomic_samples:
+        if sample["program_id"] not in stand_in_config.samples:
+            stand_in_config.samples[sample["program_id"]] = []
+        stand_in_config.samples[sample["program_id"]].append(sample["samples"][0]["submitter_sample_id"])
+
+    if stage == "prepare":
+        return {"dataset": dataset, "records": len(dataset["donors"])}
+    if stage == "ingest_schemas":
+        programs = katsu_ingest.prepare_clinical_data_for_ingest(dataset)
+        records = sum(len(records) for program in programs.values() for records in program["schemas"].values())
+        return {"programs": programs, "records": records}
+    if stage == "check_genomic_data":
+        return {"samples": genomic_samples, "records": len(genomic_samples)}
+    if stage == "htsget_ingest":
+        by_program, status_code = htsget_ingest.check_genomic_data(genomic_samples, TOKEN)
+        return {"by_program": by_program, "records": len(genomic_samples)}
+    return {"dataset": dataset, "samples": genomic_samples, "records": len(dataset["donors"]) + len(genomic_samples)}
+
+
+def run_stage(stage, args, inputs):
+    """
+    Run a stage on its prepared input and return the number of errors it reported.
+    """
+    import katsu_ingest
+    import htsget_ingest
+    errors = 0
+    if stage == "prepare":
+        programs = katsu_ingest.prepare_clinical_data_for_ingest(inputs["dataset"])
+        errors = sum(len(program["errors"]) for program in programs.values())
+    elif stage == "ingest_schemas":
+        for program in inputs["programs"].values():
+            result, status_code = katsu_ingest.ingest_schemas(program["schemas"], args.batch_size, args.adaptive)
+            errors += len(result["errors"])
+    elif stage == "check_genomic_data":
+        result, status_code = htsget_ingest.check_genomic_data(inputs["samples"], TOKEN)
+        if status_code != 200:
+            errors = len(result["errors"])
+    elif stage == "htsget_ingest":
+        for samples in inputs["by_program"].values():
+            result, status_code = htsget_ingest.htsget_ingest(samples, do_not_index=True)
+            errors += len(result["errors"])
+    elif stage == "daemon":
+        import daemon
+        import ingest_operations
+        response, status_code = katsu_ingest.prep_check_clinical_data(inputs["dataset"], TOKEN, args.batch_size)
+        queue_ids = [ingest_operations.add_to_queue({"katsu": response, "batch_size": args.batch_size,
+                                                     "adaptive_batching": args.adaptive})]
+        response, status_code = htsget_ingest.check_genomic_data(inputs["samples"], TOKEN)
+        queue_ids.append(ingest_operations.add_to_queue({"htsget": response, "do_not_index": True}))
+        for queue_id in queue_ids:
+            results, status_code = daemon.ingest_file(os.path.join(config.DAEMON_PATH, "to_ingest", queue_id))
+            errors += sum(len(result["errors"]) for result in results.values())
+    return errors
+
+
+def measure(args):
+    """
+    Run a single stage at a single scale in this process and print its measurements as JSON.
+    """
+    stand_in_config = StandInConfig(args.katsu_latency, args.htsget_latency, args.error_rate, args.seed,
+                                    schema_path=args.schema)
+    server = start_stand_ins(stand_in_config)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    os.environ["CANDIG_URL"] = base_url
+    os.environ["KATSU_URL"] = f"{base_url}/katsu"
+    os.environ["HTSGET_URL"] = f"{base_url}/genomics"
+    use_daemon_path(tempfile.mkdtemp(prefix="ingest-bench-"))
+    allow_all_programs()
+    record_latencies()
+
+    inputs = setup_stage(args.run_stage, args, stand_in_config)
+    setup_rss = peak_rss_mb()
+    latencies.clear()
+    start = time.perf_counter()
+    errors = run_stage(args.run_stage, args, inputs)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+    print(json.dumps({
+        "stage": args.run_stage,
+        "donors": args.donors,
+        "programs": args.programs,
+        "records": inputs["records"],
+        "seconds": round(elapsed, 4),
+        "records_per_second": round(inputs["records"] / elapsed, 1) if elapsed > 0 else None,
+        "requests": len(latencies),
+        "latency_p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+        "latency_p99_ms": round(p99 * 1000, 2) if p99 is not None else None,
+        "setup_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "errors": errors
+    }))
+
+
+def compare(results, baseline, tolerance, schema_sha256=None):
+    """
+    Returns a list of regressions: stages whose throughput dropped, or whose peak RSS grew, by more
+    than tolerance relative to the baseline run at the same scale. Runs against different schemas
+    can't be compared.
+    """
+    regressions = []
+    if schema_sha256 is not None and baseline.get("schema_sha256") not in [None, schema_sha256]:
+        return ["the baseline was run against a different schema.yml"]
+    previous = {(result["stage"], result["donors"]): result for result in baseline["results"]}
+    for result in results:
+        key = (result["stage"], result["donors"])
+        if key not in previous or "error" in result or "error" in previous[key]:
+            continue
+        before = previous[key]
+        if before["records_per_second"] and result["records_per_second"] < before["records_per_second"] * (1 - tolerance):
+            regressions.append(f"{key[0]} at {key[1]} donors: {result['records_per_second']} records/s, was {before['records_per_second']}")
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{key[0]} at {key[1]} donors: peak RSS {result['peak_rss_mb']} MB, was {before['peak_rss_mb']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest pipeline against local stand-ins for Katsu and htsget.")
+    parser.add_argument("--donors", default="100,1000",
+                        help="comma-separated list of dataset sizes, in donors")
+    parser.add_argument("--programs", type=int, default=1, help="number of programs to spread donors over")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated stages to run, from {','.join(STAGES)}")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--adaptive", action="store_true", help="use adaptive batching")
+    parser.add_argument("--katsu_latency", type=float, default=0.0, help="seconds each katsu request takes")
+    parser.add_argument("--htsget_latency", type=float, default=0.0, help="seconds each htsget request takes")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--schema", help="local copy of the katsu schema.yml; by default, the copy cached in "
+                                         "benchmarks/schema.yml is used, and is downloaded from --schema_url if missing")
+    parser.add_argument("--schema_url", default=config.DEFAULT_OPENAPI_URL, help="where to download the schema from")
+    parser.add_argument("--refresh_schema", action="store_true", help="download the cached schema again")
+    parser.add_argument("--generate", action="store_true",
+                        help="generate donors from the MoH schema instead of cloning tests/clinical_ingest.json")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fractional drop in throughput or growth in peak RSS that counts as a regression")
+    parser.add_argument("--run_stage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage is not None:
+        args.donors = int(args.donors)
+        return measure(args)
+    if args.schema is None:
+        args.schema = cached_schema(args.schema_url, args.refresh_schema)
+
+    # each stage runs in its own process, so that peak RSS is measured per stage
+    results = []
+    for donors in [int(donors) for donors in args.donors.split(",")]:
+        for stage in args.stages.split(","):
+            command = [sys.executable, os.path.realpath(__file__), "--run_stage", stage, "--donors", str(donors)]
+            for option in ["programs", "batch_size", "katsu_latency", "htsget_latency", "error_rate", "seed", "schema"]:
+                if getattr(args, option) is not None:
+                    command.extend([f"--{option}", str(getattr(args, option))])
+            for flag in ["adaptive", "generate"]:
+                if getattr(args, flag):
+                    command.append(f"--{flag}")
+            process = subprocess.run(command, capture_output=True, text=True)
+            if process.returncode != 0:
+                result = {"stage": stage, "donors": donors, "error": process.stderr.strip().splitlines()[-1:]}
+            else:
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {key: value for key, value in vars(args).items() if key not in ["run_stage", "output", "baseline"]},
+        "schema_sha256": schema_digest(args.schema),
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, report["schema_sha256"])
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
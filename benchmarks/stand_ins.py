@@ -0,0 +1,124 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInConfig():
+    """
+    Behaviour of the stand-in services: every request waits latency seconds and fails with a 500
+    with probability error_rate. samples maps program IDs to the sample registrations that katsu
+    reports for them; schema_path, if set, is served as katsu's /static/schema.yml.
+    """
+    def __init__(self, katsu_latency=0.0, htsget_latency=0.0, error_rate=0.0, seed=0, samples=None, schema_path=None):
+        self.katsu_latency = katsu_latency
+        self.htsget_latency = htsget_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.samples = samples or {}
+        self.schema_path = schema_path
+        self.lock = threading.Lock()
+        self.ingested = {}
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers katsu's /v3/ingest and /v3/authorized endpoints under /katsu and htsget's DRS, verify and
+    index endpoints under /genomics.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, body):
+        data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def respond(self, method):
+        config = self.server.config
+        path = self.path.split("?")[0].strip("/").split("/")
+        body = self.read_body() if method == "POST" else b""
+        if path[0] == "katsu":
+            time.sleep(config.katsu_latency)
+            return self.katsu(method, path[1:], body)
+        if path[0] == "genomics":
+            time.sleep(config.htsget_latency)
+            return self.htsget(method, path[1:], body)
+        self.send_json(404, {"error": f"no such path {self.path}"})
+
+    def katsu(self, method, path, body):
+        config = self.server.config
+        if path[:2] == ["static", "schema.yml"] and config.schema_path is not None:
+            with open(config.schema_path, "rb") as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if method == "POST" and path[:2] == ["v3", "ingest"]:
+            if config.fail():
+                return self.send_json(500, {"error": "stand-in failure"})
+            records = json.loads(body)
+            with config.lock:
+                config.ingested[path[2]] = config.ingested.get(path[2], 0) + len(records)
+            return self.send_json(201, {"created": len(records)})
+        if method == "GET" and path[:2] == ["v3", "authorized"]:
+            query = dict(param.split("=", 1) for param in self.path.split("?", 1)[-1].split("&") if "=" in param)
+            program_id = query.get("program_id")
+            if path[2] == "programs":
+                items = [{"program_id": program_id}] if program_id in config.samples else []
+            elif path[2] == "sample_registrations":
+                items = [{"submitter_sample_id": sample_id} for sample_id in config.samples.get(program_id, [])]
+            else:
+                items = []
+            return self.send_json(200, {"items": items})
+        self.send_json(404, {"error": f"no such path {self.path}"})
+
+    def htsget(self, method, path, body):
+        config = self.server.config
+        if path[:4] == ["ga4gh", "drs", "v1", "objects"]:
+            if method == "GET":
+                return self.send_json(404, {"message": "not found"})
+            if config.fail():
+                return self.send_json(500, {"message": "stand-in failure"})
+            return self.send_json(200, json.loads(body))
+        if path[:2] == ["htsget", "v1"] and path[-1] == "verify":
+            if config.fail():
+                return self.send_json(200, {"result": False, "message": "stand-in failure"})
+            return self.send_json(200, {"result": True})
+        if path[:2] == ["htsget", "v1"] and path[-1] == "index":
+            return self.send_json(200, {"id": path[-2]})
+        self.send_json(404, {"error": f"no such path {self.path}"})
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+
+def start_stand_ins(config, host="127.0.0.1", port=0):
+    """
+    Start the stand-in services in a background thread. Returns the server; its base URL is
+    f"http://{host}:{server.server_port}".
+    """
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.config = config
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
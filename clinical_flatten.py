@@ -0,0 +1,129 @@
+import traceback
+from timing import timed
+from candigv2_logging.logging import CanDIGLogger
+
+
+# Validating and flattening clinical donors needs no CanDIG services, so that validate.py can run
+# without them.
+
+logger = CanDIGLogger(__file__)
+
+ID_NAMES = {
+    "programs": "program_id",
+    "donors": "submitter_donor_id",
+    "primary_diagnoses": "submitter_primary_diagnosis_id",
+    "sample_registrations": "submitter_sample_id",
+    "treatments": "submitter_treatment_id",
+    "specimens": "submitter_specimen_id",
+    "followups": "submitter_follow_up_id",
+}
+
+
+def traverse_clinical_field(fields, field: dict, ctype, parents, types, ingested_ids):
+    """
+    Helper function for prep_check_clinical_data. Parses and ingests clinical fields from a DonorWithClinicalData
+    object.
+    Args:
+        field: The (sub)field of a DonorWithClinicalData object, potentially nested
+        ctype: The type of the field being ingested (e.g. "donors")
+        parents: A list of tuple mappings of the parents of this object, e.g.
+            [
+                ("donors", "DONOR_1"),
+                ("primary_diagnoses", "PRIMARY_DIAGNOSIS_1")
+            ]
+        types: A list of possible field types
+        id_names: A mapping of field names to what their ID key is (e.g. {"donors": "submitter_donor_id"})
+        ingested_ids: A list of IDs that have already been ingested (some fields in DonorWithClinical are duplicates)
+    """
+
+    id_names = ID_NAMES
+
+    data = {}
+    if ctype in id_names:
+        id_key = id_names[ctype]
+    else:
+        id_key = None
+    if id_key:
+        try:
+            field_id = field.pop(id_key)
+        except KeyError:
+            raise ValueError(
+                f"Missing required foreign key: {id_key} for {ctype} under {parents[-1][1]}"
+            )
+        if id_key not in ingested_ids:
+            ingested_ids[id_key] = []
+        if field_id in ingested_ids[id_key]:
+            logger.info(f"Skipping {field_id} in {id_key} (Already ingested).")
+            return
+        data[id_key] = field_id
+        ingested_ids[id_key].append(field_id)
+
+    attributes = list(field.keys())
+    for attribute in attributes:
+        if attribute not in types:
+            data[attribute] = field.pop(attribute)
+
+    if (
+        len(parents) >= 2
+    ):  # Program & donor have been added (must be the first 2 fields)
+        foreign_keys = [parents[0], parents[1]]
+        if len(parents) > 2:
+            foreign_keys.append(parents[-1])
+    else:
+        foreign_keys = [parents[0]]  # Just program
+    for parent in foreign_keys:
+        parent_key = id_names[parent[0]]
+        data[parent_key] = parent[1]
+
+    fields[ctype].append(data)
+
+    if id_key:
+        parents.append((ctype, data[id_key]))
+    subfields = field.keys()
+    for subfield in subfields:
+        if type(field[subfield]) == list:
+            for elem in field[subfield]:
+                traverse_clinical_field(
+                    fields, elem, subfield, parents, types, ingested_ids
+                )
+        elif type(field[subfield]) == dict:
+            traverse_clinical_field(
+                fields, field[subfield], subfield, parents, types, ingested_ids
+            )
+    if id_key:
+        parents.pop(-1)
+
+
+def validate_program(schema, types, program_id, ingest_map, timings=None):
+    """
+    Validate the donors of one program (ingest_map["donors"]) against a MoHSchemaV3 schema, then
+    flatten them into lists of records of each of types. The donors are consumed by flattening.
+    Returns the flattened records, or None if validation failed, and the lists of errors and warnings.
+    If timings is a dict, the time spent validating and flattening is added to it.
+    """
+    errors = []
+    logger.info(f"Validating input for program {program_id}")
+    with timed(timings, "validation"):
+        schema.validate_ingest_map(ingest_map)
+    warnings = [str(line) for line in schema.validation_warnings]
+    if len(warnings) > 0:
+        logger.info("Validation returned warnings:")
+        logger.info("\n".join(warnings))
+    if len(schema.validation_errors) > 0:
+        errors.append([str(line) for line in schema.validation_errors])
+        return None, errors, warnings
+    logger.info("Validation success.")
+
+    fields = {type: [] for type in types}
+    with timed(timings, "flattening"):
+        for donor in ingest_map["donors"]:
+            parents = [("programs", program_id)]
+            try:
+                ingested_ids = {}
+                traverse_clinical_field(
+                    fields, donor, "donors", parents, types, ingested_ids
+                )
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                errors.append(str(e))
+    return fields, errors, warnings
@@ -3,3 +3,5 @@ import os
 
 VERSION = "3.0.0-alpha"
 DAEMON_PATH = os.getenv("DAEMON_PATH", "~/tmp")
+# the katsu schema that clinical data is validated against when a submission doesn't name one
+DEFAULT_OPENAPI_URL = "https://raw.githubusercontent.com/CanDIG/katsu/develop/chord_metadata_service/mohpackets/docs/schemas/schema.yml"
@@ -1,10 +1,20 @@
 from config import DAEMON_PATH
+import auth
 import os
 from watchdog.observers import Observer
 import watchdog.events
 from candigv2_logging.logging import initialize, CanDIGLogger
 import json
-from katsu_ingest import ingest_schemas
+import shutil
+import threading
+import time
+import metrics
+import job_control
+import distributed
+from profiling import profiled
+from ingest_results import merge_partial_results
+from scheduler import Scheduler, INGEST_WORKERS, remove_job_meta
+from sharding import ingest_program
 from htsget_ingest import htsget_ingest
 
 
@@ -16,61 +26,216 @@ logger = CanDIGLogger(__file__)
 initialize()
 
 
+def add_timings(ingest_results, queued_timings, queue_wait, start):
+    """
+    Combine the timings of the stages run before the job was queued (parsing, validation, flattening,
+    auth checks) with the time spent in the queue and the timings of the ingest itself.
+    """
+    ingest_results["timings"] = {
+        **queued_timings,
+        "queue_wait": queue_wait,
+        "ingest": round(time.monotonic() - start, 4),
+        **ingest_results.get("timings", {})
+    }
+
+
 def ingest_file(file_path):
-    json_data = None
-    results = {}
-    results_path = os.path.join(DAEMON_PATH, "results", os.path.basename(file_path))
     with open(file_path) as f:
         json_data = json.load(f)
+    profile = json_data is not None and json_data.get("profile", False)
+    with profiled(f"job_{os.path.basename(file_path)}", enabled=profile):
+        try:
+            return ingest_job(file_path, json_data)
+        except Exception as e:
+            fail_job(file_path, e)
+            raise
+
+
+def fail_job(file_path, error):
+    """
+    Take a job that raised out of the queue, report the error in its status and remove its spool files.
+    """
+    queue_id = os.path.basename(file_path)
+    with open(os.path.join(DAEMON_PATH, "results", queue_id), "w") as f:
+        json.dump({"status": "failed", "errors": [str(error)]}, f)
+    job_control.clear_action(queue_id)
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+    remove_job_meta(queue_id)
+    shutil.rmtree(os.path.join(DAEMON_PATH, "spool", queue_id), ignore_errors=True)
+
+
+def pause_job(file_path, job, results):
+    """
+    Move a paused job out of the queue, keeping its spool files, checkpoint and partial results so
+    that it can be resumed.
+    """
+    queue_id = os.path.basename(file_path)
+    job["partial_results"] = results
+    os.makedirs(os.path.dirname(job_control.paused_path(queue_id)), exist_ok=True)
+    with open(f"{job_control.paused_path(queue_id)}.tmp", "w") as f:
+        json.dump(job, f)
+    os.replace(f"{job_control.paused_path(queue_id)}.tmp", job_control.paused_path(queue_id))
+    os.remove(file_path)
+
+
+def ingest_job(file_path, json_data):
+    results = {}
+    queue_id = os.path.basename(file_path)
+    results_path = os.path.join(DAEMON_PATH, "results", queue_id)
     if json_data is not None:
         logger.info(f"Ingesting {file_path}")
+        start = time.monotonic()
+        job = json_data
+        job_type = None
+        status_code = 200
+        queued_timings = json_data.get("timings", {})
+        queue_wait = None
+        if "queued_at" in json_data:
+            queue_wait = round(time.time() - json_data["queued_at"], 4)
+        # progress made before the job was paused, if it was
+        control = job_control.JobControl(queue_id)
+        checkpoint = job.setdefault("checkpoint", {"done": [], "progress": {}})
+        previous = job.get("partial_results", {})
+        stopped = control()
         if "katsu" in json_data:
+            job_type = "clinical"
+            batch_size = json_data.get("batch_size", 1000)
+            adaptive = json_data.get("adaptive_batching", False)
+            isolate_errors = json_data.get("isolate_errors", False)
+            delta = json_data.get("delta", False)
             json_data = json_data["katsu"]
             programs = list(json_data.keys())
             for program_id in programs:
-                ingest_results, status_code = ingest_schemas(json_data[program_id]["schemas"])
+                if program_id in checkpoint["done"]:
+                    results[program_id] = previous[program_id]
+                    continue
+                if stopped is not None:
+                    break
+                program_start = time.monotonic()
+                ingest_results, status_code = ingest_program(json_data[program_id], batch_size, adaptive, isolate_errors, delta,
+                                                             control, checkpoint["progress"].setdefault(program_id, {}))
                 results[program_id] = ingest_results
+                add_timings(ingest_results, queued_timings.get(program_id, {}), queue_wait, program_start)
+                merge_partial_results(ingest_results, previous.get(program_id, {}))
+                stopped = ingest_results.pop("stopped", None)
+                if stopped is None:
+                    checkpoint["done"].append(program_id)
         elif "htsget" in json_data:
+            job_type = "genomic"
             do_not_index = False
             if "do_not_index" in json_data:
                 do_not_index = json_data["do_not_index"]
             json_data = json_data["htsget"]
             programs = list(json_data.keys())
             for program_id in programs:
-                ingest_results, status_code = htsget_ingest(json_data[program_id], do_not_index)
+                if program_id in checkpoint["done"]:
+                    results[program_id] = previous[program_id]
+                    continue
+                if stopped is not None:
+                    break
+                program_start = time.monotonic()
+                ingest_results, status_code = htsget_ingest(json_data[program_id], do_not_index, control,
+                                                            checkpoint["progress"].setdefault(program_id, {}))
                 results[program_id] = ingest_results
+                add_timings(ingest_results, queued_timings.get(program_id, {}), queue_wait, program_start)
+                metrics.RECORDS_CREATED.labels("genomic_files").inc(len(ingest_results["results"]))
+                merge_partial_results(ingest_results, previous.get(program_id, {}))
+                stopped = ingest_results.pop("stopped", None)
+                if stopped is None:
+                    checkpoint["done"].append(program_id)
+        if stopped == job_control.PAUSE:
+            status = "paused"
+        elif stopped == job_control.CANCEL:
+            status = "cancelled"
+        else:
+            status = None
+        if status is not None:
+            logger.info(f"Ingest {queue_id} was {status}")
+            for program_id in programs:
+                if program_id not in checkpoint["done"]:
+                    results.setdefault(program_id, {"errors": [], "results": []})["status"] = status
         with open(results_path, "w") as f:
-            json.dump(results, f)
+            json.dump(results if len(results) > 0 or status is None else {"status": status}, f)
+        for program_id in results:
+            logger.info(json.dumps({"event": "ingest_timings", "queue_id": queue_id, "type": job_type,
+                                    "program_id": program_id, "timings": results[program_id].get("timings", {})}))
+        if job_type is not None:
+            failed = any(len(result["errors"]) > 0 for result in results.values())
+            metrics.JOBS.labels(job_type, status or ("failed" if failed else "succeeded")).inc()
+            metrics.JOB_DURATION.labels(job_type).observe(time.monotonic() - start)
+        job_control.clear_action(queue_id)
+        if stopped == job_control.PAUSE:
+            pause_job(file_path, job, results)
+            return results, status_code
         os.remove(file_path)
+        remove_job_meta(queue_id)
+        shutil.rmtree(os.path.join(DAEMON_PATH, "spool", queue_id), ignore_errors=True)
         return results, status_code
     return {"error": f"No such file {file_path}"}, 404
 
 
+def worker(scheduler):
+    while True:
+        file_path, meta = scheduler.next_job()
+        start = time.monotonic()
+        try:
+            ingest_file(file_path)
+        except Exception as e:
+            logger.warning(str(e))
+        finally:
+            scheduler.done(file_path, meta, time.monotonic() - start)
+
+
 class DaemonHandler(watchdog.events.FileSystemEventHandler):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
     def on_created(self, event):
-        ingest_file(event.src_path)
+        try:
+            self.scheduler.add(event.src_path)
+        except Exception as e:
+            logger.warning(str(e))
+
+    def on_moved(self, event):
+        # resumed jobs are moved back into the queue
+        try:
+            self.scheduler.add(event.dest_path)
+        except Exception as e:
+            logger.warning(str(e))
+
+
+# run as one of several daemons on different hosts that share DAEMON_PATH
+INGEST_DISTRIBUTED = os.getenv("INGEST_DISTRIBUTED", "false").lower() == "true"
 
 
 if __name__ == "__main__":
-    ## look for any backlog IDs, ingest those, then listen for new IDs to ingest.
     ingest_path = os.path.join(DAEMON_PATH, "to_ingest")
     logger.info(f"ingesting started on {ingest_path}")
-    to_ingest = os.listdir(ingest_path)
-    logger.info(f"Finishing backlog: ingesting {to_ingest}")
-    while len(to_ingest) > 0:
-        try:
-            file_path = f"{ingest_path}/{to_ingest.pop()}"
-            ingest_file(file_path)
-        except Exception as e:
-            logger.warning(str(e))
-        to_ingest = os.listdir(ingest_path)
+    # share one service token between all ingest jobs, refreshed before it expires
+    auth.service_token_provider.start()
+    if INGEST_DISTRIBUTED:
+        logger.info(f"taking ingest tasks from the shared queue with {INGEST_WORKERS} workers")
+        distributed.run(ingest_path, INGEST_WORKERS)
+    job_scheduler = Scheduler()
+    for i in range(INGEST_WORKERS):
+        threading.Thread(target=worker, args=(job_scheduler,), daemon=True).start()
 
-    # now that the backlog is complete, listen for new files created:
+    # listen for new files before queueing the backlog, so that no file is missed in between
     logger.info(f"listening for new files at {ingest_path}")
-    event_handler = DaemonHandler()
+    event_handler = DaemonHandler(job_scheduler)
     observer = Observer()
     observer.schedule(event_handler, ingest_path, recursive=False)
     observer.start()
+    to_ingest = os.listdir(ingest_path)
+    logger.info(f"Finishing backlog: ingesting {to_ingest}")
+    for queue_id in to_ingest:
+        try:
+            job_scheduler.add(os.path.join(ingest_path, queue_id))
+        except Exception as e:
+            logger.warning(str(e))
     try:
         while observer.is_alive():
             observer.join(1)
@@ -0,0 +1,420 @@
+import contextlib
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import config
+import job_control
+import metrics
+from batching import is_spooled, record_count, split_spool
+from htsget_ingest import htsget_ingest
+from ingest_results import merge_partial_results, merge_task_results
+from katsu_ingest import ingest_schemas
+from scheduler import remove_job_meta
+from sharding import PARENT_TYPES
+from candigv2_logging.logging import CanDIGLogger
+
+
+logger = CanDIGLogger(__file__)
+
+# In distributed mode, ingest daemons on any number of hosts that share DAEMON_PATH take work from
+# a shared SQLite task queue. Each job is split into tasks of up to INGEST_TASK_RECORDS records; a
+# worker holds a lease on its task, renews it before every batch and records how far it has got, so
+# that if the worker dies another one takes the task over from the last batch it finished. While a
+# batch is being sent, a heartbeat thread keeps renewing the lease, so that a slow batch isn't taken
+# over and sent twice. SQLite relies on file locks, so the queue must be on a local filesystem, or a
+# shared one whose locks work across hosts, such as NFS with locking.
+INGEST_QUEUE_DB = os.getenv("INGEST_QUEUE_DB")
+INGEST_TASK_RECORDS = int(os.getenv("INGEST_TASK_RECORDS", 10000))
+INGEST_LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS", 300))
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", 5))
+# a task that raises, or whose worker dies, this many times fails, and so does its job
+INGEST_TASK_ATTEMPTS = int(os.getenv("INGEST_TASK_ATTEMPTS", 3))
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+# returned by TaskControl when another worker has taken the task over
+LOST = "lost"
+
+
+def new_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def job_tasks(job):
+    """
+    Split a queued job into tasks. Each clinical task is a range of one type's spooled records; the
+    types of a program are ingested in order, so each type is a stage that can only start once the
+    stages before it are done. The shards of a sharded program (see sharding.spool_program) are a
+    last stage of one task per shard, after its programs and donors. Each genomic task is a range of
+    a program's samples.
+    """
+    tasks = []
+    if "katsu" in job:
+        for program_id, program in job["katsu"].items():
+            stages = program["schemas"].items()
+            if "shards" in program:
+                stages = [(type, records) for type, records in stages if type in PARENT_TYPES]
+            for stage, (type, records) in enumerate(stages):
+                if record_count(records) == 0:
+                    continue
+                ranges = split_spool(records, INGEST_TASK_RECORDS) if is_spooled(records) else [records]
+                for records_range in ranges:
+                    tasks.append((program_id, stage, {"fields": {type: records_range}}))
+            for shard in program.get("shards", []):
+                tasks.append((program_id, len(stages), {"fields": shard}))
+    elif "htsget" in job:
+        for program_id, samples in job["htsget"].items():
+            for start in range(0, len(samples), INGEST_TASK_RECORDS):
+                tasks.append((program_id, 0, {"samples": [start, min(start + INGEST_TASK_RECORDS, len(samples))]}))
+    return tasks
+
+
+class TaskQueue():
+    """
+    The shared queue of jobs and their tasks. Each thread needs its own TaskQueue.
+    """
+    def __init__(self, path=None):
+        self.path = path or INGEST_QUEUE_DB or os.path.join(config.DAEMON_PATH, "queue.sqlite")
+        # autocommit, so that transactions can be started with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (queue_id TEXT PRIMARY KEY, job TEXT, created REAL, "
+                        "finished INTEGER DEFAULT 0)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, queue_id TEXT, program_id TEXT, "
+                        "stage INTEGER, payload TEXT, state TEXT, worker TEXT, lease_expires REAL, progress TEXT, result TEXT, "
+                        "attempts INTEGER DEFAULT 0)")
+        try:
+            # queues created before tasks counted their failed attempts
+            self.db.execute("ALTER TABLE tasks ADD COLUMN attempts INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_by_job ON tasks (queue_id, program_id, stage)")
+        self.jobs = {}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def add_job(self, queue_id, job):
+        """
+        Add a job and its tasks, unless another node has already added it. Returns True if it was added.
+        """
+        with self.transaction():
+            if self.db.execute("SELECT 1 FROM jobs WHERE queue_id = ?", (queue_id,)).fetchone() is not None:
+                return False
+            self.db.execute("INSERT INTO jobs (queue_id, job, created) VALUES (?, ?, ?)",
+                            (queue_id, json.dumps(job), job.get("queued_at", time.time())))
+            self.db.executemany("INSERT INTO tasks (queue_id, program_id, stage, payload, state, progress) VALUES (?, ?, ?, ?, ?, ?)",
+                                [(queue_id, program_id, stage, json.dumps(payload), PENDING, "{}")
+                                 for program_id, stage, payload in job_tasks(job)])
+        return True
+
+    def job(self, queue_id):
+        if queue_id not in self.jobs:
+            row = self.db.execute("SELECT job FROM jobs WHERE queue_id = ?", (queue_id,)).fetchone()
+            self.jobs[queue_id] = json.loads(row["job"])
+        return self.jobs[queue_id]
+
+    def claim(self, worker):
+        """
+        Lease the next task that can run: the oldest job's first pending task, or a task whose lease
+        has expired, whose earlier stages are done and whose job isn't paused. Taking over an expired
+        lease counts as a failed attempt at the task. Returns None if there is no such task.
+        """
+        now = time.time()
+        with self.transaction():
+            rows = self.db.execute(
+                "SELECT tasks.* FROM tasks JOIN jobs USING (queue_id) "
+                "WHERE (tasks.state = ? OR (tasks.state = ? AND tasks.lease_expires < ?)) "
+                "AND NOT EXISTS (SELECT 1 FROM tasks AS earlier WHERE earlier.queue_id = tasks.queue_id "
+                "AND earlier.program_id = tasks.program_id AND earlier.stage < tasks.stage AND earlier.state IN (?, ?)) "
+                "ORDER BY jobs.created, tasks.id LIMIT 100", (PENDING, LEASED, now, PENDING, LEASED)).fetchall()
+            for row in rows:
+                if job_control.requested_action(row["queue_id"]) == job_control.PAUSE:
+                    continue
+                attempts = row["attempts"] + (1 if row["state"] == LEASED else 0)
+                self.db.execute("UPDATE tasks SET state = ?, worker = ?, lease_expires = ?, attempts = ? WHERE id = ?",
+                                (LEASED, worker, now + INGEST_LEASE_SECONDS, attempts, row["id"]))
+                return {**dict(row), "worker": worker, "attempts": attempts}
+        return None
+
+    def renew(self, task, checkpoint):
+        """
+        Extend the lease on a task and record its progress. Returns False if the lease has been lost.
+        """
+        with self.transaction():
+            cursor = self.db.execute("UPDATE tasks SET lease_expires = ?, progress = ? WHERE id = ? AND worker = ? AND state = ?",
+                                     (time.time() + INGEST_LEASE_SECONDS, json.dumps(checkpoint), task["id"], task["worker"], LEASED))
+            return cursor.rowcount == 1
+
+    def extend(self, task):
+        """
+        Extend the lease on a task without recording its progress. Returns False if the lease has been lost.
+        """
+        with self.transaction():
+            cursor = self.db.execute("UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?",
+                                     (time.time() + INGEST_LEASE_SECONDS, task["id"], task["worker"], LEASED))
+            return cursor.rowcount == 1
+
+    def release(self, task, checkpoint, result):
+        """
+        Give back a task that was stopped because its job was paused, keeping its progress and partial result.
+        """
+        with self.transaction():
+            self.db.execute("UPDATE tasks SET state = ?, worker = NULL, progress = ?, result = ? WHERE id = ? AND worker = ?",
+                            (PENDING, json.dumps(checkpoint), json.dumps(result), task["id"], task["worker"]))
+
+    def fail(self, task, error):
+        """
+        Count a failed attempt at a task and give it back to be tried again, or, after
+        INGEST_TASK_ATTEMPTS of them, finish it as failed. Returns True if this was the last task of
+        its job, in which case the caller completes the job.
+        """
+        with self.transaction():
+            cursor = self.db.execute("UPDATE tasks SET attempts = attempts + 1 WHERE id = ? AND worker = ? AND state = ?",
+                                     (task["id"], task["worker"], LEASED))
+            if cursor.rowcount == 0:
+                return False
+            attempts = self.db.execute("SELECT attempts FROM tasks WHERE id = ?", (task["id"],)).fetchone()[0]
+            if attempts < INGEST_TASK_ATTEMPTS:
+                self.db.execute("UPDATE tasks SET state = ?, worker = NULL WHERE id = ?", (PENDING, task["id"]))
+                return False
+        return self.finish(task, {"errors": [error], "results": []}, FAILED)
+
+    def finish(self, task, result, state=DONE):
+        """
+        Record the result of a task. A cancelled or failed task cancels the tasks of its job that
+        haven't started. Returns True if this was the last task of its job, in which case the caller
+        completes the job.
+        """
+        with self.transaction():
+            cursor = self.db.execute("UPDATE tasks SET state = ?, worker = NULL, result = ? WHERE id = ? AND worker = ? AND state = ?",
+                                     (state, json.dumps(result), task["id"], task["worker"], LEASED))
+            if cursor.rowcount == 0:
+                return False
+            if state in (CANCELLED, FAILED):
+                self.db.execute("UPDATE tasks SET state = ? WHERE queue_id = ? AND state = ?", (CANCELLED, task["queue_id"], PENDING))
+            remaining = self.db.execute("SELECT COUNT(*) FROM tasks WHERE queue_id = ? AND state IN (?, ?)",
+                                        (task["queue_id"], PENDING, LEASED)).fetchone()[0]
+            if remaining > 0:
+                return False
+            cursor = self.db.execute("UPDATE jobs SET finished = 1 WHERE queue_id = ? AND finished = 0", (task["queue_id"],))
+            return cursor.rowcount == 1
+
+    def task_results(self, queue_id):
+        return self.db.execute("SELECT program_id, state, result FROM tasks WHERE queue_id = ? ORDER BY id", (queue_id,)).fetchall()
+
+    def remove_job(self, queue_id):
+        with self.transaction():
+            self.db.execute("DELETE FROM tasks WHERE queue_id = ?", (queue_id,))
+            self.db.execute("DELETE FROM jobs WHERE queue_id = ?", (queue_id,))
+        self.jobs.pop(queue_id, None)
+
+    def close(self):
+        self.db.close()
+
+
+class TaskControl():
+    """
+    Called before each batch of a task: renews the task's lease and records its checkpoint, and
+    passes on cancel and pause requests for its job. While it is used as a context manager, a
+    heartbeat thread also renews the lease every third of INGEST_LEASE_SECONDS, however long a batch
+    takes.
+    """
+    def __init__(self, tasks, task, checkpoint):
+        self.tasks = tasks
+        self.task = task
+        self.checkpoint = checkpoint
+        self.job_control = job_control.JobControl(task["queue_id"])
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=self._heartbeat, name=f"lease-{self.task['id']}", daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.heartbeat.join()
+        self.heartbeat = None
+
+    def _heartbeat(self):
+        # sqlite connections can't be shared between threads
+        tasks = TaskQueue(self.tasks.path)
+        try:
+            while not self.stopped.wait(INGEST_LEASE_SECONDS / 3):
+                try:
+                    if not tasks.extend(self.task):
+                        self.lost.set()
+                        return
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not renew the lease on task {self.task['id']}: {e}")
+        finally:
+            tasks.close()
+
+    def __call__(self):
+        if self.lost.is_set() or not self.tasks.renew(self.task, self.checkpoint):
+            return LOST
+        return self.job_control()
+
+
+def run_task(tasks, task):
+    """
+    Ingest one task. Returns True if it was the last task of its job.
+    """
+    job = tasks.job(task["queue_id"])
+    payload = json.loads(task["payload"])
+    checkpoint = json.loads(task["progress"] or "{}")
+    with TaskControl(tasks, task, checkpoint) as control:
+        if "katsu" in job:
+            result, status_code = ingest_schemas(payload["fields"], job.get("batch_size", 1000), job.get("adaptive_batching", False),
+                                                 job.get("isolate_errors", False), job.get("delta", False), control, checkpoint)
+        else:
+            start, end = payload["samples"]
+            result, status_code = htsget_ingest(job["htsget"][task["program_id"]][start:end], job.get("do_not_index", False),
+                                                control, checkpoint)
+            metrics.RECORDS_CREATED.labels("genomic_files").inc(len(result["results"]))
+    if task["result"] is not None:
+        merge_partial_results(result, json.loads(task["result"]))
+    stopped = result.pop("stopped", None)
+    if stopped == LOST:
+        logger.warning(f"Lost the lease on task {task['id']} of {task['queue_id']}")
+        return False
+    if stopped == job_control.PAUSE:
+        tasks.release(task, checkpoint, result)
+        return False
+    return tasks.finish(task, result, CANCELLED if stopped == job_control.CANCEL else DONE)
+
+
+def attempt_task(tasks, task):
+    """
+    Run a claimed task, unless it has already failed INGEST_TASK_ATTEMPTS times. A task that raises
+    is given back to be tried again, until it has failed that many times. Returns True if it was the
+    last task of its job.
+    """
+    if task["attempts"] >= INGEST_TASK_ATTEMPTS:
+        logger.warning(f"Giving up on task {task['id']} of {task['queue_id']} after {task['attempts']} attempts")
+        return tasks.finish(task, {"errors": [f"the ingest stopped {task['attempts']} times"], "results": []}, FAILED)
+    try:
+        return run_task(tasks, task)
+    except Exception as e:
+        logger.warning(f"Task {task['id']} of {task['queue_id']} failed: {e}")
+        return tasks.fail(task, str(e))
+
+
+def complete_job(tasks, queue_id):
+    """
+    Merge the results of a job's tasks into its status, and clean up after it. A job with a failed
+    task fails, as daemon.fail_job would fail it.
+    """
+    job = tasks.job(queue_id)
+    rows = tasks.task_results(queue_id)
+    job_type = "clinical" if "katsu" in job else "genomic"
+    failures = [error for row in rows if row["state"] == FAILED for error in json.loads(row["result"])["errors"]]
+    if len(failures) > 0:
+        with open(os.path.join(config.DAEMON_PATH, "results", queue_id), "w") as f:
+            json.dump({"status": "failed", "errors": failures}, f)
+        metrics.JOBS.labels(job_type, "failed").inc()
+        clean_up_job(tasks, queue_id)
+        return None
+    results = merge_task_results([(row["program_id"], json.loads(row["result"]) if row["result"] else None) for row in rows])
+    cancelled = {row["program_id"] for row in rows if row["state"] == CANCELLED}
+    for program_id, program_results in results.items():
+        program_results["timings"] = {**job.get("timings", {}).get(program_id, {}), **program_results.get("timings", {})}
+        if program_id in cancelled:
+            program_results["status"] = "cancelled"
+    with open(os.path.join(config.DAEMON_PATH, "results", queue_id), "w") as f:
+        json.dump(results, f)
+    for program_id in results:
+        logger.info(json.dumps({"event": "ingest_timings", "queue_id": queue_id, "type": job_type,
+                                "program_id": program_id, "timings": results[program_id]["timings"]}))
+    failed = any(len(result["errors"]) > 0 for result in results.values())
+    metrics.JOBS.labels(job_type, "cancelled" if len(cancelled) > 0 else ("failed" if failed else "succeeded")).inc()
+    metrics.JOB_DURATION.labels(job_type).observe(time.time() - job.get("queued_at", time.time()))
+    clean_up_job(tasks, queue_id)
+    return results
+
+
+def clean_up_job(tasks, queue_id):
+    job_control.clear_action(queue_id)
+    remove_job_meta(queue_id)
+    shutil.rmtree(os.path.join(config.DAEMON_PATH, "spool", queue_id), ignore_errors=True)
+    tasks.remove_job(queue_id)
+
+
+def add_queued_jobs(tasks, ingest_path):
+    """
+    Move the jobs queued in ingest_path into the task queue. Several nodes can do this at once.
+    """
+    for queue_id in os.listdir(ingest_path):
+        file_path = os.path.join(ingest_path, queue_id)
+        try:
+            with open(file_path) as f:
+                job = json.load(f)
+            if tasks.add_job(queue_id, job):
+                task_count = len(job_tasks(job))
+                logger.info(f"Queued {queue_id} as {task_count} tasks")
+                if task_count == 0:
+                    # no task will finish, so the job is complete already
+                    complete_job(tasks, queue_id)
+            os.remove(file_path)
+        except (FileNotFoundError, ValueError):
+            # another node has taken the job, or it is still being written
+            pass
+
+
+def feeder(ingest_path):
+    tasks = TaskQueue()
+    while True:
+        try:
+            add_queued_jobs(tasks, ingest_path)
+        except Exception as e:
+            logger.warning(str(e))
+        time.sleep(INGEST_POLL_SECONDS)
+
+
+def worker():
+    tasks = TaskQueue()
+    worker_id = new_worker_id()
+    while True:
+        try:
+            task = tasks.claim(worker_id)
+            if task is None:
+                time.sleep(INGEST_POLL_SECONDS)
+                continue
+            if attempt_task(tasks, task):
+                complete_job(tasks, task["queue_id"])
+        except Exception as e:
+            logger.warning(str(e))
+            time.sleep(INGEST_POLL_SECONDS)
+
+
+def run(ingest_path, workers):
+    """
+    Run this node's share of the distributed ingest: poll ingest_path for new jobs and work on tasks
+    from the shared queue with workers threads.
+    """
+    TaskQueue().close()
+    threads = [threading.Thread(target=feeder, args=(ingest_path,), daemon=True)]
+    threads.extend(threading.Thread(target=worker, daemon=True) for i in range(workers))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
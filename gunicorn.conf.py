@@ -10,3 +10,11 @@ accesslog = '-'
 access_log_format = 'INFO\t%(m)s\t%(U)s\t%(b)s\t%(M)s\t%(s)s'
 capture_output = True
 syslog = True
+
+
+
+def child_exit(server, worker):
+    # let the metrics of exited workers be aggregated correctly
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR") is not None:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,14 +1,21 @@
 import argparse
+import functools
 
 import auth
-from authx.auth import get_site_admin_token, is_action_allowed_for_program, create_service_token
+import metrics
+from authx.auth import get_site_admin_token
+from auth import is_action_allowed_for_program
 import os
-import re
 import json
+from timing import timed, add_time
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ingest_result import IngestServerException, IngestUserException, IngestResult
-import requests
 import sys
 from urllib.parse import urlparse
+from s3_urls import get_access_method, parse_s3_url, parse_s3_urls
+from profiling import in_profile
 from clinical_etl.schema import openapi_to_jsonschema
 import jsonschema
 from candigv2_logging.logging import CanDIGLogger
@@ -22,9 +29,19 @@ HTSGET_URL = os.getenv("HTSGET_URL", f"{CANDIG_URL}/genomics")
 DRS_HOST_URL = "drs://" + CANDIG_URL.replace(f"{urlparse(CANDIG_URL).scheme}://","") + "/genomics"
 KATSU_URL = os.environ.get("KATSU_URL")
 IS_TESTING = os.getenv("IS_TESTING", False)
+# number of htsget verify requests sent at once
+HTSGET_VERIFY_WORKERS = int(os.getenv("HTSGET_VERIFY_WORKERS", 8))
+# how long a successful verification of a file is remembered
+HTSGET_VERIFY_CACHE_SECONDS = float(os.getenv("HTSGET_VERIFY_CACHE_SECONDS", 3600))
+# how long the listing of an S3 prefix is reused when checking that genomic files exist
+S3_PREFLIGHT_CACHE_SECONDS = float(os.getenv("S3_PREFLIGHT_CACHE_SECONDS", 300))
 
 
-def link_genomic_data(sample, do_not_index=False):
+def link_genomic_data(sample, do_not_index=False, timings=None, verify=True):
+    """
+    Write the DRS objects for a genomic file and its samples. Unless verify is False, the file is
+    then verified with htsget, and flagged for indexing in result["to_index"] if it can be read.
+    """
     url = f"{HTSGET_URL}/ga4gh/drs/v1/objects"
     result = {
         "errors": [],
@@ -35,13 +52,14 @@ def link_genomic_data(sample, do_not_index=False):
     headers = {}
     if not IS_TESTING:
         headers = {
-            "X-Service-Token": create_service_token(),
+            "X-Service-Token": auth.get_service_token(),
             "Content-Type": "application/json"
         }
 
     # get the master genomic object, or create it:
+    drs_start = time.monotonic()
     genomic_drs_obj = {}
-    response = requests.get(f"{url}/{sample['genomic_file_id']}", headers=headers)
+    response = auth.service_request("htsget", "drs", "GET", f"{url}/{sample['genomic_file_id']}", headers=headers)
     if response.status_code == 200:
         genomic_drs_obj = response.json()
     genomic_drs_obj["id"] = sample["genomic_file_id"]
@@ -75,7 +93,7 @@ def link_genomic_data(sample, do_not_index=False):
             "version": "v1",
             "contents": []
         }
-        response = requests.get(f"{url}/{clin_sample['submitter_sample_id']}", headers=headers)
+        response = auth.service_request("htsget", "drs", "GET", f"{url}/{clin_sample['submitter_sample_id']}", headers=headers)
         if response.status_code == 200:
             sample_drs_obj = response.json()
 
@@ -94,7 +112,7 @@ def link_genomic_data(sample, do_not_index=False):
             sample_drs_obj["contents"].append(contents_obj)
 
         # update the sample_drs_object in the database:
-        response = requests.post(f"{url}", json=sample_drs_obj, headers=headers)
+        response = auth.service_request("htsget", "drs", "POST", f"{url}", json=sample_drs_obj, headers=headers)
         if response.status_code != 200:
             result["errors"].append({"error": f"error creating sample drs object {sample_drs_obj['id']}: {response.status_code} {response.text}"})
         else:
@@ -119,29 +137,99 @@ def link_genomic_data(sample, do_not_index=False):
             result.pop("sample")
 
     # finally, post the genomic_drs_object
-    response = requests.post(url, json=genomic_drs_obj, headers=headers)
+    response = auth.service_request("htsget", "drs", "POST", url, json=genomic_drs_obj, headers=headers)
     if response.status_code != 200:
         result["errors"].append({"error": f"error posting genomic drs object {genomic_drs_obj['id']}: {response.status_code} {response.text}"})
     else:
         result["genomic"] = response.json()
 
+    if timings is not None:
+        add_time(timings, time.monotonic() - drs_start, "drs")
+    if not verify:
+        return result
+
     # verify that the genomic file exists and is readable
-    verify_url = f"{HTSGET_URL}/htsget/v1/{sample['metadata']['data_type']}s/{genomic_drs_obj['id']}/verify"
     logger.debug(f"{sample['genomic_file_id']} Are we indexing? do_not_index = {do_not_index}")
-
-    response = requests.get(verify_url, headers=headers)
-    if response.status_code != 200:
-        result["errors"].append({"error": f"could not verify sample: {response.text}"})
-    elif not response.json()['result']:
-        result["errors"].append({"error": f"could not verify sample: {response.json()['message']}"})
+    with timed(timings, "verify"):
+        error = verify_sample(sample, headers)
+    if error is not None:
+        result["errors"].append({"error": error})
     else:
         # flag the genomic_drs_object for indexing:
-        logger.debug(f"Are we indexing? do_not_index = {do_not_index}")
-        url =f"{HTSGET_URL}/htsget/v1/{sample['metadata']['data_type']}s/{genomic_drs_obj['id']}/index"
-        result["to_index"].append(url)
+        result["to_index"].append(index_url(sample))
     return result
 
 
+def index_url(sample):
+    return f"{HTSGET_URL}/htsget/v1/{sample['metadata']['data_type']}s/{sample['genomic_file_id']}/index"
+
+
+def verify_sample(sample, headers):
+    """
+    Ask htsget to verify that a linked genomic file exists and is readable. Returns None if it is,
+    or the reason it isn't.
+    """
+    verify_url = f"{HTSGET_URL}/htsget/v1/{sample['metadata']['data_type']}s/{sample['genomic_file_id']}/verify"
+    response = auth.service_request("htsget", "verify", "GET", verify_url, headers=headers)
+    if response.status_code != 200:
+        return f"could not verify sample: {response.text}"
+    if not response.json()['result']:
+        return f"could not verify sample: {response.json()['message']}"
+    return None
+
+
+class VerifyCache():
+    """
+    Remembers the genomic files that htsget has verified, for ttl seconds, so that re-ingesting the
+    same files doesn't verify them again. Entries are keyed by the access URL and, where it is known
+    (see preflight_s3), the ETag of each of the sample's files, so a file that changes is verified again.
+    """
+    def __init__(self, ttl=HTSGET_VERIFY_CACHE_SECONDS):
+        self.ttl = ttl
+        self.verified = {}
+        self.lock = threading.Lock()
+
+    def key(self, sample):
+        files = [(sample[file]["access_method"], sample[file].get("etag")) for file in ("main", "index") if file in sample]
+        return (sample["genomic_file_id"], sample["metadata"]["data_type"], tuple(files))
+
+    def get(self, sample):
+        with self.lock:
+            verified_at = self.verified.get(self.key(sample))
+        return verified_at is not None and time.monotonic() - verified_at < self.ttl
+
+    def add(self, sample):
+        with self.lock:
+            self.verified[self.key(sample)] = time.monotonic()
+
+
+verify_cache = VerifyCache()
+
+
+def verify_samples(samples, headers, workers=HTSGET_VERIFY_WORKERS, cache=None):
+    """
+    Verify linked samples with htsget, workers at a time, skipping those that were verified recently
+    (see VerifyCache).
+    Returns a dict of genomic_file_id to the reason each sample that failed could not be verified,
+    and the number of samples that were found in the cache.
+    """
+    if cache is None:
+        cache = verify_cache
+    to_verify = [sample for sample in samples if not cache.get(sample)]
+
+    def verify(sample):
+        return sample, verify_sample(sample, headers)
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for sample, error in executor.map(in_profile(verify), to_verify):
+            if error is None:
+                cache.add(sample)
+            else:
+                failures[sample["genomic_file_id"]] = error
+    return failures, len(samples) - len(to_verify)
+
+
 def add_file_drs_object(genomic_drs_obj, file, type, headers):
     url = f"{HTSGET_URL}/ga4gh/drs/v1/objects"
     obj = {
@@ -173,67 +261,131 @@ def add_file_drs_object(genomic_drs_obj, file, type, headers):
                 break
     if not_found:
         genomic_drs_obj["contents"].append(contents_obj)
-    response = requests.post(url, json=obj, headers=headers)
+    response = auth.service_request("htsget", "drs", "POST", url, json=obj, headers=headers)
     if response.status_code > 200:
         return {"error": f"error creating file drs object: {response.status_code} {response.text}"}
     return contents_obj
 
 
-def get_access_method(url):
-    if url.startswith("file"):
-        return {
-            "type": "file",
-            "access_url": {
-                "url": url
-            }
-        }
-    try:
-        result = parse_s3_url(url)
-    except Exception as e:
-        return {
-            "message": str(e)
-        }
-    return {
-        "type": "s3",
-        "access_id": url
-    }
+class S3ListingCache():
+    """
+    Remembers, for ttl seconds, the objects (and their ETags) listed under each prefix of a bucket.
+    """
+    def __init__(self, ttl=S3_PREFLIGHT_CACHE_SECONDS):
+        self.ttl = ttl
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, bucket, prefix):
+        with self.lock:
+            listed_at, objects = self.listings.get((endpoint, bucket, prefix), (None, None))
+        if listed_at is None or time.monotonic() - listed_at >= self.ttl:
+            return None
+        return objects
+
+    def add(self, endpoint, bucket, prefix, objects):
+        with self.lock:
+            self.listings[(endpoint, bucket, prefix)] = (time.monotonic(), objects)
 
 
-def parse_s3_url(url):
+s3_listing_cache = S3ListingCache()
+
+
+def list_s3_prefix(client, endpoint, bucket, prefix, cache=None, expected=()):
     """
-    Parse a url into s3 components
+    The objects directly under prefix in bucket, as a dict of object name to ETag. A cached listing is
+    only used if it has all of the expected object names, since the others may have been uploaded
+    after it was made.
     """
-    s3_url_parse = re.match(r"((https*|s3):\/\/(.+?))\/(.+)", url)
-    if s3_url_parse is not None:
-        if s3_url_parse.group(2) == "s3":
-            raise Exception(f"Incorrect URL format {url}. S3 URLs should be in the form http(s)://endpoint-url/bucket-name/object. If your object is stored at AWS S3, you can find more information about endpoint URLs at https://docs.aws.amazon.com/general/latest/gr/rande.html")
-        endpoint = s3_url_parse.group(1)
-        bucket_parse = re.match(r"(.+?)\/(.+)", s3_url_parse.group(4))
-        if bucket_parse is not None:
-            return {
-                "endpoint": endpoint,
-                "bucket": bucket_parse.group(1),
-                "object": bucket_parse.group(2)
-            }
-        raise Exception(f"S3 URI {url} does not contain a bucket name")
-    raise Exception(f"URI {url} cannot be parsed as an S3-style URI")
+    if cache is None:
+        cache = s3_listing_cache
+    objects = cache.get(endpoint, bucket, prefix)
+    if objects is None or any(name not in objects for name in expected):
+        objects = {obj.object_name: obj.etag for obj in client.list_objects(bucket, prefix=prefix, recursive=False)}
+        cache.add(endpoint, bucket, prefix, objects)
+    return objects
+
+
+def preflight_s3(samples, token, cache=None):
+    """
+    Check that the S3 objects of samples exist and can be read with the stored credentials, before
+    anything is written to DRS. Files are grouped by endpoint and bucket: the credential for each
+    group is read once, and the objects are found by listing the prefixes they are in rather than
+    by a request per file. The credentials are read by ingest itself, whoever submitted the samples,
+    and are only used for listing. Public objects and local files are left to htsget's verify step.
+    Returns a dict of genomic_file_id to the errors for its files. The ETag of each object that was
+    found is added to its file, for the verify cache.
+    """
+    parsed_urls, url_errors = parse_s3_urls(samples)
+    errors = {genomic_file_id: [error["error"] for error in sample_errors] for genomic_file_id, sample_errors in url_errors.items()}
+    samples_by_id = {sample["genomic_file_id"]: sample for sample in samples}
+    groups = {}
+    for (genomic_file_id, file), parsed in parsed_urls.items():
+        sample = samples_by_id[genomic_file_id]
+        object_name, query = parsed["object"].split("?", 1) if "?" in parsed["object"] else (parsed["object"], "")
+        if "public=true" in query:
+            continue
+        group = groups.setdefault((parsed["endpoint"], parsed["bucket"]), {})
+        prefix = object_name.rpartition("/")[0]
+        group.setdefault(f"{prefix}/" if prefix else "", []).append((sample, file, object_name))
+
+    for (endpoint, bucket), prefixes in groups.items():
+        group_files = [entry for entries in prefixes.values() for entry in entries]
+        credential, status_code = auth.get_service_s3_credential(endpoint, bucket)
+        if status_code != 200:
+            for sample, file, object_name in group_files:
+                errors.setdefault(sample["genomic_file_id"], []).append(f"no S3 credentials are stored for {endpoint}/{bucket}")
+            continue
+        try:
+            client = auth.get_minio_client(token, endpoint, bucket, access_key=credential["access"],
+                                           secret_key=credential["secret"])["client"]
+            listings = {prefix: list_s3_prefix(client, endpoint, bucket, prefix, cache, [entry[2] for entry in entries])
+                        for prefix, entries in prefixes.items()}
+        except Exception as e:
+            for sample, file, object_name in group_files:
+                errors.setdefault(sample["genomic_file_id"], []).append(f"could not read {endpoint}/{bucket}: {e}")
+            continue
+        for prefix, entries in prefixes.items():
+            for sample, file, object_name in entries:
+                if object_name in listings[prefix]:
+                    sample[file]["etag"] = listings[prefix][object_name]
+                else:
+                    errors.setdefault(sample["genomic_file_id"], []).append(f"{sample[file]['access_method']} does not exist")
+    return errors
 
 
-def htsget_ingest(ingest_json, do_not_index=False):
+def htsget_ingest(ingest_json, do_not_index=False, control=None, checkpoint=None):
+    """
+    Link each sample's files in DRS, then verify the linked files with htsget in bulk (see
+    verify_samples) and index those that could be verified. If control is set (see
+    job_control.JobControl), it is called before each sample; if it returns an action, the samples
+    linked so far are verified and indexed, the ingest stops and the action is reported in
+    result["stopped"]. The number of samples done so far is kept in checkpoint["samples"], and an
+    ingest given the same checkpoint carries on from there.
+    The number of samples verified, found in the verify cache and that failed verification are
+    reported in result["verification"].
+    """
+    if checkpoint is None:
+        checkpoint = {}
     result = {
         "errors": {},
-        "results": {}
+        "results": {},
+        "timings": {}
     }
-    to_index = []
+    linked = []
     status_code = 200
-    for sample in ingest_json:
+    for sample in ingest_json[checkpoint.get("samples", 0):]:
+        stopped = control() if control is not None else None
+        if stopped is not None:
+            result["stopped"] = stopped
+            break
         logger.debug(f"Ingesting {sample['genomic_file_id']}, do_not_index = {do_not_index}")
         result["errors"][sample["genomic_file_id"]] = []
         # create the corresponding DRS objects
         if "samples" not in sample or len(sample["samples"]) == 0:
             result["errors"][sample["genomic_file_id"]].append("No samples were specified for the genomic file mapping")
             break
-        response = link_genomic_data(sample, do_not_index)
+        response = link_genomic_data(sample, do_not_index, result["timings"], verify=False)
         for err in response["errors"]:
             result["errors"][sample["genomic_file_id"]].append(err)
             if "403" in err:
@@ -241,29 +393,52 @@ def htsget_ingest(ingest_json, do_not_index=False):
                 break
         if len(result["errors"][sample["genomic_file_id"]]) == 0:
             result["errors"].pop(sample["genomic_file_id"])
+            linked.append(sample)
         response.pop("errors")
-        to_index.extend(response["to_index"])
         if len(response) > 0:
             result["results"][sample["genomic_file_id"]] = response
+        checkpoint["samples"] = checkpoint.get("samples", 0) + 1
     # Use service token to authenticate this with htsget
     headers = {}
     if not IS_TESTING:
         headers = {
-            "X-Service-Token": create_service_token(),
+            "X-Service-Token": auth.get_service_token(),
             "Content-Type": "application/json"
         }
 
+    with timed(result["timings"], "verify"):
+        failures, cached = verify_samples(linked, headers)
+    for genomic_file_id, error in failures.items():
+        result["errors"].setdefault(genomic_file_id, []).append({"error": error})
+    result["verification"] = {"verified": len(linked) - len(failures), "cached": cached, "failed": len(failures)}
+    if len(failures) > 0:
+        logger.warning(f"{len(failures)} of {len(linked)} genomic files could not be verified: {', '.join(failures.keys())}")
+
     # send off index calls
-    for url in to_index:
-        response = requests.get(url, headers=headers, params={"do_not_index": do_not_index})
+    for sample in linked:
+        if sample["genomic_file_id"] in failures:
+            continue
+        result["results"][sample["genomic_file_id"]]["to_index"].append(index_url(sample))
+        with timed(result["timings"], "index"):
+            response = auth.service_request("htsget", "index", "GET", index_url(sample), headers=headers, params={"do_not_index": do_not_index})
 
     return result, status_code
 
 
-def check_genomic_data(dataset, token):
-    with open("ingest_openapi.yaml") as f:
+@functools.cache
+def get_genomic_sample_schema():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_openapi.yaml")) as f:
         openapi_text = f.read()
-        json_schema = openapi_to_jsonschema(openapi_text, "GenomicSample")
+        return openapi_to_jsonschema(openapi_text, "GenomicSample")
+
+
+def check_genomic_data(dataset, token, timings=None):
+    """
+    Check that the user can ingest to each program and that the samples are valid and exist in katsu.
+    If timings is a dict, the time spent on auth checks, katsu lookups and validation is added to
+    timings[program_id].
+    """
+    json_schema = get_genomic_sample_schema()
     result = {
         "errors": {},
     }
@@ -279,14 +454,20 @@ def check_genomic_data(dataset, token):
     for program_id in by_program.keys():
         if program_id not in result["errors"]:
             result["errors"][program_id] = []
-        response, status_code = auth.get_program_in_opa(program_id, token)
+        program_timings = None
+        if timings is not None:
+            program_timings = timings.setdefault(program_id, {})
+        with timed(program_timings, "auth"):
+            response, status_code = auth.get_program_in_opa(program_id, token)
+            allowed = status_code > 300 or is_action_allowed_for_program(token, method="POST", path="/ga4gh/drs/v1/objects", program=program_id)
         if status_code > 300:
             result["errors"][program_id].append({"not found": "No program authorization exists"})
-        elif not is_action_allowed_for_program(token, method="POST", path="/ga4gh/drs/v1/objects", program=program_id):
+        elif not allowed:
             result["errors"][program_id].append({"unauthorized": "user is not allowed to ingest to program"})
             continue
         # look for program in katsu
-        response = requests.get(f"{KATSU_URL}/v3/authorized/programs", params={"program_id": program_id}, headers=headers)
+        with timed(program_timings, "katsu_lookup"):
+            response = metrics.request("katsu", "authorized", "GET", f"{KATSU_URL}/v3/authorized/programs", params={"program_id": program_id}, headers=headers)
         if response.status_code == 200:
             if "items" in response.json() and len(response.json()["items"]) == 0:
                 result["errors"][program_id].append({"no such program": "program does not exist in clinical data"})
@@ -294,9 +475,11 @@ def check_genomic_data(dataset, token):
 
         # get all sample_registrations for this program
         samples_in_program = []
-        response = requests.get(f"{KATSU_URL}/v3/authorized/sample_registrations", params={"program_id": program_id, "page_size": 10000000}, headers=headers)
+        with timed(program_timings, "katsu_lookup"):
+            response = metrics.request("katsu", "authorized", "GET", f"{KATSU_URL}/v3/authorized/sample_registrations", params={"program_id": program_id, "page_size": 10000000}, headers=headers)
         if response.status_code == 200:
             samples_in_program.extend(list(map(lambda x: x["submitter_sample_id"], response.json()["items"])))
+        validation_start = time.monotonic()
         for sample in by_program[program_id]:
             sample_errors = []
             # validate the json
@@ -313,6 +496,13 @@ def check_genomic_data(dataset, token):
                     sample_errors.append({"no such sample": f"sample {submitter_sample['submitter_sample_id']} does not exist in clinical data {samples_in_program}"})
             if len(sample_errors) > 0:
                 result["errors"][program_id].append({sample["genomic_file_id"]: sample_errors})
+        if program_timings is not None:
+            add_time(program_timings, time.monotonic() - validation_start, "validation")
+        # fail before anything is written to DRS if the files can't be found
+        with timed(program_timings, "s3_preflight"):
+            s3_errors = preflight_s3(by_program[program_id], token)
+        for genomic_file_id, errors in s3_errors.items():
+            result["errors"][program_id].append({genomic_file_id: errors})
         if len(result["errors"][program_id]) == 0:
             result["errors"].pop(program_id)
     if len(result["errors"]) == 0:
@@ -0,0 +1,117 @@
+import functools
+import gzip
+import io
+import json
+import os
+import jsonschema
+from clinical_etl.schema import openapi_to_jsonschema
+from config import DEFAULT_OPENAPI_URL
+
+
+NDJSON_TYPES = ["application/x-ndjson", "application/ndjson", "application/jsonl"]
+# the largest request body accepted, after decompression
+INGEST_MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", 1024 * 1024 * 1024))
+
+
+class BodyTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__(f"request body is larger than the maximum of {max_bytes} bytes")
+
+
+@functools.cache
+def get_request_schema(schema_name):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_openapi.yaml")) as f:
+        return openapi_to_jsonschema(f.read(), schema_name)
+
+
+def open_body(data, content_encoding=None):
+    """
+    Returns a binary stream over a request body, decompressing it on the fly if it is gzip-encoded.
+    """
+    stream = io.BytesIO(data)
+    if content_encoding is not None and content_encoding.strip().lower() in ["gzip", "x-gzip"]:
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    return stream
+
+
+def iter_ndjson(stream):
+    """
+    Parse a stream of newline-delimited JSON one line at a time, skipping blank lines.
+    Raises a ValueError that names the line number if a line is not valid JSON.
+    """
+    for line_number, line in enumerate(stream, start=1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}")
+
+
+def limited_lines(stream, max_bytes):
+    """
+    Yield the lines of a stream, raising BodyTooLarge once more than max_bytes have been read.
+    """
+    total = 0
+    while True:
+        line = stream.readline(max_bytes - total + 1)
+        if len(line) == 0:
+            return
+        total += len(line)
+        if total > max_bytes:
+            raise BodyTooLarge(max_bytes)
+        yield line
+
+
+def read_body(data, mimetype, content_encoding=None, max_bytes=None):
+    """
+    Parse a JSON or NDJSON request body, which may be gzip-encoded. NDJSON bodies are returned as a list
+    of the objects on each line. A gzip-encoded body is decompressed as it is parsed, and no more than
+    max_bytes (by default INGEST_MAX_BODY_BYTES) of it are decompressed: BodyTooLarge is raised for
+    anything larger.
+    """
+    max_bytes = max_bytes or INGEST_MAX_BODY_BYTES
+    stream = open_body(data, content_encoding)
+    try:
+        if mimetype in NDJSON_TYPES:
+            return list(iter_ndjson(limited_lines(stream, max_bytes)))
+        text = stream.read(max_bytes + 1)
+        if len(text) > max_bytes:
+            raise BodyTooLarge(max_bytes)
+        return json.loads(text)
+    except (OSError, EOFError) as e:
+        raise ValueError(f"could not decompress request body: {e}")
+
+
+def read_clinical_body(data, mimetype, content_encoding=None, openapi_url=None, max_bytes=None):
+    """
+    Returns a ClinicalDonor object from a JSON body or from an NDJSON body with one donor per line.
+    """
+    body = read_body(data, mimetype, content_encoding, max_bytes)
+    if mimetype in NDJSON_TYPES:
+        body = {"openapi_url": openapi_url or DEFAULT_OPENAPI_URL, "donors": body}
+    errors = [error.message for error in jsonschema.Draft202012Validator(get_request_schema("ClinicalDonor")).iter_errors(body)]
+    if len(errors) > 0:
+        raise ValueError("; ".join(errors))
+    return body
+
+
+def read_genomic_body(data, mimetype, content_encoding=None, max_bytes=None):
+    """
+    Returns a list of GenomicSamples from a JSON array or from an NDJSON body with one sample per line.
+    """
+    body = read_body(data, mimetype, content_encoding, max_bytes)
+    if not isinstance(body, list):
+        raise ValueError("request body must be a list of GenomicSamples")
+    # ndjson bodies are not validated by connexion, so check each sample here
+    validator = jsonschema.Draft202012Validator(get_request_schema("GenomicSample"))
+    errors = []
+    for i, sample in enumerate(body):
+        for error in validator.iter_errors(sample):
+            if len(error.path) > 0:
+                errors.append(f"sample {i}: {' > '.join(map(str, error.path))}: {error.message}")
+            else:
+                errors.append(f"sample {i}: {error.message}")
+    if len(errors) > 0:
+        raise ValueError("; ".join(errors))
+    return body
@@ -7,13 +7,24 @@ import urllib.parse
 
 import auth
 from ingest_result import *
-from katsu_ingest import prep_check_clinical_data
+from katsu_ingest import prep_check_clinical_data, plan_ingest, recent_throughput, existing_record_ids
 from htsget_ingest import check_genomic_data
 from opa_ingest import remove_user_from_dataset, add_user_to_dataset
+from sharding import spool_program
+from batching import is_spooled
+from timing import timed
+from ingest_body import read_clinical_body, read_genomic_body, BodyTooLarge, INGEST_MAX_BODY_BYTES
+import upload_sessions
+import profiling
+from scheduler import write_job_meta, read_job_meta, remove_job_meta, job_meta, meta_path
+from admission import check_admission
+import job_control
 import config
 import tempfile
+import time
 import uuid
 import json
+import shutil
 
 
 app = Flask(__name__)
@@ -175,42 +186,151 @@ def remove_user_from_role(role_type, email):
 ####
 
 def add_genomic_linkages():
-    dataset = connexion.request.json
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    # refuse before reading the body if the queue is already full
+    rejection = check_admission(user=auth.get_user_name(token))
+    if rejection is not None:
+        return rejection
+    if request.content_length is not None and request.content_length > INGEST_MAX_BODY_BYTES:
+        return {"error": str(BodyTooLarge(INGEST_MAX_BODY_BYTES))}, 413
+    parse_start = time.monotonic()
+    try:
+        dataset = read_genomic_body(request.get_data(), request.mimetype, request.headers.get("Content-Encoding"))
+    except BodyTooLarge as e:
+        return {"error": str(e)}, 413
+    except ValueError as e:
+        return {"error": f"invalid request body: {e}"}, 400
+    request_timings = {"parse": round(time.monotonic() - parse_start, 4)}
     do_not_index = bool(connexion.request.args.get("do_not_index", False))
     headers = get_headers()
+    return queue_genomic_data(dataset, token, do_not_index, request_timings)
+
+
+def add_clinical_donors():
     token = request.headers['Authorization'].split("Bearer ")[1]
-    response, status_code = check_genomic_data(dataset, token)
+    dry_run = connexion.request.args.get("dry_run", "false").lower() == "true"
+    # refuse before reading the body if the queue is already full
+    if not dry_run:
+        rejection = check_admission(user=auth.get_user_name(token))
+        if rejection is not None:
+            return rejection
+    if request.content_length is not None and request.content_length > INGEST_MAX_BODY_BYTES:
+        return {"error": str(BodyTooLarge(INGEST_MAX_BODY_BYTES))}, 413
+    parse_start = time.monotonic()
+    try:
+        dataset = read_clinical_body(request.get_data(), request.mimetype, request.headers.get("Content-Encoding"),
+                                     connexion.request.args.get("openapi_url"))
+    except BodyTooLarge as e:
+        return {"error": str(e)}, 413
+    except ValueError as e:
+        return {"error": f"invalid request body: {e}"}, 400
+    request_timings = {"parse": round(time.monotonic() - parse_start, 4)}
+    batch_size = int(connexion.request.args.get("batch_size", 1000))
+    adaptive_batching = connexion.request.args.get("adaptive_batching", "false").lower() == "true"
+    isolate_errors = connexion.request.args.get("isolate_errors", "false").lower() == "true"
+    delta = connexion.request.args.get("delta", "false").lower() == "true"
+    headers = get_headers()
+    if dry_run:
+        return plan_clinical_data(dataset, token, batch_size, adaptive_batching)
+    return queue_clinical_data(dataset, token, batch_size, adaptive_batching, isolate_errors, delta, request_timings)
+
+
+def queue_genomic_data(dataset, token, do_not_index=False, request_timings=None):
+    timings = {}
+    response, status_code = check_genomic_data(dataset, token, timings)
     if status_code == 200:
-        ingest_uuid = add_to_queue({"htsget": response, "do_not_index": do_not_index})
+        for program_id in timings:
+            timings[program_id].update(request_timings or {})
+        ingest_json = {"htsget": response, "do_not_index": do_not_index, "timings": timings,
+                       "submitter": auth.get_user_name(token)}
+        rejection = check_admission(job_meta(ingest_json)["records"], ingest_json["submitter"])
+        if rejection is not None:
+            return rejection
+        ingest_uuid = add_to_queue(ingest_json)
         response = {"queue_id": ingest_uuid}
     check_default_site_admin(response)
     return response, status_code
 
 
-def add_clinical_donors():
-    dataset = connexion.request.json
-    batch_size = int(connexion.request.args.get("batch_size", 1000))
-    headers = get_headers()
-    token = request.headers['Authorization'].split("Bearer ")[1]
-    response, status_code = prep_check_clinical_data(dataset, token, batch_size)
+def queue_clinical_data(dataset, token, batch_size=1000, adaptive_batching=False, isolate_errors=False, delta=False,
+                        request_timings=None):
+    timings = {}
+    response, status_code = prep_check_clinical_data(dataset, token, batch_size, timings)
     if status_code == 200:
-        ingest_uuid = add_to_queue({"katsu": response})
+        for program_id in timings:
+            timings[program_id].update(request_timings or {})
+        ingest_json = {"katsu": response, "batch_size": batch_size, "adaptive_batching": adaptive_batching,
+                       "isolate_errors": isolate_errors, "delta": delta, "timings": timings,
+                       "submitter": auth.get_user_name(token)}
+        rejection = check_admission(job_meta(ingest_json)["records"], ingest_json["submitter"])
+        if rejection is not None:
+            return rejection
+        ingest_uuid = add_to_queue(ingest_json)
         response = {"queue_id": ingest_uuid}
     check_default_site_admin(response)
     return response, status_code
 
 
-def add_to_queue(ingest_json):
-    queue_id = str(uuid.uuid1())
-    with tempfile.NamedTemporaryFile(delete_on_close=False, mode="w") as f:
-        json.dump(ingest_json, f, indent=4)
-        os.rename(f.name, os.path.join(config.DAEMON_PATH, "to_ingest", queue_id))
+def plan_clinical_data(dataset, token, batch_size=1000, adaptive_batching=False):
+    """
+    Validate and flatten the donors as an ingest would, but report what would be sent to katsu
+    instead of queueing it.
+    """
+    response, status_code = prep_check_clinical_data(dataset, token, batch_size)
+    if status_code == 200:
+        throughput = recent_throughput(os.path.join(config.DAEMON_PATH, "results"))
+        programs = {}
+        for program_id, program in response.items():
+            existing = existing_record_ids(program_id, program["schemas"].keys(), token)
+            programs[program_id] = plan_ingest(program["schemas"], batch_size, adaptive_batching, throughput, existing)
+        response = {"dry_run": True, "programs": programs}
+    check_default_site_admin(response)
+    return response, status_code
+
+
+def add_to_queue(ingest_json, queue_id=None):
+    queue_id = queue_id or str(uuid.uuid1())
+    ingest_json["queued_at"] = time.time()
+    if profiling.request_profiled():
+        # profile the job as well as the request that queued it
+        ingest_json["profile"] = True
+    try:
+        if "katsu" in ingest_json:
+            spool_schemas(ingest_json["katsu"], queue_id, ingest_json.get("timings"))
+        # the daemon's scheduler reads this instead of the whole job
+        write_job_meta(queue_id, ingest_json)
+        with tempfile.NamedTemporaryFile(delete_on_close=False, mode="w") as f:
+            json.dump(ingest_json, f)
+            os.rename(f.name, os.path.join(config.DAEMON_PATH, "to_ingest", queue_id))
+    except Exception:
+        # the job never made it into the queue, so nothing else will clean up after it
+        remove_job_meta(queue_id)
+        shutil.rmtree(os.path.join(config.DAEMON_PATH, "spool", queue_id), ignore_errors=True)
+        raise
     results_path = os.path.join(config.DAEMON_PATH, "results", queue_id)
     with open(results_path, "w") as f:
         json.dump({"status": "still in queue"}, f)
     return queue_id
 
 
+def spool_schemas(programs, queue_id, timings=None):
+    """
+    Replace each program's flattened records with references to NDJSON spool files under
+    DAEMON_PATH/spool/queue_id, which the daemon streams straight into katsu request bodies.
+    Programs with many donors are split into shards (see sharding.spool_program). Programs that have
+    already been spooled are left as they are.
+    """
+    for program_id in programs:
+        if any(is_spooled(records) for records in programs[program_id]["schemas"].values()):
+            continue
+        program_dir = os.path.join(config.DAEMON_PATH, "spool", queue_id, urllib.parse.quote_plus(program_id))
+        os.makedirs(program_dir, exist_ok=True)
+        with timed(timings.setdefault(program_id, {}) if timings is not None else None, "spool"):
+            shards = spool_program(programs[program_id]["schemas"], program_dir)
+        if shards is not None:
+            programs[program_id]["shards"] = shards
+
+
 @app.route('/status/<path:queue_id>')
 def get_ingest_status(queue_id):
     try:
@@ -223,6 +343,151 @@ def get_ingest_status(queue_id):
         return {"error": f"no such queue_id {queue_id}"}, 404
 
 
+def job_owner_or_admin(file_path, token):
+    try:
+        meta = read_job_meta(file_path)
+    except (OSError, ValueError):
+        meta = {}
+    return auth.is_site_admin(token) or (meta.get("submitter") is not None and meta["submitter"] == auth.get_user_name(token))
+
+
+def change_ingest(queue_id, action):
+    """
+    Cancel, pause or resume a queued, running or paused ingest. Running jobs stop between batches,
+    so a cancel or pause is accepted (202) and the status shows when it has happened.
+    """
+    if "/" in queue_id or queue_id in ["", ".", ".."]:
+        return {"error": f"no such queue_id {queue_id}"}, 404
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    queued_path = os.path.join(config.DAEMON_PATH, "to_ingest", queue_id)
+    paused_path = job_control.paused_path(queue_id)
+    # in distributed mode, jobs leave to_ingest for the shared task queue but keep their metadata
+    if not any(os.path.exists(path) for path in [queued_path, paused_path, meta_path(queue_id)]):
+        if os.path.exists(os.path.join(config.DAEMON_PATH, "results", queue_id)):
+            return {"error": f"ingest {queue_id} has already finished"}, 409
+        return {"error": f"no such queue_id {queue_id}"}, 404
+    if not job_owner_or_admin(queued_path if os.path.exists(queued_path) else paused_path, token):
+        return {"error": "only the submitter or a site admin can change this ingest"}, 403
+
+    if action == "resume":
+        job_control.clear_action(queue_id)
+        if os.path.exists(paused_path):
+            # the daemon picks the job up again when it reappears in the queue
+            os.rename(paused_path, queued_path)
+        return {"queue_id": queue_id, "status": "resumed"}, 200
+    if action == job_control.PAUSE and (os.path.exists(paused_path) or job_control.requested_action(queue_id) == job_control.PAUSE):
+        return {"error": f"ingest {queue_id} is already paused"}, 409
+    job_control.request_action(queue_id, action)
+    if os.path.exists(paused_path):
+        # a paused job is cancelled by the daemon as soon as it is back in the queue
+        os.rename(paused_path, queued_path)
+    return {"queue_id": queue_id, "status": "cancelling" if action == job_control.CANCEL else "pausing"}, 202
+
+
+@app.route('/status/<path:queue_id>')
+def cancel_ingest(queue_id):
+    return change_ingest(queue_id, job_control.CANCEL)
+
+
+@app.route('/status/<path:queue_id>/pause')
+def pause_ingest(queue_id):
+    return change_ingest(queue_id, job_control.PAUSE)
+
+
+@app.route('/status/<path:queue_id>/resume')
+def resume_ingest(queue_id):
+    return change_ingest(queue_id, "resume")
+
+
+####
+# Chunked uploads
+####
+
+def start_upload():
+    upload = connexion.request.json
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    return upload_sessions.start_session(upload, auth.get_user_name(token))
+
+
+def get_upload(upload_id):
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    return upload_sessions.get_session(upload_id, auth.get_user_name(token))
+
+
+def upload_part(upload_id, part_number):
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    if request.content_length is not None and request.content_length > upload_sessions.UPLOAD_MAX_PART_BYTES:
+        return {"error": f"part is larger than the maximum of {upload_sessions.UPLOAD_MAX_PART_BYTES} bytes"}, 413
+    return upload_sessions.add_part(upload_id, part_number, request.get_data(), auth.get_user_name(token))
+
+
+def commit_upload(upload_id):
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    user = auth.get_user_name(token)
+    session, status_code = upload_sessions.read_session(upload_id, user)
+    if status_code != 200:
+        return session, status_code
+    rejection = check_admission(user=user)
+    if rejection is not None:
+        return rejection
+    programs = upload_sessions.split_by_program(upload_id)
+    if len(programs) == 0:
+        return {"error": f"no parts have been uploaded to {upload_id}"}, 400
+    response, status_code = queue_upload(session, programs, token)
+    if status_code == 200:
+        upload_sessions.remove_session(upload_id, user)
+    return response, status_code
+
+
+def queue_upload(session, programs, token):
+    """
+    Check and queue a committed upload one program at a time, so that only one program's records are
+    in memory at once. Each program's records are read from the file written by
+    upload_sessions.split_by_program and checked as /clinical or /genomic would check them; flattened
+    clinical records are spooled before the next program is read.
+    """
+    queue_id = str(uuid.uuid1())
+    timings = {}
+    checked = {}
+    errors = {}
+    try:
+        for program_id, (path, count) in programs.items():
+            records = upload_sessions.read_program(path)
+            if session["type"] == "clinical":
+                response, status_code = prep_check_clinical_data({"openapi_url": session["openapi_url"], "donors": records},
+                                                                 token, session["options"]["batch_size"], timings)
+                if status_code == 200:
+                    spool_schemas(response, queue_id, timings)
+            else:
+                response, status_code = check_genomic_data(records, token, timings)
+            if status_code != 200:
+                errors.update(response["errors"])
+                continue
+            checked.update(response)
+        if len(errors) > 0:
+            response = {"errors": errors}
+            check_default_site_admin(response)
+            shutil.rmtree(os.path.join(config.DAEMON_PATH, "spool", queue_id), ignore_errors=True)
+            return response, 400
+        ingest_json = {"katsu" if session["type"] == "clinical" else "htsget": checked, **session["options"],
+                       "timings": timings, "submitter": auth.get_user_name(token)}
+        rejection = check_admission(job_meta(ingest_json)["records"], ingest_json["submitter"])
+        if rejection is not None:
+            shutil.rmtree(os.path.join(config.DAEMON_PATH, "spool", queue_id), ignore_errors=True)
+            return rejection
+    except Exception:
+        shutil.rmtree(os.path.join(config.DAEMON_PATH, "spool", queue_id), ignore_errors=True)
+        raise
+    response = {"queue_id": add_to_queue(ingest_json, queue_id)}
+    check_default_site_admin(response)
+    return response, 200
+
+
+def abort_upload(upload_id):
+    token = request.headers['Authorization'].split("Bearer ")[1]
+    return upload_sessions.remove_session(upload_id, auth.get_user_name(token))
+
+
 ####
 # Program authorizations
 ####
@@ -0,0 +1,82 @@
+from katsu_ingest import count_summary
+
+
+def add_counts(counts, more):
+    for type, type_counts in more.items():
+        totals = counts.setdefault(type, {})
+        for key, value in type_counts.items():
+            totals[key] = totals.get(key, 0) + value
+
+
+def merge_batch_sizes(batch_sizes, more):
+    for type, summary in more.items():
+        if summary.get("batches", 0) == 0:
+            continue
+        if batch_sizes.get(type, {}).get("batches", 0) == 0:
+            batch_sizes[type] = dict(summary)
+            continue
+        total = batch_sizes[type]
+        batches = total["batches"] + summary["batches"]
+        total["mean"] = round((total["mean"] * total["batches"] + summary["mean"] * summary["batches"]) / batches, 1)
+        total["min"] = min(total["min"], summary["min"])
+        total["max"] = max(total["max"], summary["max"])
+        total["batches"] = batches
+
+
+def merge_into(merged, result):
+    """
+    Add the result of part of a program's ingest to merged: lists are concatenated, numbers (counts
+    and timings) are added up and batch size summaries are combined.
+    """
+    for key, value in result.items():
+        if key == "counts":
+            add_counts(merged.setdefault(key, {}), value)
+        elif key == "batch_sizes":
+            merge_batch_sizes(merged.setdefault(key, {}), value)
+        elif isinstance(value, list):
+            merged[key] = merged.get(key, []) + value
+        elif isinstance(value, dict):
+            merge_into(merged.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(merged.get(key), (int, float)):
+            merged[key] = round(merged[key] + value, 4)
+        else:
+            merged[key] = value
+
+
+def merge_partial_results(ingest_results, previous):
+    """
+    Combine the results of the part of a program that was ingested before its job was paused with
+    the results of the rest of it.
+    """
+    merged = {}
+    merge_into(merged, {key: value for key, value in previous.items() if key != "status"})
+    merge_into(merged, ingest_results)
+    ingest_results.update(summarize(merged))
+
+
+def summarize(program_results, slowest=3):
+    """
+    Rewrite the results of a program that was ingested in parts as if it had been ingested at once.
+    """
+    if "counts" in program_results:
+        program_results["results"] = [count_summary(type, counts) for type, counts in program_results["counts"].items()]
+    for type_timings in program_results.get("timings", {}).get("katsu", {}).values():
+        if "slowest_batches" in type_timings:
+            type_timings["slowest_batches"] = sorted(type_timings["slowest_batches"], key=lambda batch: batch["seconds"],
+                                                     reverse=True)[:slowest]
+    return program_results
+
+
+def merge_task_results(task_results):
+    """
+    Combine the results of the tasks that a job was split into, given as a list of (program_id,
+    result) in task order, into one result per program.
+    """
+    merged = {}
+    for program_id, result in task_results:
+        merge_into(merged.setdefault(program_id, {}), result or {})
+    for program_results in merged.values():
+        program_results.setdefault("errors", [])
+        program_results.setdefault("results", [])
+        summarize(program_results)
+    return merged
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import config
+
+
+# actions that can be requested for a queued or running job
+CANCEL = "cancel"
+PAUSE = "pause"
+
+
+def control_path(queue_id):
+    return os.path.join(config.DAEMON_PATH, "control", queue_id)
+
+
+def paused_path(queue_id):
+    return os.path.join(config.DAEMON_PATH, "paused", queue_id)
+
+
+def request_action(queue_id, action):
+    os.makedirs(os.path.dirname(control_path(queue_id)), exist_ok=True)
+    with tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(control_path(queue_id)), delete=False) as f:
+        f.write(action)
+    os.replace(f.name, control_path(queue_id))
+
+
+def requested_action(queue_id):
+    try:
+        with open(control_path(queue_id)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def clear_action(queue_id):
+    try:
+        os.remove(control_path(queue_id))
+    except FileNotFoundError:
+        pass
+
+
+class JobControl():
+    """
+    Called by the ingest loops between batches: returns CANCEL or PAUSE if that has been requested
+    for the job, and None if the job should carry on.
+    """
+    def __init__(self, queue_id):
+        self.queue_id = queue_id
+
+    def __call__(self):
+        action = requested_action(self.queue_id)
+        if action in (CANCEL, PAUSE):
+            return action
+        return None
@@ -1,11 +1,19 @@
 import argparse
+import itertools
 import json
 import os
-import traceback
+import time
 from http import HTTPStatus
 import requests
 import auth
-from authx.auth import get_site_admin_token, create_service_token, is_action_allowed_for_program
+import config
+import metrics
+from batching import BatchSizer, iter_batches, batch_body, read_records, record_count, is_spooled
+from timing import timed, add_time
+from record_hashes import RecordHashStore, record_hash
+from clinical_flatten import ID_NAMES, traverse_clinical_field, validate_program
+from authx.auth import get_site_admin_token
+from auth import is_action_allowed_for_program
 from clinical_etl.mohschemav3 import MoHSchemaV3
 from candigv2_logging.logging import initialize, CanDIGLogger
 
@@ -53,143 +61,422 @@ def read_json(file_path):
             return None
 
 
+KATSU_TIMEOUT = float(os.getenv("KATSU_TIMEOUT", 300))
+# number of recent jobs whose throughput is used to estimate ingest times for dry runs
+INGEST_ESTIMATE_JOBS = int(os.getenv("INGEST_ESTIMATE_JOBS", 20))
+# number of records to request per page when listing records that are already in katsu
+KATSU_PAGE_SIZE = int(os.getenv("KATSU_PAGE_SIZE", 1000))
+
+
+def post_batch(ingest_url, headers, batch, sizer, split=False, adjust=True):
+    """
+    POST a batch of serialized records to katsu. If split is set, a batch that katsu rejects because
+    of its records (a 400 or 422) is split in half and each half is retried, until the failing
+    records are isolated. A batch that times out or gets a server error is not split or sent again:
+    katsu may have committed it, and a struggling katsu would only get more requests.
+    Returns the number of records created and a list of (response, batch) failures; response is None
+    if the request timed out.
+    """
+    start = time.monotonic()
+    try:
+        response = auth.service_request("katsu", "ingest", "POST", ingest_url, headers=headers, data=batch_body(batch),
+                                        timeout=KATSU_TIMEOUT)
+    except requests.exceptions.Timeout:
+        response = None
+    success = response is not None and response.status_code == HTTPStatus.CREATED
+    overloaded = response is None or response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR
+    sizer.record(len(batch), time.monotonic() - start, overloaded, adjust)
+    if success:
+        return len(batch), []
+    rejected = response is not None and response.status_code in (HTTPStatus.BAD_REQUEST, HTTPStatus.UNPROCESSABLE_ENTITY)
+    if not split or not rejected or len(batch) == 1:
+        return 0, [(response, batch)]
+
+    created_count = 0
+    failures = []
+    middle = len(batch) // 2
+    for half in (batch[:middle], batch[middle:]):
+        half_created, half_failures = post_batch(ingest_url, headers, half, sizer, split, adjust=False)
+        created_count += half_created
+        failures.extend(half_failures)
+    return created_count, failures
+
+
+def batch_error(type, response, batch):
+    if response is None:
+        return f"{type}: timed out after {KATSU_TIMEOUT} seconds posting {len(batch)} {type}"
+    try:
+        if "error" in response.json():
+            return f"{type}: {response.status_code} {response.json()['error']}"
+    except:
+        message = f"\nREQUEST STATUS CODE: {response.status_code} \nRETURN MESSAGE: {response.text}\n"
+        return f"{type}: {message}"
+    return None
+
+
+def record_key(type, record):
+    """
+    The submitter ID that identifies a flattened record. Types without their own ID (e.g. radiations)
+    are identified by the closest parent ID that they carry.
+    """
+    if type in ID_NAMES and ID_NAMES[type] in record:
+        return record[ID_NAMES[type]]
+    for parent_type in ["followups", "treatments", "specimens", "primary_diagnoses", "donors"]:
+        if ID_NAMES[parent_type] in record:
+            return f"{ID_NAMES[parent_type]}:{record[ID_NAMES[parent_type]]}"
+    return None
+
+
+def error_key(type, record, position):
+    """
+    How a rejected record is identified in result["record_errors"]: by its submitter ID or, for types
+    without an ID of their own (e.g. radiations), whose siblings share their parents' IDs, by its
+    position among the records of its type that were sent.
+    """
+    if type in ID_NAMES and ID_NAMES[type] in record:
+        return record[ID_NAMES[type]]
+    return f"record {position}"
+
+
+def record_error(response):
+    if response is None:
+        return f"timed out after {KATSU_TIMEOUT} seconds"
+    try:
+        return f"{response.status_code} {response.json()['error']}"
+    except:
+        return f"{response.status_code} {response.text}"
+
+
+def delta_changes(type, records, store, existing_ids=None):
+    """
+    Compare serialized records with the hashes in store (a record_hashes.RecordHashStore) and drop the
+    records that have not changed since they were last ingested. Returns the new records, the
+    conflicting records and the number of unchanged records; each new or conflicting record is a tuple
+    of (record, program_id, key, hash).
+    Katsu can't update records, so a record that has changed since it was ingested is a conflict, and
+    is not sent. Records of types without their own ID are keyed by their parent's ID and their
+    content: a record whose content is new under a parent whose records of this type were already
+    ingested may be a changed one, so it is a conflict too. A program that was already ingested is
+    unchanged, since its metadata holds statistics that change with every submission.
+    If store has no hashes for a program and type, existing_ids(program_id) is called for the IDs
+    already in katsu, which are stored with an empty hash: records with those IDs are conflicts,
+    without being sent to katsu first.
+    """
+    new = []
+    conflicts = []
+    unchanged_count = 0
+    parents = {}
+    seeded = set()
+    for record in records:
+        data = json.loads(record)
+        digest = record_hash(data)
+        program_id = data.get("program_id")
+        hashes = store.hashes(program_id, type)
+        if len(hashes) == 0 and existing_ids is not None and program_id not in seeded:
+            seeded.add(program_id)
+            ids = existing_ids(program_id)
+            if ids:
+                store.update(program_id, type, {record_id: "" for record_id in ids})
+        record_id = data.get(ID_NAMES[type]) if type in ID_NAMES else None
+        if record_id is not None:
+            key = record_id
+            conflict = key in hashes
+        else:
+            parent = record_key(type, data)
+            key = f"{parent}#{digest}"
+            if program_id not in parents:
+                parents[program_id] = {known_key.rsplit("#", 1)[0] for known_key in hashes if "#" in known_key}
+            conflict = parent in parents[program_id]
+        if hashes.get(key) == digest or (type == "programs" and key in hashes):
+            unchanged_count += 1
+        elif conflict:
+            conflicts.append((record, program_id, key, digest))
+        else:
+            new.append((record, program_id, key, digest))
+    return new, conflicts, unchanged_count
+
+
+def store_hashes(store, type, entries):
+    by_program = {}
+    for record, program_id, key, digest in entries:
+        by_program.setdefault(program_id, {})[key] = digest
+    for program_id, hashes in by_program.items():
+        store.update(program_id, type, hashes)
+
+
+def conflict_key(key):
+    # records without an ID of their own are reported by their parent's ID
+    return key.rsplit("#", 1)[0]
+
+
+def add_record_error(result, type, key, error):
+    if type not in result["record_errors"]:
+        result["record_errors"][type] = {}
+    if key not in result["record_errors"][type]:
+        result["record_errors"][type][key] = []
+    result["record_errors"][type][key].append(error)
+
+
+def count_summary(type, counts):
+    if "conflicts" in counts:
+        return (f"Of {counts['records']} {type}, {counts['created']} were created, {counts['unchanged']} were unchanged "
+                f"and {counts['conflicts']} conflicted with records already in katsu")
+    return f"Of {counts['records']} {type}, {counts['created']} were created"
+
+
 ## This will be called by the daemon
-def ingest_schemas(fields, batch_size=1000):
-    result = {"errors": [], "results": []}
+def ingest_schemas(fields, batch_size=1000, adaptive=False, isolate_errors=False, delta=False, control=None,
+                   checkpoint=None):
+    """
+    Post flattened clinical schemas to katsu, type by type. With adaptive set, batches are sized by
+    serialized bytes and katsu's latency (see batching.BatchSizer) and failing batches are split to
+    isolate the bad records; the effective batch sizes are reported in result["batch_sizes"].
+    With isolate_errors set, failing batches are bisected down to the offending records, everything
+    else is ingested, and the errors for each offending record are reported in result["record_errors"],
+    keyed by type and submitter ID (or position, for types without IDs of their own).
+    With delta set, only records that are new since the last ingest (according to the hashes in
+    record_hashes.RecordHashStore) are sent. Records that have changed since they were ingested, and
+    new records that are already in katsu, can't be updated: they are listed in result["conflicts"],
+    keyed by type (see delta_changes).
+    Each type's records are either a list of records or a reference to a spool file written by
+    batching.write_spool.
+    If control is set (see job_control.JobControl), it is called before each batch; if it returns an
+    action, the ingest stops and the action is reported in result["stopped"]. The number of records
+    of each type sent so far is kept in the checkpoint dict, and an ingest given the same checkpoint
+    carries on from there. Delta ingests don't need the checkpoint, since they skip records that
+    were already sent.
+    The number of records of each type that were sent and created are reported in result["counts"].
+    The wall time for each type, the time spent waiting on katsu and the slowest batches are reported
+    in result["timings"]["katsu"].
+    """
+    result = {"errors": [], "results": [], "counts": {}, "batch_sizes": {}, "timings": {"katsu": {}}}
+    if isolate_errors:
+        result["record_errors"] = {}
+    if delta:
+        result["conflicts"] = {}
+    status_code = HTTPStatus.OK
+    store = RecordHashStore() if delta else None
+    if checkpoint is None:
+        checkpoint = {}
+    stopped = None
 
     # Use service token to authenticate this with katsu
     headers = {
-        "X-Service-Token": create_service_token(),
+        "X-Service-Token": auth.get_service_token(),
         "Content-Type": "application/json"
     }
 
     for type in fields:
-        if len(fields[type]) > 0:
+        skip = 0 if delta else checkpoint.get(type, 0)
+        if record_count(fields[type]) > skip:
             ingest_url = f"{KATSU_URL}/v3/ingest/{type}/"
 
             created_count = 0
-            total_count = len(fields[type])
-
-            data = fields[type]
-            for i in range(0, len(data), batch_size):
-                batch = data[i : i + batch_size]
-                response = requests.post(
-                    ingest_url, headers=headers, data=json.dumps(batch)
-                )
-                if response.status_code == HTTPStatus.CREATED:
-                    created_count += len(batch)
-                elif response.status_code == HTTPStatus.NOT_FOUND:
+            total_count = record_count(fields[type]) - skip
+            type_start = time.monotonic()
+            fatal = False
+            sent_count = skip
+
+            records = itertools.islice(read_records(fields[type]), skip, None)
+            if delta:
+                existing_ids = None
+                if type in ID_NAMES:
+                    existing_ids = lambda program_id: authorized_ids(type, program_id, headers)
+                new, conflicts, unchanged_count = delta_changes(type, records, store, existing_ids)
+                entries = {entry[0]: entry for entry in new}
+                records = (entry[0] for entry in new)
+
+            sizer = BatchSizer(batch_size, adaptive=adaptive)
+            for batch in iter_batches(records, sizer):
+                stopped = control() if control is not None else None
+                if stopped is not None:
+                    break
+                metrics.BATCH_SIZE.labels(type).observe(len(batch))
+                batch_created, failures = post_batch(ingest_url, headers, batch, sizer,
+                                                     split=adaptive or isolate_errors or delta)
+                batch_start = sent_count
+                created_count += batch_created
+                sent_count += len(batch)
+                checkpoint[type] = sent_count
+                if delta:
+                    # records that already exist in katsu are conflicts, except for programs
+                    exists = [failed_batch[0] for response, failed_batch in failures if len(failed_batch) == 1
+                              and response is not None and "unique" in response.text and type in ID_NAMES]
+                    if type == "programs":
+                        unchanged_count += len(exists)
+                    else:
+                        conflicts.extend(entries[record] for record in exists)
+                    failures = [(response, failed_batch) for response, failed_batch in failures
+                                if len(failed_batch) > 1 or failed_batch[0] not in exists]
+                    failed = {record for response, failed_batch in failures for record in failed_batch}
+                    store_hashes(store, type, [entries[record] for record in batch
+                                               if record not in failed and record not in exists])
+                if len(failures) == 0:
+                    status_code = HTTPStatus.CREATED
+                    continue
+                response, failed_batch = failures[0]
+                status_code = HTTPStatus.GATEWAY_TIMEOUT if response is None else response.status_code
+                if status_code == HTTPStatus.NOT_FOUND:
                     message = (
                         f"ERROR 404: {ingest_url} was not found! Please check the URL."
                     )
                     result["errors"].append(f"{type}: {message}")
+                    fatal = True
                     break
-                elif response.status_code == HTTPStatus.UNAUTHORIZED:
+                elif status_code == HTTPStatus.UNAUTHORIZED:
                     message = f"ERROR 401: You do not have permission to ingest {type}"
                     result["errors"].append(f"{type}: {message}")
+                    fatal = True
                     break
-                else:
-                    try:
-                        if "error" in response.json():
-                            result["errors"].append(
-                                f"{type}: {response.status_code} {response.json()['error']}"
-                            )
-                    except:
-                        message = f"\nREQUEST STATUS CODE: {response.status_code} \nRETURN MESSAGE: {response.text}\n"
-                        result["errors"].append(f"{type}: {message}")
-                    if type == "programs" and "unique" in response.text:
+                for response, failed_batch in failures:
+                    if isolate_errors and len(failed_batch) == 1:
+                        record = json.loads(failed_batch[0])
+                        position = batch_start + next(i for i, sent in enumerate(batch) if sent is failed_batch[0]) + 1
+                        add_record_error(result, type, error_key(type, record, position), record_error(response))
+                        if type == "programs" and response is not None and "unique" in response.text:
+                            return result, 200
+                        continue
+                    error = batch_error(type, response, failed_batch)
+                    if error is not None:
+                        result["errors"].append(error)
+                    if type == "programs" and response is not None and "unique" in response.text:
                         # this is still okay to return 200:
                         return result, 200
-            result["results"].append(
-                f"Of {total_count} {type}, {created_count} were created"
-            )
-    return result, response.status_code
+
+            if delta and len(conflicts) > 0:
+                result["conflicts"][type] = [conflict_key(entry[2]) for entry in conflicts]
+
+            if stopped is not None:
+                # only count the records that were sent, so that the counts of a resumed ingest add up
+                total_count = sent_count - skip
+            result["counts"][type] = {"records": total_count, "created": created_count}
+            if delta:
+                result["counts"][type].update({"unchanged": unchanged_count, "conflicts": len(conflicts)})
+            result["results"].append(count_summary(type, result["counts"][type]))
+            result["batch_sizes"][type] = sizer.summary()
+            wall_seconds = time.monotonic() - type_start
+            result["timings"]["katsu"][type] = {"wall_seconds": round(wall_seconds, 4), "records": created_count,
+                                                **sizer.timings()}
+            metrics.RECORDS_CREATED.labels(type).inc(created_count)
+            metrics.RECORDS_PER_SECOND.labels(type).observe(created_count / max(wall_seconds, 0.001))
+            if stopped is not None:
+                result["stopped"] = stopped
+                break
+    if store is not None:
+        store.close()
+    return result, status_code
+
+
+def recent_throughput(results_dir, jobs=INGEST_ESTIMATE_JOBS):
+    """
+    Records created per second for each type, from the katsu timings of the most recent jobs in
+    results_dir. The rate over all types is reported as "*".
+    """
+    totals = {}
+    try:
+        names = sorted(os.listdir(results_dir), key=lambda name: os.path.getmtime(os.path.join(results_dir, name)))
+    except FileNotFoundError:
+        names = []
+    for name in reversed(names[-jobs:]):
+        try:
+            with open(os.path.join(results_dir, name)) as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for program_result in results.values():
+            if not isinstance(program_result, dict):
+                continue
+            for type, type_timings in program_result.get("timings", {}).get("katsu", {}).items():
+                if type_timings.get("records", 0) > 0:
+                    for key in (type, "*"):
+                        records, seconds = totals.get(key, (0, 0))
+                        totals[key] = (records + type_timings["records"], seconds + type_timings["wall_seconds"])
+    return {type: records / seconds for type, (records, seconds) in totals.items() if seconds > 0}
+
+
+def list_authorized(type, program_id, headers):
+    """
+    All of the records of type that are in katsu for program_id, requested KATSU_PAGE_SIZE at a time.
+    Returns None if any page can't be read.
+    """
+    items = []
+    page = 1
+    while True:
+        response = metrics.request("katsu", "authorized", "GET", f"{KATSU_URL}/v3/authorized/{type}",
+                                   params={"program_id": program_id, "page": page, "page_size": KATSU_PAGE_SIZE}, headers=headers)
+        if response.status_code != 200:
+            return None
+        body = response.json()
+        page_items = body.get("items", [])
+        items.extend(page_items)
+        if len(page_items) < KATSU_PAGE_SIZE or len(items) >= body.get("count", float("inf")) or body.get("next", True) is None:
+            return items
+        page += 1
 
 
-def traverse_clinical_field(fields, field: dict, ctype, parents, types, ingested_ids):
+def authorized_ids(type, program_id, headers):
     """
-    Helper function for prep_check_clinical_data. Parses and ingests clinical fields from a DonorWithClinicalData
-    object.
-    Args:
-        field: The (sub)field of a DonorWithClinicalData object, potentially nested
-        ctype: The type of the field being ingested (e.g. "donors")
-        parents: A list of tuple mappings of the parents of this object, e.g.
-            [
-                ("donors", "DONOR_1"),
-                ("primary_diagnoses", "PRIMARY_DIAGNOSIS_1")
-            ]
-        types: A list of possible field types
-        id_names: A mapping of field names to what their ID key is (e.g. {"donors": "submitter_donor_id"})
-        ingested_ids: A list of IDs that have already been ingested (some fields in DonorWithClinical are duplicates)
+    The submitter IDs of the records of type that are in katsu for program_id, or None if they can't
+    be listed.
     """
+    try:
+        items = list_authorized(type, program_id, headers)
+    except requests.RequestException:
+        return None
+    if items is None:
+        return None
+    return {item[ID_NAMES[type]] for item in items if ID_NAMES[type] in item}
 
-    id_names = {
-        "programs": "program_id",
-        "donors": "submitter_donor_id",
-        "primary_diagnoses": "submitter_primary_diagnosis_id",
-        "sample_registrations": "submitter_sample_id",
-        "treatments": "submitter_treatment_id",
-        "specimens": "submitter_specimen_id",
-        "followups": "submitter_follow_up_id",
-    }
 
-    data = {}
-    if ctype in id_names:
-        id_key = id_names[ctype]
-    else:
-        id_key = None
-    if id_key:
-        try:
-            field_id = field.pop(id_key)
-        except KeyError:
-            raise ValueError(
-                f"Missing required foreign key: {id_key} for {ctype} under {parents[-1][1]}"
-            )
-        if id_key not in ingested_ids:
-            ingested_ids[id_key] = []
-        if field_id in ingested_ids[id_key]:
-            logger.info(f"Skipping {field_id} in {id_key} (Already ingested).")
-            return
-        data[id_key] = field_id
-        ingested_ids[id_key].append(field_id)
-
-    attributes = list(field.keys())
-    for attribute in attributes:
-        if attribute not in types:
-            data[attribute] = field.pop(attribute)
-
-    if (
-        len(parents) >= 2
-    ):  # Program & donor have been added (must be the first 2 fields)
-        foreign_keys = [parents[0], parents[1]]
-        if len(parents) > 2:
-            foreign_keys.append(parents[-1])
-    else:
-        foreign_keys = [parents[0]]  # Just program
-    for parent in foreign_keys:
-        parent_key = id_names[parent[0]]
-        data[parent_key] = parent[1]
-
-    fields[ctype].append(data)
-
-    if id_key:
-        parents.append((ctype, data[id_key]))
-    subfields = field.keys()
-    for subfield in subfields:
-        if type(field[subfield]) == list:
-            for elem in field[subfield]:
-                traverse_clinical_field(
-                    fields, elem, subfield, parents, types, ingested_ids
-                )
-        elif type(field[subfield]) == dict:
-            traverse_clinical_field(
-                fields, field[subfield], subfield, parents, types, ingested_ids
-            )
-    if id_key:
-        parents.pop(-1)
+def existing_record_ids(program_id, types, token):
+    """
+    The submitter IDs of each type that already exist in katsu for program_id.
+    """
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    existing = {}
+    for type in types:
+        if type not in ID_NAMES:
+            continue
+        ids = authorized_ids(type, program_id, headers)
+        if ids is not None:
+            existing[type] = ids
+    return existing
 
 
-def prepare_clinical_data_for_ingest(ingest_json):
+def plan_ingest(fields, batch_size=1000, adaptive=False, throughput=None, existing=None):
+    """
+    Work out what ingest_schemas would send to katsu without sending it: the number of records,
+    batches and payload bytes of each type, how many of the records already exist (given existing,
+    from existing_record_ids) and an estimate of the time the ingest will take, based on throughput
+    (from recent_throughput). With adaptive set, the number of batches is that of the initial batch
+    size.
+    """
+    throughput = throughput or {}
+    existing = existing or {}
+    plan = {"types": {}, "records": 0, "batches": 0, "bytes": 0, "estimated_seconds": 0}
+    for type in fields:
+        count = record_count(fields[type])
+        if count == 0:
+            continue
+        type_plan = {"records": count, "batches": 0, "bytes": 0}
+        for batch in iter_batches(read_records(fields[type]), BatchSizer(batch_size, adaptive=adaptive)):
+            type_plan["batches"] += 1
+            type_plan["bytes"] += sum(len(record) for record in batch) + len(batch) + 1
+        if type in existing and not is_spooled(fields[type]):
+            existing_ids = [record[ID_NAMES[type]] for record in fields[type] if record.get(ID_NAMES[type]) in existing[type]]
+            type_plan["existing"] = len(existing_ids)
+            type_plan["existing_ids"] = existing_ids
+        rate = throughput.get(type, throughput.get("*"))
+        type_plan["estimated_seconds"] = round(count / rate, 1) if rate else None
+        plan["types"][type] = type_plan
+        for key in ("records", "batches", "bytes"):
+            plan[key] += type_plan[key]
+        if plan["estimated_seconds"] is not None:
+            plan["estimated_seconds"] = None if rate is None else round(plan["estimated_seconds"] + type_plan["estimated_seconds"], 1)
+    return plan
+
+
+def prepare_clinical_data_for_ingest(ingest_json, timings=None):
     """A single file ingest which validates and loads an MOH donor_with_clinical_data object from JSON.
     JSON format:
     [
@@ -204,8 +491,12 @@ def prepare_clinical_data_for_ingest(ingest_json):
         ...
     ]
     (Fully outlined in MOH Schema)
+    If timings is a dict, the time spent loading the schema, validating and flattening is added to
+    timings[program_id].
     """
-    schema = MoHSchemaV3(ingest_json["openapi_url"])
+    request_timings = {}
+    with timed(request_timings, "schema_load"):
+        schema = MoHSchemaV3(ingest_json["openapi_url"])
 
     types = ["programs"]
     types.extend(schema.validation_schema.keys())
@@ -220,29 +511,15 @@ def prepare_clinical_data_for_ingest(ingest_json):
         by_program[donor["program_id"]]["donors"].append(donor)
 
     for program_id in by_program.keys():
-        errors = by_program[program_id]["errors"]
-        logger.info(f"Validating input for program {program_id}")
-        schema.validate_ingest_map(by_program[program_id])
-        if len(schema.validation_warnings) > 0:
-            logger.info("Validation returned warnings:")
-            logger.info("\n".join(schema.validation_warnings))
-        if len(schema.validation_errors) > 0:
-            errors.append([str(line) for line in schema.validation_errors])
+        program_timings = None
+        if timings is not None:
+            program_timings = timings.setdefault(program_id, {})
+            program_timings.update(request_timings)
+        fields, errors, warnings = validate_program(schema, types, program_id, by_program[program_id], program_timings)
+        by_program[program_id]["errors"].extend(errors)
+        if fields is None:
             continue
-        logger.info("Validation success.")
-
-        donors = by_program[program_id].pop("donors")
-        fields = {type: [] for type in types}
-        for donor in donors:
-            parents = [("programs", program_id)]
-            try:
-                ingested_ids = {}
-                traverse_clinical_field(
-                    fields, donor, "donors", parents, types, ingested_ids
-                )
-            except Exception as e:
-                logger.error(traceback.format_exc())
-                errors.append(str(e))
+        by_program[program_id].pop("donors")
         by_program[program_id]["schemas"] = fields
         by_program[program_id]["schemas"]["programs"] = [
             {"program_id": program_id, "metadata": schema.statistics.copy()}
@@ -250,14 +527,15 @@ def prepare_clinical_data_for_ingest(ingest_json):
     return by_program
 
 
-def prep_check_clinical_data(ingest_json, token, batch_size):
+def prep_check_clinical_data(ingest_json, token, batch_size, timings=None):
     # check to see if we're running in an environment with an active katsu:
     # if we can get a response for the katsu schema url, use that.
     result = {}
+    schema_check_start = time.monotonic()
 
     active_schema_url = f"{KATSU_URL}/static/schema.yml"
     try:
-        response = requests.get(active_schema_url)
+        response = metrics.request("katsu", "schema", "GET", active_schema_url)
         if response.status_code == 200:
             logger.info(f"Validating against active katsu schema at {active_schema_url}")
 
@@ -270,17 +548,24 @@ def prep_check_clinical_data(ingest_json, token, batch_size):
             ingest_json["openapi_url"] = active_schema_url
     except:
         pass
+    schema_check_seconds = time.monotonic() - schema_check_start
 
-    schemas_to_ingest = prepare_clinical_data_for_ingest(ingest_json)
+    schemas_to_ingest = prepare_clinical_data_for_ingest(ingest_json, timings)
     result["errors"] = {}
 
     for program_id in schemas_to_ingest.keys():
         result["errors"][program_id] = []
         program = schemas_to_ingest[program_id]
-        response, status_code = auth.get_program_in_opa(program_id, token)
+        program_timings = None
+        if timings is not None:
+            program_timings = timings.setdefault(program_id, {})
+            add_time(program_timings, schema_check_seconds, "schema_check")
+        with timed(program_timings, "auth"):
+            response, status_code = auth.get_program_in_opa(program_id, token)
+            allowed = is_action_allowed_for_program(token, method="POST", path="/v3/ingest/programs/", program=program_id)
         if status_code > 300:
             result["errors"][program_id].append({"not found": "No program authorization exists"})
-        if not is_action_allowed_for_program(token, method="POST", path="/v3/ingest/programs/", program=program_id):
+        if not allowed:
             result["errors"][program_id].append({"unauthorized": "user is not allowed to ingest to program"})
         if len(program["errors"]) > 0:
             result["errors"][program_id].extend(program["errors"])
@@ -311,6 +596,12 @@ def main():
     )
     parser.add_argument("--input", help="Path to the clinical json file to ingest.")
     parser.add_argument("--batch_size", help="How many items for batch ingest.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adapt batch sizes to payload size and katsu's response time, starting from batch_size.")
+    parser.add_argument("--isolate_errors", action="store_true",
+                        help="Bisect failing batches to find and report the records that katsu rejects.")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only send records that are new since they were last ingested; changed records are reported as conflicts.")
     args = parser.parse_args()
 
     data_location = args.input
@@ -327,9 +618,7 @@ def main():
 
     ingest_json = read_json(data_location)
     if "openapi_url" not in ingest_json:
-        ingest_json["openapi_url"] = (
-            "https://raw.githubusercontent.com/CanDIG/katsu/develop/chord_metadata_service/mohpackets/docs/schemas/schema.yml"
-        )
+        ingest_json["openapi_url"] = config.DEFAULT_OPENAPI_URL
 
     results = {}
     json_data, status_code = prep_check_clinical_data(ingest_json, token, batch_size)
@@ -337,7 +626,7 @@ def main():
     for program_id in schemas_to_ingest:
         program = json_data[program_id]
         schemas = program.pop("schemas")
-        ingest_results, status_code = ingest_schemas(schemas)
+        ingest_results, status_code = ingest_schemas(schemas, batch_size, args.adaptive, args.isolate_errors, args.delta)
         results[program_id] = ingest_results
 
     print(json.dumps(results, indent=2))
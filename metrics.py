@@ -0,0 +1,129 @@
+import functools
+import os
+import time
+import requests
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+import config
+
+
+# The gunicorn workers and the daemon are separate processes. When PROMETHEUS_MULTIPROC_DIR is set
+# (see run.sh), each process writes its metrics there and /metrics aggregates all of them.
+
+HTTP_REQUESTS = Counter("ingest_http_requests_total", "Requests to the ingest API",
+                        ["endpoint", "method", "status"])
+HTTP_REQUEST_DURATION = Histogram("ingest_http_request_duration_seconds", "Time taken to answer requests to the ingest API",
+                                  ["endpoint", "method"])
+SERVICE_REQUEST_DURATION = Histogram("ingest_service_request_duration_seconds",
+                                     "Time taken by calls to Katsu, htsget, OPA and Vault", ["service", "operation"])
+SERVICE_ERRORS = Counter("ingest_service_errors_total", "Failed calls to Katsu, htsget, OPA and Vault",
+                         ["service", "operation", "status"])
+JOBS = Counter("ingest_jobs_total", "Ingest jobs run by the daemon", ["type", "status"])
+JOB_DURATION = Histogram("ingest_job_duration_seconds", "Time taken by the daemon to run an ingest job", ["type"],
+                         buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, float("inf")))
+RECORDS_CREATED = Counter("ingest_records_created_total", "Records created in Katsu or htsget", ["type"])
+RECORDS_PER_SECOND = Histogram("ingest_records_per_second", "Ingest throughput of each type in each job", ["type"],
+                               buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, float("inf")))
+ADMISSION_REJECTIONS = Counter("ingest_admission_rejections_total", "Ingest requests refused because the queue or the submitter's quota is full",
+                               ["reason"])
+BATCH_SIZE = Histogram("ingest_batch_size_records", "Number of records in each batch posted to Katsu", ["type"],
+                       buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")))
+
+
+class QueueCollector():
+    """
+    Reports the ingest queue at scrape time, so that a stuck daemon shows up as a growing queue with an
+    ageing oldest job.
+    """
+    def collect(self):
+        ingest_path = os.path.join(config.DAEMON_PATH, "to_ingest")
+        depth = 0
+        oldest = 0
+        now = time.time()
+        try:
+            for queue_id in os.listdir(ingest_path):
+                try:
+                    oldest = max(oldest, now - os.path.getmtime(os.path.join(ingest_path, queue_id)))
+                    depth += 1
+                except FileNotFoundError:
+                    pass
+        except FileNotFoundError:
+            pass
+        queue_depth = GaugeMetricFamily("ingest_queue_depth", "Number of ingest jobs waiting in the queue")
+        queue_depth.add_metric([], depth)
+        yield queue_depth
+        queue_age = GaugeMetricFamily("ingest_queue_oldest_job_age_seconds", "Age of the oldest job in the queue")
+        queue_age.add_metric([], oldest)
+        yield queue_age
+
+
+queue_registry = CollectorRegistry()
+queue_registry.register(QueueCollector())
+
+
+def generate_metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR") is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(queue_registry)
+
+
+def metrics_response():
+    return generate_metrics(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
+def is_error(result):
+    if isinstance(result, requests.Response):
+        return result.status_code >= 400, result.status_code
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], int):
+        return result[1] >= 400, result[1]
+    return False, None
+
+
+def observe_call(service, operation=None):
+    """
+    Decorator that times calls to a function that talks to another service, and counts the calls
+    that raise or that return an error status code.
+    """
+    def decorator(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                SERVICE_ERRORS.labels(service, name, "exception").inc()
+                raise
+            finally:
+                SERVICE_REQUEST_DURATION.labels(service, name).observe(time.monotonic() - start)
+            failed, status_code = is_error(result)
+            if failed:
+                SERVICE_ERRORS.labels(service, name, str(status_code)).inc()
+            return result
+        return wrapper
+    return decorator
+
+
+def request(service, operation, method, url, **kwargs):
+    """
+    requests.request, timed and counted as a call to service.
+    """
+    return observe_call(service, operation)(requests.request)(method, url, **kwargs)
+
+
+class ServiceClient():
+    """
+    Wraps a client module for another service, such as authx.auth, so that each call made through it
+    is timed and counted as a call to service, named after the function called. Functions are looked
+    up on the module at call time.
+    """
+    def __init__(self, service, module):
+        self.service = service
+        self.module = module
+
+    def __getattr__(self, name):
+        return observe_call(self.service, name)(getattr(self.module, name))
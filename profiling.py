@@ -0,0 +1,203 @@
+import contextlib
+import cProfile
+import os
+import pstats
+import re
+import threading
+import time
+from flask import g, has_request_context, request
+from candigv2_logging.logging import CanDIGLogger
+import auth
+import config
+
+
+logger = CanDIGLogger(__file__)
+
+
+# profile every API request and daemon job; otherwise only requests from site admins that send the
+# X-Ingest-Profile header, and the jobs they queue, are profiled
+INGEST_PROFILE = os.getenv("INGEST_PROFILE", "false").lower() == "true"
+INGEST_PROFILE_MAX_BYTES = int(os.getenv("INGEST_PROFILE_MAX_BYTES", 100 * 1024 * 1024))
+INGEST_PROFILE_MAX_FILES = int(os.getenv("INGEST_PROFILE_MAX_FILES", 50))
+PROFILE_HEADER = "X-Ingest-Profile"
+
+# cProfile can only have one active profiler per process
+profiler_lock = threading.Lock()
+# the profile that the current thread's work belongs to, if any
+current = threading.local()
+
+
+def profile_dir():
+    return os.path.join(config.DAEMON_PATH, "profiles")
+
+
+def rotate_profiles():
+    """
+    Remove the oldest profiles until there are at most INGEST_PROFILE_MAX_FILES of them, taking up at
+    most INGEST_PROFILE_MAX_BYTES.
+    """
+    profiles = []
+    for name in os.listdir(profile_dir()):
+        try:
+            stat = os.stat(os.path.join(profile_dir(), name))
+            profiles.append((stat.st_mtime, stat.st_size, name))
+        except FileNotFoundError:
+            pass
+    profiles.sort()
+    total = sum(size for mtime, size, name in profiles)
+    while len(profiles) > 0 and (len(profiles) > INGEST_PROFILE_MAX_FILES or total > INGEST_PROFILE_MAX_BYTES):
+        mtime, size, name = profiles.pop(0)
+        try:
+            os.remove(os.path.join(profile_dir(), name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class Profile():
+    """
+    A cProfile run that is written to DAEMON_PATH/profiles when it stops. If another profile is
+    already running in this process, this one does nothing. Work done in other threads is included
+    if it is run through in_profile.
+    """
+    def __init__(self, name):
+        self.name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+        self.profiler = None
+        self.thread_profilers = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        if not profiler_lock.acquire(blocking=False):
+            logger.warning(f"Not profiling {self.name}: another profile is already running")
+            return self
+        self.profiler = cProfile.Profile()
+        try:
+            self.profiler.enable()
+        except ValueError:
+            logger.warning(f"Not profiling {self.name}: another profiling tool is active")
+            self.profiler = None
+            profiler_lock.release()
+            return self
+        current.profile = self
+        return self
+
+    def run_in_thread(self, fn, *args, **kwargs):
+        """
+        Run fn in this thread with its own profiler, whose stats are merged into this profile when it
+        stops. Before Python 3.12, cProfile only sees the thread that enabled it.
+        """
+        current.profile = self
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # from Python 3.12, the profiler enabled by start() already sees every thread
+            profiler = None
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current.profile = None
+            if profiler is not None:
+                profiler.disable()
+                with self.lock:
+                    self.thread_profilers.append(profiler)
+
+    def stop(self):
+        """
+        Stop profiling and write the profile. Returns the path of the profile, or None.
+        """
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        current.profile = None
+        try:
+            os.makedirs(profile_dir(), exist_ok=True)
+            path = os.path.join(profile_dir(), f"{time.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}_{self.name}.prof")
+            stats = pstats.Stats(self.profiler)
+            with self.lock:
+                for profiler in self.thread_profilers:
+                    stats.add(profiler)
+                self.thread_profilers = []
+            stats.dump_stats(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            rotate_profiles()
+            return path
+        finally:
+            self.profiler = None
+            profiler_lock.release()
+
+
+def active_profile():
+    """
+    The profile that the current thread's work is part of, or None.
+    """
+    profile = getattr(current, "profile", None)
+    if profile is None or profile.profiler is None:
+        return None
+    return profile
+
+
+def in_profile(fn):
+    """
+    Wrap fn, which is about to be handed to a worker thread, so that it is profiled as part of the
+    profile of the thread that wraps it, if there is one.
+    """
+    profile = active_profile()
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        return profile.run_in_thread(fn, *args, **kwargs)
+    return run
+
+
+@contextlib.contextmanager
+def profiled(name, enabled=False):
+    profile = None
+    if enabled or INGEST_PROFILE:
+        profile = Profile(name).start()
+    try:
+        yield profile
+    finally:
+        if profile is not None:
+            profile.stop()
+
+
+def profile_requested():
+    if INGEST_PROFILE:
+        return True
+    if request.headers.get(PROFILE_HEADER, "false").lower() != "true":
+        return False
+    try:
+        return auth.is_site_admin(request.headers["Authorization"].split("Bearer ")[1])
+    except Exception:
+        return False
+
+
+def start_request_profile():
+    # only the connexion operations in ingest_operations are profiled
+    if request.endpoint is None or not request.endpoint.startswith("ingest_operations"):
+        return
+    if profile_requested():
+        g.profile = Profile(f"{request.method}_{request.endpoint}").start()
+
+
+def finish_request_profile(response):
+    if "profile" in g:
+        path = g.pop("profile").stop()
+        if path is not None:
+            response.headers["X-Ingest-Profile-File"] = os.path.basename(path)
+    return response
+
+
+def stop_request_profile(exception=None):
+    # the request failed before finish_request_profile ran
+    if "profile" in g:
+        g.pop("profile").stop()
+
+
+def request_profiled():
+    """
+    True if the current request is being profiled, so that the job it queues should be profiled too.
+    """
+    return has_request_context() and "profile" in g
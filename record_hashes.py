@@ -0,0 +1,50 @@
+import hashlib
+import json
+import os
+import sqlite3
+import config
+
+
+# where the hashes of ingested records are kept; defaults to DAEMON_PATH/record_hashes.sqlite. Like the
+# distributed task queue, it must be on a local filesystem or a shared one whose locks work across hosts
+INGEST_HASH_DB = os.getenv("INGEST_HASH_DB")
+
+
+def record_hash(data):
+    """
+    A hash of a record's content that doesn't depend on the order of its keys.
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class RecordHashStore():
+    """
+    The content hashes of the clinical records ingested into katsu, by program, type and submitter ID,
+    so that delta ingests can skip records that have not changed since they were last ingested.
+    """
+    def __init__(self, path=None):
+        self.path = path or INGEST_HASH_DB or os.path.join(config.DAEMON_PATH, "record_hashes.sqlite")
+        # no WAL: it needs shared memory, which doesn't work when DAEMON_PATH is shared between hosts
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS record_hashes (program_id TEXT, type TEXT, record_id TEXT, hash TEXT, "
+                        "PRIMARY KEY (program_id, type, record_id))")
+        self.cache = {}
+
+    def hashes(self, program_id, type):
+        if (program_id, type) not in self.cache:
+            rows = self.db.execute("SELECT record_id, hash FROM record_hashes WHERE program_id = ? AND type = ?",
+                                   (program_id, type))
+            self.cache[(program_id, type)] = dict(rows)
+        return self.cache[(program_id, type)]
+
+    def update(self, program_id, type, hashes):
+        """
+        Store hashes, a dict of record IDs to content hashes.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO record_hashes VALUES (?, ?, ?, ?)",
+                                [(program_id, type, record_id, hash) for record_id, hash in hashes.items()])
+        self.hashes(program_id, type).update(hashes)
+
+    def close(self):
+        self.db.close()
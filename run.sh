@@ -1,6 +1,10 @@
 #!/usr/bin/env bash
 mkdir -p $DAEMON_PATH/to_ingest
 mkdir -p $DAEMON_PATH/results
+# the gunicorn workers and the daemon share this directory, so /metrics covers all of them
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-$DAEMON_PATH/metrics}
+rm -rf $PROMETHEUS_MULTIPROC_DIR
+mkdir -p $PROMETHEUS_MULTIPROC_DIR
 bash /ingest_app/daemon.sh &
 
 gunicorn server:app
\ No newline at end of file
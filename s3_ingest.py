@@ -1,10 +1,338 @@
 import sys
 import argparse
+import hashlib
 import json
 import requests
 import os
+import math
+import threading
+import time
 import auth
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from minio.datatypes import Part
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_COUNT = 10000
+
+
+class UploadProgress():
+    """
+    Thread-safe tally of bytes uploaded, reported periodically while uploads run.
+    """
+    def __init__(self, total_bytes, interval=10):
+        self.total_bytes = total_bytes
+        self.uploaded_bytes = 0
+        self.interval = interval
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    def update(self, num_bytes):
+        with self.lock:
+            self.uploaded_bytes += num_bytes
+
+    def throughput(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return self.uploaded_bytes / elapsed
+
+    def report(self):
+        percent = 100 * self.uploaded_bytes / self.total_bytes if self.total_bytes > 0 else 100
+        print(f"uploaded {self.uploaded_bytes / 2**30:.2f} of {self.total_bytes / 2**30:.2f} GiB ({percent:.1f}%) "
+              f"at {self.throughput() / 2**20:.1f} MiB/s", flush=True)
+
+    def start_reporting(self):
+        self.reporter = threading.Thread(target=self._report_loop, daemon=True)
+        self.reporter.start()
+
+    def stop_reporting(self):
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join()
+
+    def _report_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+
+class UploadState():
+    """
+    Records the multipart uploads that are in progress in a local JSON file, so that an interrupted
+    upload can be resumed by uploading only the parts that the bucket does not already have.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.uploads = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.uploads = json.load(f)
+
+    def get(self, key):
+        with self.lock:
+            return self.uploads.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            if value is None:
+                self.uploads.pop(key, None)
+            else:
+                self.uploads[key] = value
+            if self.path is not None:
+                with open(self.path, "w") as f:
+                    json.dump(self.uploads, f, indent=4)
+
+
+def get_part_size(file_size, part_size):
+    # S3 allows at most 10000 parts per object, each of at least 5 MiB
+    return max(part_size, MIN_PART_SIZE, math.ceil(file_size / MAX_PART_COUNT))
+
+
+def list_uploaded_parts(client, bucket, object_name, upload_id):
+    parts = {}
+    marker = None
+    while True:
+        result = client._list_parts(bucket, object_name, upload_id, part_number_marker=marker)
+        for part in result.parts:
+            parts[int(part.part_number)] = part
+        if not result.is_truncated:
+            return parts
+        marker = result.next_part_number_marker
+
+
+def common_root(files):
+    """
+    The deepest directory that contains all of the files.
+    """
+    if len(files) == 0:
+        return "."
+    return os.path.commonpath([Path(f).absolute().parent for f in files])
+
+
+def object_names(files, root=None):
+    """
+    The object name for each file: its path relative to root (by default, the common_root of the
+    files), so that files with the same name in different directories don't overwrite each other.
+    """
+    root = Path(root or common_root(files)).absolute()
+    return {f: Path(os.path.relpath(Path(f).absolute(), root)).as_posix() for f in files}
+
+
+def upload_file(client, bucket, file, part_size, part_concurrency, state, progress, object_name=None):
+    """
+    Upload a single file as object_name (by default, the file's name). Files larger than part_size
+    are uploaded as multipart uploads, with up to part_concurrency parts in flight at once; if state
+    records an earlier upload of the same object, only its missing parts are uploaded.
+    """
+    object_name = object_name or file.name
+    file_size = file.stat().st_size
+    if file_size <= part_size:
+        with open(file, "rb") as fp:
+            result = client.put_object(bucket, object_name, fp, file_size)
+        progress.update(file_size)
+        return result.object_name
+
+    part_size = get_part_size(file_size, part_size)
+    part_count = math.ceil(file_size / part_size)
+    key = f"{bucket}/{object_name}"
+    fingerprint = {"size": file_size, "mtime": file.stat().st_mtime, "part_size": part_size}
+
+    upload_id = None
+    uploaded = {}
+    previous = state.get(key)
+    if previous is not None and all(previous.get(k) == v for k, v in fingerprint.items()):
+        try:
+            uploaded = list_uploaded_parts(client, bucket, object_name, previous["upload_id"])
+            upload_id = previous["upload_id"]
+            print(f"resuming {object_name}: {len(uploaded)} of {part_count} parts already uploaded")
+        except Exception:
+            # the upload has expired or was aborted, so start again
+            uploaded = {}
+    if upload_id is None:
+        upload_id = client._create_multipart_upload(bucket, object_name, {"Content-Type": "application/octet-stream"})
+        state.set(key, {"upload_id": upload_id, **fingerprint})
+
+    def upload_part(part_number):
+        offset = (part_number - 1) * part_size
+        length = min(part_size, file_size - offset)
+        with open(file, "rb") as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+        etag = client._upload_part(bucket, object_name, data, None, upload_id, part_number)
+        progress.update(length)
+        return Part(part_number, etag)
+
+    parts = []
+    for part_number, part in uploaded.items():
+        parts.append(Part(part_number, part.etag))
+        progress.update(part.size or min(part_size, file_size - (part_number - 1) * part_size))
+    to_upload = [n for n in range(1, part_count + 1) if n not in uploaded]
+    with ThreadPoolExecutor(max_workers=part_concurrency) as executor:
+        for future in as_completed([executor.submit(upload_part, n) for n in to_upload]):
+            parts.append(future.result())
+
+    parts.sort(key=lambda p: p.part_number)
+    result = client._complete_multipart_upload(bucket, object_name, upload_id, parts)
+    state.set(key, None)
+    return result.object_name
+
+
+class ChecksumCache():
+    """
+    Local cache of the ETags computed for files, keyed by path and invalidated when a file's size or
+    modification time changes, so that large files are only read once to be checksummed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.checksums = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.checksums = json.load(f)
+
+    def get(self, file, kind):
+        stat = file.stat()
+        with self.lock:
+            entry = self.checksums.get(str(file.resolve()))
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                return None
+            return entry["etags"].get(kind)
+
+    def set(self, file, kind, etag):
+        stat = file.stat()
+        with self.lock:
+            key = str(file.resolve())
+            entry = self.checksums.get(key)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime, "etags": {}}
+                self.checksums[key] = entry
+            entry["etags"][kind] = etag
+            if self.path is not None:
+                with open(self.path, "w") as f:
+                    json.dump(self.checksums, f, indent=4)
+
+
+def compute_etag(file, part_size=None):
+    """
+    The ETag that S3 reports for file: the MD5 of the file for a single-part upload or, for a multipart
+    upload, the MD5 of the concatenated part MD5s followed by the number of parts.
+    """
+    with open(file, "rb") as fp:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: fp.read(2**20), b""):
+                md5.update(chunk)
+            return md5.hexdigest()
+        part_digests = []
+        for part in iter(lambda: fp.read(part_size), b""):
+            part_digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def local_etag(file, remote_etag, part_size, cache):
+    """
+    Compute the local ETag in the same form as remote_etag. For multipart ETags the part size is not
+    recorded by S3, so both the part size this script would use and the smallest whole MiB part size
+    that gives the same part count are tried.
+    """
+    file_size = file.stat().st_size
+    if "-" not in remote_etag:
+        candidates = [None]
+    else:
+        part_count = int(remote_etag.split("-")[1])
+        candidates = [get_part_size(file_size, part_size), math.ceil(file_size / part_count / 2**20) * 2**20]
+    etag = None
+    for candidate in candidates:
+        kind = "md5" if candidate is None else f"multipart:{candidate}"
+        etag = cache.get(file, kind)
+        if etag is None:
+            etag = compute_etag(file, candidate)
+            cache.set(file, kind, etag)
+        if etag == remote_etag:
+            break
+    return etag
+
+
+def list_remote_objects(client, bucket, names):
+    """
+    List the objects in the bucket that are in the same directories as names: each directory is
+    listed once, and not recursively, so that the rest of the bucket is never listed.
+    """
+    prefixes = sorted({name.rpartition("/")[0] + "/" if "/" in name else "" for name in names})
+    remote = {}
+    for prefix in prefixes:
+        for obj in client.list_objects(bucket, prefix=prefix, recursive=False):
+            remote[obj.object_name] = obj
+    return remote
+
+
+def select_changed_files(client, bucket, files, part_size, cache, root=None):
+    """
+    Compare files to the objects already in the bucket (named as by object_names) by size and ETag.
+    Returns the files that are new or changed, and a dict of the unchanged files keyed by path.
+    """
+    names = object_names(files, root)
+    remote = list_remote_objects(client, bucket, list(names.values()))
+    to_upload = []
+    unchanged = {}
+    for f in files:
+        file = Path(f)
+        obj = remote.get(names[f])
+        if obj is None or obj.size != file.stat().st_size:
+            to_upload.append(f)
+        elif obj.etag is not None and local_etag(file, obj.etag, part_size, cache) != obj.etag:
+            to_upload.append(f)
+        else:
+            unchanged[f] = {"object": names[f], "size": obj.size, "etag": obj.etag}
+    return to_upload, unchanged
+
+
+def write_manifest(path, bucket, files, uploaded, skipped, errors):
+    manifest = {"bucket": bucket, "files": {}}
+    for f in files:
+        if f in uploaded:
+            manifest["files"][f] = {"status": "uploaded", "object": uploaded[f], "size": Path(f).stat().st_size}
+        elif f in skipped:
+            manifest["files"][f] = {"status": "unchanged", **skipped[f]}
+        else:
+            manifest["files"][f] = {"status": "failed", "error": errors.get(f)}
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def upload_files(client, bucket, files, parallel=1, part_size=64 * 2**20, part_concurrency=4, state_file=None,
+                 report_interval=10, root=None):
+    """
+    Upload files to the bucket, with up to parallel files in flight at once. Objects are named by
+    their path relative to root (see object_names).
+    Returns a dict of the uploaded object names and a dict of errors, both keyed by file path.
+    """
+    names = object_names(files, root)
+    state = UploadState(state_file)
+    progress = UploadProgress(sum(Path(f).stat().st_size for f in files), report_interval)
+    progress.start_reporting()
+    uploaded = {}
+    errors = {}
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {
+                executor.submit(upload_file, client, bucket, Path(f), part_size, part_concurrency, state, progress, names[f]): f
+                for f in files
+            }
+            for future in as_completed(futures):
+                try:
+                    uploaded[futures[future]] = future.result()
+                    print(f"uploaded {uploaded[futures[future]]}")
+                except Exception as e:
+                    errors[futures[future]] = str(e)
+                    print(f"failed to upload {futures[future]}: {e}", file=sys.stderr)
+    finally:
+        progress.stop_reporting()
+        progress.report()
+    return uploaded, errors
 
 
 def main():
@@ -17,6 +345,19 @@ def main():
     parser.add_argument("--awsfile", help="s3 credentials", required=False)
     parser.add_argument("--access", help="access key", required=False)
     parser.add_argument("--secret", help="secret key", required=False)
+    parser.add_argument("--parallel", type=int, default=1, help="number of files to upload at once")
+    parser.add_argument("--part_size", type=int, default=64, help="multipart upload part size, in MiB")
+    parser.add_argument("--part_concurrency", type=int, default=4,
+                        help="number of parts of each file to upload at once")
+    parser.add_argument("--state", default=".s3_ingest_state.json",
+                        help="file that records multipart uploads in progress, so that interrupted uploads can be resumed")
+    parser.add_argument("--sync", action="store_true",
+                        help="only upload files that are not already in the bucket with the same size and checksum")
+    parser.add_argument("--checksum_cache", default=".s3_ingest_checksums.json",
+                        help="file that caches the checksums of local files for --sync")
+    parser.add_argument("--manifest", help="file to write a manifest of the uploaded, unchanged and failed files to")
+    parser.add_argument("--root", help="directory that object names are relative to; defaults to the deepest directory "
+                                       "that contains all of the files")
 
     args = parser.parse_args()
 
@@ -46,11 +387,22 @@ def main():
 
     client = auth.get_minio_client(auth.get_site_admin_token(), args.endpoint, args.bucket, access_key=access_key, secret_key=secret_key)
 
-    for sample in samples:
-        file = Path(sample)
-        with open(file, "rb") as fp:
-            result = client["client"].put_object(args.bucket, file.name, fp, file.stat().st_size)
-            print(f"uploaded {result.object_name}")
+    # name objects relative to the same directory whether or not some of the files are skipped
+    root = args.root or common_root(samples)
+    to_upload = samples
+    skipped = {}
+    if args.sync:
+        to_upload, skipped = select_changed_files(client["client"], args.bucket, samples, args.part_size * 2**20,
+                                                  ChecksumCache(args.checksum_cache), root)
+        print(f"{len(skipped)} of {len(samples)} files are already in {args.bucket}")
+
+    uploaded, errors = upload_files(client["client"], args.bucket, to_upload, parallel=args.parallel,
+                                    part_size=args.part_size * 2**20, part_concurrency=args.part_concurrency,
+                                    state_file=args.state, root=root)
+    if args.manifest is not None:
+        write_manifest(args.manifest, args.bucket, samples, uploaded, skipped, errors)
+    if len(errors) > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import sys
+import argparse
+import csv
+import json
+import os
+import auth
+
+
+# main file extensions, their htsget data types and the extensions of their index files
+GENOMIC_FILE_TYPES = {
+    ".vcf.gz": ("variant", [".tbi"]),
+    ".bcf": ("variant", [".csi"]),
+    ".bam": ("read", [".bai"]),
+    ".cram": ("read", [".crai"]),
+}
+
+
+def genomic_file_type(name):
+    for extension in GENOMIC_FILE_TYPES:
+        if name.endswith(extension):
+            return extension
+    return None
+
+
+def index_candidates(name, extension):
+    """
+    Possible names for the index of a main file, e.g. sample.bam.bai or sample.bai for sample.bam.
+    """
+    stem = name[:-len(extension)]
+    candidates = []
+    for index_extension in GENOMIC_FILE_TYPES[extension][1]:
+        candidates.append(f"{name}{index_extension}")
+        candidates.append(f"{stem}{index_extension}")
+    return candidates
+
+
+def read_sample_map(path):
+    """
+    Read a csv with genomic_file_id, genomic_file_sample_id and submitter_sample_id columns into a dict
+    of sample links keyed by genomic_file_id.
+    """
+    sample_map = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            if row["genomic_file_id"] not in sample_map:
+                sample_map[row["genomic_file_id"]] = []
+            sample_map[row["genomic_file_id"]].append({
+                "genomic_file_sample_id": row["genomic_file_sample_id"],
+                "submitter_sample_id": row["submitter_sample_id"]
+            })
+    return sample_map
+
+
+def build_manifest(object_names, endpoint, bucket, program_id, reference="hg38", sequence_type="wgs", sample_map=None):
+    """
+    Pair the main genomic files in a bucket listing with their index files in a single pass and yield
+    a GenomicSample for each pair. Each file is linked to the samples listed for its genomic_file_id in
+    sample_map or, if there is no sample map, to a sample with the same name as the file.
+    Main files that have no index, no samples in sample_map, or the same genomic_file_id as another main
+    file under a different prefix, are yielded as {"error": ..., "name": ...}.
+    """
+    main_files = []
+    index_files = set()
+    for name in object_names:
+        if genomic_file_type(name) is not None:
+            main_files.append(name)
+        else:
+            index_files.add(name)
+
+    file_ids = {}
+    for name in main_files:
+        genomic_file_id = os.path.basename(name)[:-len(genomic_file_type(name))]
+        file_ids.setdefault(genomic_file_id, []).append(name)
+
+    endpoint = endpoint.rstrip("/")
+    for name in main_files:
+        extension = genomic_file_type(name)
+        index_name = None
+        for candidate in index_candidates(name, extension):
+            if candidate in index_files:
+                index_name = candidate
+                break
+        if index_name is None:
+            yield {"error": f"no index file found for {name}", "name": name}
+            continue
+        genomic_file_id = os.path.basename(name)[:-len(extension)]
+        if len(file_ids[genomic_file_id]) > 1:
+            others = ", ".join(other for other in file_ids[genomic_file_id] if other != name)
+            yield {"error": f"genomic_file_id {genomic_file_id} of {name} is also the id of {others}", "name": name}
+            continue
+        if sample_map is not None:
+            if genomic_file_id not in sample_map:
+                yield {"error": f"no samples listed for {genomic_file_id}", "name": name}
+                continue
+            samples = sample_map[genomic_file_id]
+        else:
+            samples = [{"genomic_file_sample_id": genomic_file_id, "submitter_sample_id": genomic_file_id}]
+        yield {
+            "program_id": program_id,
+            "genomic_file_id": genomic_file_id,
+            "main": {
+                "access_method": f"{endpoint}/{bucket}/{name}",
+                "name": os.path.basename(name)
+            },
+            "index": {
+                "access_method": f"{endpoint}/{bucket}/{index_name}",
+                "name": os.path.basename(index_name)
+            },
+            "metadata": {
+                "sequence_type": sequence_type,
+                "data_type": GENOMIC_FILE_TYPES[extension][0],
+                "reference": reference
+            },
+            "samples": samples
+        }
+
+
+def write_manifest_chunks(samples, output, chunk_size):
+    """
+    Write samples to output_1.json, output_2.json... with at most chunk_size samples in each file.
+    Returns the paths written and a list of errors for the files that could not be paired.
+    """
+    paths = []
+    errors = []
+    chunk = []
+
+    def flush():
+        path = f"{output}_{len(paths) + 1}.json"
+        with open(path, "w") as f:
+            json.dump(chunk, f, indent=4)
+        paths.append(path)
+
+    for sample in samples:
+        if "error" in sample:
+            errors.append(sample["error"])
+            continue
+        chunk.append(sample)
+        if len(chunk) >= chunk_size:
+            flush()
+            chunk = []
+    if len(chunk) > 0:
+        flush()
+    return paths, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Script to generate genomic ingest json files from the contents of an S3-compatible bucket.")
+
+    parser.add_argument("--endpoint", help="s3 endpoint, e.g. https://s3.us-east-1.amazonaws.com", required=True)
+    parser.add_argument("--bucket", help="s3 bucket name", required=True)
+    parser.add_argument("--prefix", help="only include objects with this prefix", required=False)
+    parser.add_argument("--awsfile", help="s3 credentials", required=False)
+    parser.add_argument("--access", help="access key", required=False)
+    parser.add_argument("--secret", help="secret key", required=False)
+    parser.add_argument("--program_id", help="program that the genomic files belong to", required=True)
+    parser.add_argument("--reference", help="reference genome", choices=["hg37", "hg38"], default="hg38")
+    parser.add_argument("--sequence_type", help="sequence type", choices=["wgs", "wts"], default="wgs")
+    parser.add_argument("--samplemap", required=False,
+                        help="csv with genomic_file_id, genomic_file_sample_id and submitter_sample_id columns")
+    parser.add_argument("--output", help="prefix for the generated json files", default="genomic_ingest")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="maximum number of files in each json file")
+
+    args = parser.parse_args()
+
+    if args.awsfile:
+        result = auth.parse_s3_credential(args.awsfile)
+        if "error" in result:
+            raise Exception(f"Failed to parse awsfile: {result['error']}")
+        access_key = result["access"]
+        secret_key = result["secret"]
+    elif args.access and args.secret:
+        access_key = args.access
+        secret_key = args.secret
+    else:
+        raise Exception("Either awsfile or access/secret need to be provided.")
+
+    client = auth.get_minio_client(None, args.endpoint, args.bucket, access_key=access_key, secret_key=secret_key)
+    endpoint = args.endpoint
+    if not endpoint.startswith("http"):
+        endpoint = f"https://{endpoint}"
+
+    sample_map = None
+    if args.samplemap is not None:
+        sample_map = read_sample_map(args.samplemap)
+
+    object_names = (obj.object_name for obj in client["client"].list_objects(args.bucket, prefix=args.prefix, recursive=True))
+    samples = build_manifest(object_names, endpoint, args.bucket, args.program_id, args.reference, args.sequence_type, sample_map)
+    paths, errors = write_manifest_chunks(samples, args.output, args.chunk_size)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(json.dumps({"manifests": paths, "errors": len(errors)}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import functools
+import os
+import re
+
+
+# number of endpoint/bucket prefixes whose parse is remembered
+S3_URL_CACHE_SIZE = int(os.getenv("S3_URL_CACHE_SIZE", 1024))
+
+S3_URL_PATTERN = re.compile(r"((https*|s3):\/\/(.+?))\/(.+)")
+BUCKET_PATTERN = re.compile(r"(.+?)\/(.+)")
+# the scheme, endpoint and bucket of a URL, up to the start of the object name
+S3_PREFIX_PATTERN = re.compile(r"((https*|s3):\/\/([^\/\n]+))\/([^\/\n]+)\/")
+
+S3_SCHEME_ERROR = ("Incorrect URL format {url}. S3 URLs should be in the form http(s)://endpoint-url/bucket-name/object. If your "
+                   "object is stored at AWS S3, you can find more information about endpoint URLs at "
+                   "https://docs.aws.amazon.com/general/latest/gr/rande.html")
+
+
+@functools.lru_cache(maxsize=S3_URL_CACHE_SIZE)
+def s3_location(prefix):
+    """
+    The scheme, endpoint and bucket of a URL prefix of the form scheme://endpoint/bucket/, or None
+    if it isn't one. Manifests keep most of their files in a few buckets, so this is cached.
+    """
+    location = S3_PREFIX_PATTERN.fullmatch(prefix)
+    if location is None:
+        return None
+    return location.group(2), location.group(1), location.group(4)
+
+
+def parse_s3_url(url):
+    """
+    Parse a url into s3 components
+    """
+    # fast path: split off the object name and look up the rest
+    scheme_end = url.find("://")
+    endpoint_end = url.find("/", scheme_end + 3) if scheme_end > 0 else -1
+    bucket_end = url.find("/", endpoint_end + 1) if endpoint_end > 0 else -1
+    if bucket_end > 0 and bucket_end < len(url) - 1 and "\n" not in url:
+        location = s3_location(url[:bucket_end + 1])
+        if location is not None:
+            scheme, endpoint, bucket = location
+            if scheme == "s3":
+                raise Exception(S3_SCHEME_ERROR.format(url=url))
+            return {
+                "endpoint": endpoint,
+                "bucket": bucket,
+                "object": url[bucket_end + 1:]
+            }
+
+    s3_url_parse = S3_URL_PATTERN.match(url)
+    if s3_url_parse is not None:
+        if s3_url_parse.group(2) == "s3":
+            raise Exception(S3_SCHEME_ERROR.format(url=url))
+        endpoint = s3_url_parse.group(1)
+        bucket_parse = BUCKET_PATTERN.match(s3_url_parse.group(4))
+        if bucket_parse is not None:
+            return {
+                "endpoint": endpoint,
+                "bucket": bucket_parse.group(1),
+                "object": bucket_parse.group(2)
+            }
+        raise Exception(f"S3 URI {url} does not contain a bucket name")
+    raise Exception(f"URI {url} cannot be parsed as an S3-style URI")
+
+
+def get_access_method(url):
+    if url.startswith("file"):
+        return {
+            "type": "file",
+            "access_url": {
+                "url": url
+            }
+        }
+    try:
+        result = parse_s3_url(url)
+    except Exception as e:
+        return {
+            "message": str(e)
+        }
+    return {
+        "type": "s3",
+        "access_id": url
+    }
+
+
+def parse_s3_urls(samples, files=("main", "index")):
+    """
+    Parse the S3 URLs of the files of a whole manifest of GenomicSamples at once. Local files are
+    skipped, as they are by get_access_method.
+    Returns a dict of (genomic_file_id, file) to the parsed URL (see parse_s3_url), and a dict of
+    genomic_file_id to a list of errors, each {"file": ..., "access_method": ..., "error": ...}.
+    """
+    parsed = {}
+    errors = {}
+    for sample in samples:
+        for file in files:
+            url = sample.get(file, {}).get("access_method")
+            if not isinstance(url, str) or url.startswith("file"):
+                continue
+            try:
+                parsed[(sample["genomic_file_id"], file)] = parse_s3_url(url)
+            except Exception as e:
+                errors.setdefault(sample["genomic_file_id"], []).append({"file": file, "access_method": url, "error": str(e)})
+    return parsed, errors
@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+import config
+from batching import record_count
+
+
+# number of ingest jobs the daemon runs at once
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+# number of jobs for the same program that can run at once
+INGEST_MAX_JOBS_PER_PROGRAM = int(os.getenv("INGEST_MAX_JOBS_PER_PROGRAM", 1))
+# clinical jobs with at most this many records run ahead of larger ones, as do all genomic jobs
+INGEST_SMALL_JOB_RECORDS = int(os.getenv("INGEST_SMALL_JOB_RECORDS", 10000))
+# half-life, in seconds, of the ingest time charged to a program or submitter for fair share
+INGEST_FAIR_SHARE_HALF_LIFE = float(os.getenv("INGEST_FAIR_SHARE_HALF_LIFE", 3600))
+
+
+def meta_path(queue_id):
+    return os.path.join(config.DAEMON_PATH, "jobs", f"{queue_id}.json")
+
+
+def job_meta(ingest_json):
+    """
+    What the scheduler needs to know about a queued job, without the records themselves.
+    """
+    meta = {
+        "type": None,
+        "programs": [],
+        "records": 0,
+        "submitter": ingest_json.get("submitter"),
+        "queued_at": ingest_json.get("queued_at", time.time())
+    }
+    if "katsu" in ingest_json:
+        meta["type"] = "clinical"
+        meta["programs"] = list(ingest_json["katsu"].keys())
+        meta["records"] = sum(record_count(records) for program in ingest_json["katsu"].values()
+                              for records in program["schemas"].values())
+    elif "htsget" in ingest_json:
+        meta["type"] = "genomic"
+        meta["programs"] = list(ingest_json["htsget"].keys())
+        meta["records"] = sum(len(samples) for samples in ingest_json["htsget"].values())
+    return meta
+
+
+def write_job_meta(queue_id, ingest_json):
+    os.makedirs(os.path.dirname(meta_path(queue_id)), exist_ok=True)
+    with open(meta_path(queue_id), "w") as f:
+        json.dump(job_meta(ingest_json), f)
+
+
+def read_job_meta(file_path):
+    """
+    Read the metadata written alongside a queued job, or work it out from the job itself if there
+    is none.
+    """
+    try:
+        with open(meta_path(os.path.basename(file_path))) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        with open(file_path) as f:
+            return job_meta(json.load(f))
+
+
+def remove_job_meta(queue_id):
+    try:
+        os.remove(meta_path(queue_id))
+    except FileNotFoundError:
+        pass
+
+
+def job_priority(meta):
+    """
+    Jobs with a lower priority value run first: genomic linkages and small clinical loads before
+    large clinical loads.
+    """
+    if meta["type"] == "genomic" or meta["records"] <= INGEST_SMALL_JOB_RECORDS:
+        return 0
+    return 1
+
+
+class Scheduler():
+    """
+    Hands queued jobs to the daemon's workers. Of the jobs whose programs are all below
+    max_per_program running jobs, the next one is chosen by priority, then by fair share: the
+    program, then the submitter, that has recently used the least ingest time goes first, and ties
+    go to the oldest job. Ingest time is charged to programs and submitters when each job finishes
+    and decays with a half-life of half_life seconds.
+    """
+    def __init__(self, max_per_program=INGEST_MAX_JOBS_PER_PROGRAM, half_life=INGEST_FAIR_SHARE_HALF_LIFE):
+        self.max_per_program = max_per_program
+        self.half_life = half_life
+        self.condition = threading.Condition()
+        self.queued = {}
+        self.active = set()
+        self.running = {}
+        self.usage = {}
+
+    def add(self, file_path, meta=None):
+        if meta is None:
+            meta = read_job_meta(file_path)
+        with self.condition:
+            if file_path in self.queued or file_path in self.active:
+                return
+            self.queued[file_path] = meta
+            self.condition.notify_all()
+
+    def usage_of(self, key, now):
+        value, charged_at = self.usage.get(key, (0, now))
+        return value * 0.5 ** ((now - charged_at) / self.half_life)
+
+    def charge(self, key, seconds, now):
+        self.usage[key] = (self.usage_of(key, now) + seconds, now)
+
+    def runnable(self, meta):
+        return all(self.running.get(program_id, 0) < self.max_per_program for program_id in meta["programs"])
+
+    def order(self, meta, now):
+        program_usage = max([self.usage_of(("program", program_id), now) for program_id in meta["programs"]], default=0)
+        return (job_priority(meta), program_usage, self.usage_of(("submitter", meta["submitter"]), now), meta["queued_at"])
+
+    def pick(self):
+        now = time.time()
+        candidates = [file_path for file_path, meta in self.queued.items() if self.runnable(meta)]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda file_path: self.order(self.queued[file_path], now))
+
+    def next_job(self):
+        """
+        Wait for a job that can run, mark it as running and return its path and metadata.
+        """
+        with self.condition:
+            while True:
+                file_path = self.pick()
+                if file_path is not None:
+                    meta = self.queued.pop(file_path)
+                    for program_id in meta["programs"]:
+                        self.running[program_id] = self.running.get(program_id, 0) + 1
+                    self.active.add(file_path)
+                    return file_path, meta
+                self.condition.wait()
+
+    def done(self, file_path, meta, seconds):
+        with self.condition:
+            now = time.time()
+            for program_id in meta["programs"]:
+                self.running[program_id] -= 1
+                self.charge(("program", program_id), seconds, now)
+            self.charge(("submitter", meta["submitter"]), seconds, now)
+            self.active.discard(file_path)
+            self.condition.notify_all()
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import auth
+import profiling
+from batching import record_count, write_spool, write_sharded_spool
+from ingest_results import merge_into, summarize
+from katsu_ingest import ingest_schemas
+
+
+# programs with more donors than this have their other types split into shards of this many
+# donors each, which are ingested in parallel once the program and its donors are in; 0 turns
+# sharding off
+INGEST_SHARD_DONORS = int(os.getenv("INGEST_SHARD_DONORS", 5000))
+# number of shards of a job that the daemon ingests at once
+INGEST_SHARD_WORKERS = int(os.getenv("INGEST_SHARD_WORKERS", 4))
+# ingest the shards of a job in separate processes, so that they aren't limited to one core by the
+# GIL; otherwise they are ingested by threads. In distributed mode, each shard is a task of its own
+# instead, run by whichever worker on whichever host takes it.
+INGEST_SHARD_PROCESSES = os.getenv("INGEST_SHARD_PROCESSES", "true").lower() == "true"
+
+# types that every other type depends on, which are ingested before the shards
+PARENT_TYPES = ["programs", "donors"]
+
+
+def donor_shards(schemas, donors_per_shard=INGEST_SHARD_DONORS):
+    """
+    Assign the donors in schemas to shards of donors_per_shard consecutive donors. Returns a dict of
+    donor ID to shard number, or None if the donors fit into one shard.
+    """
+    donors = schemas.get("donors", [])
+    if donors_per_shard <= 0 or len(donors) <= donors_per_shard:
+        return None
+    return {donor["submitter_donor_id"]: i // donors_per_shard for i, donor in enumerate(donors)}
+
+
+def spool_program(schemas, program_dir, donors_per_shard=INGEST_SHARD_DONORS):
+    """
+    Replace a program's flattened records with spool files in program_dir (see batching.write_spool).
+    If the program has enough donors to be sharded, the records of each type other than programs
+    and donors are written grouped by donor shard, and the list of shards is returned: each shard
+    maps types to the range of their spool file that belongs to the shard's donors. Otherwise,
+    returns None.
+    """
+    shards = donor_shards(schemas, donors_per_shard)
+    shard_count = 0 if shards is None else max(shards.values()) + 1
+    program_shards = [{} for i in range(shard_count)]
+    for type in schemas:
+        if len(schemas[type]) == 0:
+            continue
+        path = os.path.join(program_dir, f"{type}.ndjson")
+        if shards is None or type in PARENT_TYPES:
+            schemas[type] = write_spool(schemas[type], path)
+            continue
+        schemas[type], ranges = write_sharded_spool(schemas[type], path,
+                                                    lambda record: shards.get(record.get("submitter_donor_id"), 0), shard_count)
+        for shard, records_range in zip(program_shards, ranges):
+            if records_range is not None:
+                shard[type] = records_range
+    if shards is None:
+        return None
+    return [shard for shard in program_shards if len(shard) > 0]
+
+
+def ingest_shard(shard, batch_size, adaptive, isolate_errors, delta, control, checkpoint, profile_name=None):
+    """
+    Ingest one shard of a program, profiled as profile_name if it is set. Returns the result, the
+    status code and the checkpoint, so that the shard can be ingested in another process.
+    """
+    with profiling.profiled(profile_name or "shard", enabled=profile_name is not None):
+        result, status_code = ingest_schemas(shard, batch_size, adaptive, isolate_errors, delta, control, checkpoint)
+    return result, status_code, checkpoint
+
+
+def start_shard_process(token, seconds_left):
+    # use the daemon's service token rather than minting one in each process
+    if token is not None:
+        auth.service_token_provider.adopt(token, seconds_left)
+
+
+def ingest_program(program, batch_size=1000, adaptive=False, isolate_errors=False, delta=False, control=None,
+                   checkpoint=None, workers=INGEST_SHARD_WORKERS, processes=INGEST_SHARD_PROCESSES):
+    """
+    Ingest a queued program. A sharded program (see spool_program) has its programs and donors
+    ingested first, then its shards, workers at a time, and the results are merged into one, as
+    if it had been ingested at once; the time taken by the shards is reported in
+    result["timings"]["shards"]. The checkpoint of each shard is kept in checkpoint["shards"].
+    With processes set, each of the workers is a separate process, and if the program is being
+    profiled, each shard is profiled separately.
+    """
+    if checkpoint is None:
+        checkpoint = {}
+    if "shards" not in program:
+        return ingest_schemas(program["schemas"], batch_size, adaptive, isolate_errors, delta, control, checkpoint)
+
+    parents = {type: records for type, records in program["schemas"].items() if type in PARENT_TYPES}
+    # ingest_schemas gives up on a program that already exists before it gets to the other types,
+    # and so do the shards
+    remaining = [type for type in parents if record_count(parents[type]) > (0 if delta else checkpoint.get(type, 0))]
+    result, status_code = ingest_schemas(parents, batch_size, adaptive, isolate_errors, delta, control, checkpoint)
+    if "stopped" in result or any(type not in result["counts"] for type in remaining):
+        return result, status_code
+
+    shards = program["shards"]
+    shard_checkpoints = checkpoint.setdefault("shards", [{} for shard in shards])
+    start = time.monotonic()
+    if processes:
+        # spawn rather than fork, since the daemon has threads running
+        profile = profiling.active_profile()
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=start_shard_process, initargs=auth.service_token_provider.share()) as executor:
+            futures = [executor.submit(ingest_shard, shards[i], batch_size, adaptive, isolate_errors, delta, control,
+                                       shard_checkpoints[i], f"{profile.name}_shard_{i}" if profile is not None else None)
+                       for i in range(len(shards))]
+            shard_results = [future.result() for future in futures]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            shard_results = list(executor.map(
+                profiling.in_profile(lambda i: ingest_shard(shards[i], batch_size, adaptive, isolate_errors, delta, control,
+                                                            shard_checkpoints[i])),
+                range(len(shards))))
+    for i, (shard_result, shard_status_code, shard_checkpoint) in enumerate(shard_results):
+        shard_checkpoints[i] = shard_checkpoint
+        merge_into(result, shard_result)
+        if shard_status_code not in (200, 201):
+            status_code = shard_status_code
+    summarize(result)
+    result["timings"]["shards"] = {"shards": len(shards), "workers": workers, "wall_seconds": round(time.monotonic() - start, 4)}
+    return result, status_code
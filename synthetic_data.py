@@ -0,0 +1,388 @@
+import argparse
+import copy
+import json
+import random
+import sys
+import requests
+import yaml
+from config import DEFAULT_OPENAPI_URL
+
+
+ROOT_SCHEMAS = ["DonorWithClinicalDataSchema", "DonorWithClinicalData"]
+# fields that refer to the submitter IDs of other objects in the same donor
+REFERENCE_FIELDS = {"reference_radiation_treatment_id": "submitter_treatment_id"}
+# treatment types that must be listed exactly when the treatment has records of the matching kind
+TREATMENT_TYPES = {"Systemic therapy": "systemic_therapies", "Radiation therapy": "radiations", "Surgery": "surgeries"}
+
+
+def read_openapi(location):
+    if location.startswith("http"):
+        response = requests.get(location)
+        response.raise_for_status()
+        return yaml.safe_load(response.text)
+    with open(location) as f:
+        return yaml.safe_load(f)
+
+
+def is_id_field(name):
+    return name == "program_id" or (name.startswith("submitter_") and name.endswith("_id"))
+
+
+class SchemaGenerator():
+    """
+    Generates random DonorWithClinicalData objects by walking the MoH schema in katsu's openapi spec.
+    Required properties are always filled in and optional ones with probability fill; nested lists
+    hold between 1 and breadth items, down to depth levels below the donor. Submitter IDs are unique
+    and nested objects reuse the IDs of the objects they are nested in. Optional submitter IDs, such
+    as those in biomarkers, refer to objects generated earlier in the same donor. The MoH rules that
+    the schema doesn't express are then applied (see make_consistent), so that donors pass MoHSchemaV3
+    validation. The same seed always generates the same donors.
+    """
+    def __init__(self, openapi, seed=0, fill=0.8, breadth=3, depth=4, root_schema=None):
+        self.schemas = openapi["components"]["schemas"]
+        self.random = random.Random(seed)
+        self.fill = fill
+        self.breadth = breadth
+        self.depth = depth
+        self.root_schema = root_schema
+        if self.root_schema is None:
+            for name in ROOT_SCHEMAS:
+                if name in self.schemas:
+                    self.root_schema = name
+                    break
+        if self.root_schema not in self.schemas:
+            raise ValueError(f"The schema does not contain any of {', '.join(ROOT_SCHEMAS)}")
+        self.counter = 0
+        self.known_ids = {}
+
+    def resolve(self, schema):
+        while "$ref" in schema:
+            schema = {**self.schemas[schema["$ref"].split("/")[-1]], **{k: v for k, v in schema.items() if k != "$ref"}}
+        if "allOf" in schema:
+            merged = {k: v for k, v in schema.items() if k != "allOf"}
+            for sub_schema in schema["allOf"]:
+                merged.update(self.resolve(sub_schema))
+            schema = merged
+        return schema
+
+    def is_blank(self, schema):
+        schema = self.resolve(schema)
+        if schema.get("type") == "null":
+            return True
+        return "enum" in schema and all(value in [None, ""] for value in schema["enum"])
+
+    def new_id(self, name, ids):
+        self.counter += 1
+        label = name[len("submitter_"):-len("_id")].upper()
+        new_id = f"{ids['submitter_donor_id']}_{label}_{self.counter}"
+        self.known_ids.setdefault(name, []).append(new_id)
+        return new_id
+
+    def reference(self, name):
+        if len(self.known_ids.get(name, [])) == 0:
+            return None
+        return self.random.choice(self.known_ids[name])
+
+    def generate(self, name, schema, ids, depth):
+        schema = self.resolve(schema)
+        for key in ["oneOf", "anyOf"]:
+            if key in schema:
+                choices = [choice for choice in schema[key] if not self.is_blank(choice)]
+                if len(choices) == 0:
+                    return None
+                return self.generate(name, self.random.choice(choices), ids, depth)
+        if "enum" in schema:
+            choices = [value for value in schema["enum"] if value not in [None, ""]]
+            return self.random.choice(choices) if len(choices) > 0 else None
+        schema_type = schema.get("type", "object" if "properties" in schema else "string")
+        if schema_type == "object":
+            return self.generate_object(schema, ids, depth)
+        if schema_type == "array":
+            items = self.resolve(schema.get("items", {}))
+            if "enum" in items:
+                choices = [value for value in items["enum"] if value not in [None, ""]]
+                return self.random.sample(choices, self.random.randint(1, min(self.breadth, len(choices))))
+            if items.get("type", "object") == "object":
+                if depth >= self.depth:
+                    return []
+                return [self.generate(name, items, ids, depth + 1) for i in range(self.random.randint(1, self.breadth))]
+            return [self.generate(name, items, ids, depth) for i in range(self.random.randint(1, self.breadth))]
+        if schema_type == "integer":
+            return self.random.randint(schema.get("minimum", 0), schema.get("maximum", 100))
+        if schema_type == "number":
+            return round(self.random.uniform(schema.get("minimum", 0), schema.get("maximum", 100)), 1)
+        if schema_type == "boolean":
+            return self.random.choice([True, False])
+        if schema.get("format") == "date":
+            return f"{self.random.randint(1950, 2023)}-{self.random.randint(1, 12):02d}-{self.random.randint(1, 28):02d}"
+        value = f"{name}_{self.random.randint(0, 999999)}"
+        return value[:schema.get("maxLength", len(value))]
+
+    def generate_object(self, schema, ids, depth):
+        properties = schema.get("properties", {})
+        if set(properties.keys()) == {"month_interval", "day_interval"}:
+            # date intervals: keep the day offset consistent with the month offset
+            month_interval = self.random.randint(-600, 120)
+            return {"month_interval": month_interval, "day_interval": month_interval * 30 + self.random.randint(0, 29)}
+        required = schema.get("required", [])
+        ids = ids.copy()
+        result = {}
+        for name in properties:
+            if is_id_field(name):
+                if name in ids:
+                    result[name] = ids[name]
+                elif name in required:
+                    ids[name] = self.new_id(name, ids)
+                    result[name] = ids[name]
+        for name in properties:
+            if name in result or is_id_field(name) or (name not in required and self.random.random() >= self.fill):
+                continue
+            if name in REFERENCE_FIELDS:
+                value = self.reference(REFERENCE_FIELDS[name])
+            else:
+                value = self.generate(name, properties[name], ids, depth)
+            if value is not None:
+                result[name] = value
+        for name in properties:
+            if is_id_field(name) and name not in result and name not in required and self.random.random() < self.fill:
+                value = self.reference(name)
+                if value is not None:
+                    result[name] = value
+        return result
+
+    def donor(self, donor_id, program_id):
+        ids = {"program_id": program_id, "submitter_donor_id": donor_id}
+        self.known_ids = {}
+        donor = self.generate_object(self.resolve(self.schemas[self.root_schema]), ids, 0)
+        make_consistent(donor)
+        return donor
+
+
+def date_intervals(field):
+    if isinstance(field, dict):
+        if "month_interval" in field:
+            yield field
+            return
+        for key in field:
+            yield from date_intervals(field[key])
+    elif isinstance(field, list):
+        for elem in field:
+            yield from date_intervals(elem)
+
+
+def nested_objects(field):
+    if isinstance(field, dict):
+        yield field
+        for key in field:
+            yield from nested_objects(field[key])
+    elif isinstance(field, list):
+        for elem in field:
+            yield from nested_objects(elem)
+
+
+def make_consistent(donor):
+    """
+    Apply the MoH rules that the schema doesn't express to a generated donor: dates are relative to
+    diagnosis, so the date of birth comes before every other date and the date of death after them;
+    only deceased donors have a date and cause of death; and a treatment's treatment_type lists
+    exactly the kinds of therapy that it has records for.
+    """
+    if "date_of_birth" in donor:
+        donor["date_of_birth"] = {"month_interval": -abs(donor["date_of_birth"]["month_interval"]) - 1,
+                                  "day_interval": -abs(donor["date_of_birth"]["day_interval"]) - 31}
+    for date in date_intervals({key: value for key, value in donor.items() if key not in ["date_of_birth", "date_of_death"]}):
+        date["month_interval"] = abs(date["month_interval"])
+        date["day_interval"] = date["month_interval"] * 30 + date["day_interval"] % 30
+    if donor.get("is_deceased") == "Yes" and "date_of_death" in donor and "cause_of_death" in donor:
+        last = max([date["month_interval"] for date in date_intervals(donor) if date is not donor["date_of_death"]] + [0])
+        donor["date_of_death"] = {"month_interval": last + 1, "day_interval": (last + 1) * 30 + 29}
+    else:
+        for key in ["date_of_death", "cause_of_death"]:
+            donor.pop(key, None)
+        if donor.get("is_deceased") == "Yes":
+            donor["is_deceased"] = "No"
+    for treatment in [obj for obj in nested_objects(donor) if isinstance(obj.get("treatment_type"), list)]:
+        types = [type for type in treatment["treatment_type"] if type not in TREATMENT_TYPES]
+        for type, key in TREATMENT_TYPES.items():
+            if len(treatment.get(key, [])) > 0:
+                types.append(type)
+            else:
+                treatment.pop(key, None)
+        treatment["treatment_type"] = types if len(types) > 0 else ["Other"]
+
+
+def rename_ids(field, suffix):
+    """
+    Append suffix to every submitter ID in a donor, so that cloned donors don't collide but keep
+    their internal references consistent.
+    """
+    if isinstance(field, dict):
+        for key in field:
+            if key.startswith("submitter_") and key.endswith("_id") and isinstance(field[key], str):
+                field[key] = f"{field[key]}_{suffix}"
+            else:
+                rename_ids(field[key], suffix)
+    elif isinstance(field, list):
+        for elem in field:
+            rename_ids(elem, suffix)
+
+
+def program_ids(programs, prefix=""):
+    return [f"{prefix}SYNTH_{i + 1:02d}" for i in range(programs)]
+
+
+def generate_donors(count, programs=1, generator=None, template=None, prefix=""):
+    """
+    Yield count donors spread round-robin over programs, either generated from the schema by a
+    SchemaGenerator or cloned from the donors of a template dataset such as tests/clinical_ingest.json.
+    """
+    program_list = program_ids(programs, prefix)
+    for i in range(count):
+        program_id = program_list[i % programs]
+        if generator is not None:
+            yield generator.donor(f"{prefix}DONOR_{i + 1:07d}", program_id)
+        else:
+            donor = copy.deepcopy(template["donors"][i % len(template["donors"])])
+            rename_ids(donor, f"{prefix}{i + 1:07d}")
+            donor["program_id"] = program_id
+            yield donor
+
+
+def sample_ids(field):
+    if isinstance(field, dict):
+        for key in field:
+            if key == "submitter_sample_id":
+                yield field[key]
+            else:
+                yield from sample_ids(field[key])
+    elif isinstance(field, list):
+        for elem in field:
+            yield from sample_ids(elem)
+
+
+def generate_genomic_samples(donors, data_type="variant", reference="hg38"):
+    """
+    Yield a GenomicSample for the first sample registration of each donor that has one.
+    """
+    for donor in donors:
+        submitter_sample_id = next(sample_ids(donor), None)
+        if submitter_sample_id is None:
+            continue
+        file_id = f"{submitter_sample_id}_genomic"
+        yield {
+            "program_id": donor["program_id"],
+            "genomic_file_id": file_id,
+            "main": {
+                "access_method": f"file:///data/files/{file_id}.vcf.gz",
+                "name": f"{file_id}.vcf.gz"
+            },
+            "index": {
+                "access_method": f"file:///data/files/{file_id}.vcf.gz.tbi",
+                "name": f"{file_id}.vcf.gz.tbi"
+            },
+            "metadata": {
+                "sequence_type": "wgs",
+                "data_type": data_type,
+                "reference": reference
+            },
+            "samples": [
+                {
+                    "genomic_file_sample_id": submitter_sample_id,
+                    "submitter_sample_id": submitter_sample_id
+                }
+            ]
+        }
+
+
+class ItemWriter():
+    """
+    Streams items to a file as NDJSON or as a JSON list. If header is set, the list is written as the
+    value of key in the header object.
+    """
+    def __init__(self, f, ndjson=False, header=None, key=None):
+        self.f = f
+        self.ndjson = ndjson
+        self.header = header
+        self.count = 0
+        if ndjson:
+            return
+        if header is not None:
+            f.write(json.dumps(header)[:-1])
+            f.write(f', "{key}": [')
+        else:
+            f.write("[")
+
+    def write(self, item):
+        if self.ndjson:
+            self.f.write(json.dumps(item))
+            self.f.write("\n")
+        else:
+            if self.count > 0:
+                self.f.write(",\n")
+            self.f.write(json.dumps(item))
+        self.count += 1
+
+    def close(self):
+        if not self.ndjson:
+            self.f.write("]}\n" if self.header is not None else "]\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A script that generates synthetic clinical and genomic ingest data "
+                                                 "of any size without network access.")
+    parser.add_argument("--schema", help="path or URL of katsu's schema.yml; donors are generated from the MoH schema in it")
+    parser.add_argument("--template", help="instead of --schema, clone the donors in this clinical ingest json")
+    parser.add_argument("--openapi_url", default=DEFAULT_OPENAPI_URL, help="openapi_url to list in the clinical json")
+    parser.add_argument("--donors", type=int, default=100, help="number of donors")
+    parser.add_argument("--programs", type=int, default=1, help="number of programs to spread the donors over")
+    parser.add_argument("--depth", type=int, default=4, help="maximum nesting depth below each donor")
+    parser.add_argument("--breadth", type=int, default=3, help="maximum number of items in each nested list")
+    parser.add_argument("--fill", type=float, default=0.8, help="probability that an optional field is filled in")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prefix", default="", help="optional prefix to apply to all identifiers")
+    parser.add_argument("--ndjson", action="store_true", help="write one donor or sample per line instead of JSON")
+    parser.add_argument("--output", default="synthetic",
+                        help="prefix of the output files, e.g. synthetic_clinical.json and synthetic_genomic.json")
+    parser.add_argument("--no_genomic", action="store_true", help="don't write genomic samples")
+    args = parser.parse_args()
+
+    generator = None
+    template = None
+    if args.schema is not None:
+        generator = SchemaGenerator(read_openapi(args.schema), args.seed, args.fill, args.breadth, args.depth)
+    elif args.template is not None:
+        with open(args.template) as f:
+            template = json.load(f)
+        args.openapi_url = template.get("openapi_url", args.openapi_url)
+    else:
+        print("ERROR: either --schema or --template is required.", file=sys.stderr)
+        sys.exit(1)
+
+    extension = "ndjson" if args.ndjson else "json"
+    result = {"clinical": f"{args.output}_clinical.{extension}"}
+    header = {"openapi_url": args.openapi_url, "schema_class": "MoHSchemaV3"}
+    clinical_file = open(result["clinical"], "w")
+    clinical = ItemWriter(clinical_file, args.ndjson, header, "donors")
+    genomic = None
+    if not args.no_genomic:
+        result["genomic"] = f"{args.output}_genomic.{extension}"
+        genomic_file = open(result["genomic"], "w")
+        genomic = ItemWriter(genomic_file, args.ndjson)
+
+    # donors are written as they are generated, so the output can be larger than memory
+    for donor in generate_donors(args.donors, args.programs, generator, template, args.prefix):
+        clinical.write(donor)
+        if genomic is not None:
+            for sample in generate_genomic_samples([donor]):
+                genomic.write(sample)
+    clinical.close()
+    clinical_file.close()
+    result["donors"] = clinical.count
+    if genomic is not None:
+        genomic.close()
+        genomic_file.close()
+        result["samples"] = genomic.count
+    print(json.dumps(result, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,38 @@ import requests
 import os
 import re
 import sys
+import subprocess
+import hashlib
+import gzip
+import io
+import concurrent.futures
+import pstats
+import time
 
 REPO_DIR = os.path.abspath(f"{os.path.dirname(os.path.realpath(__file__))}/..")
 sys.path.insert(0, os.path.abspath(f"{REPO_DIR}"))
+import auth
+import batching
 import katsu_ingest
 import htsget_ingest
+import s3_ingest
+import s3_manifest
+import config
+import upload_sessions
+import ingest_body
+import synthetic_data
+import metrics
+import profiling
+import scheduler
+import job_control
+import daemon
+import admission
+import distributed
+import sharding
+import s3_urls
+import validate
+import ingest_operations
+from benchmarks.stand_ins import StandInConfig, start_stand_ins
 
 CANDIG_URL = os.getenv("CANDIG_URL", "http://localhost")
 HTSGET_URL = os.getenv("HTSGET_URL", f"{CANDIG_URL}/genomics")
@@ -23,6 +50,262 @@ def test_prepare_clinical_ingest():
         assert len(result["SYNTH_01"]["schemas"]["systemic_therapies"]) == 16
 
 
+def test_service_token_reuse(monkeypatch):
+    minted = []
+    def mint():
+        minted.append(f"token-{len(minted)}")
+        return minted[-1]
+    monkeypatch.setattr(auth.authx.auth, "create_service_token", mint)
+
+    provider = auth.ServiceTokenProvider(ttl=3600, refresh_margin=300)
+    assert provider.get() == "token-0"
+    assert provider.get() == "token-0"
+    assert len(minted) == 1
+
+    # an expiring token is replaced on the next call
+    provider.expires_at = 0
+    assert provider.get() == "token-1"
+    provider.invalidate()
+    assert provider.get() == "token-2"
+    # a token that has already been replaced isn't invalidated again
+    provider.invalidate("token-1")
+    assert provider.get() == "token-2"
+
+    # the lifetime comes from the token response when it has one
+    assert auth.token_lifetime({"token": "t", "expires_in": 60}, 3600) == ("t", 60)
+    assert auth.token_lifetime("opaque", 3600) == ("opaque", 3600)
+    monkeypatch.setattr(auth.authx.auth, "create_service_token", lambda: {"token": "short", "expires_in": 100})
+    provider = auth.ServiceTokenProvider(ttl=3600, refresh_margin=300)
+    assert provider.get() == "short"
+    assert provider.margin == 50
+
+
+def test_service_token_retry(requests_mock, monkeypatch):
+    monkeypatch.setattr(auth, "service_token_provider", auth.ServiceTokenProvider())
+    monkeypatch.setattr(auth.authx.auth, "create_service_token", iter(["revoked", "fresh"]).__next__)
+
+    def check_token(request, context):
+        context.status_code = 200 if request.headers["X-Service-Token"] == "fresh" else 401
+        return {}
+    requests_mock.get(f"{HTSGET_URL}/ga4gh/drs/v1/objects/S1", json=check_token)
+    headers = {"X-Service-Token": auth.get_service_token()}
+    response = auth.service_request("htsget", "drs", "GET", f"{HTSGET_URL}/ga4gh/drs/v1/objects/S1", headers)
+    assert response.status_code == 200
+    assert headers["X-Service-Token"] == "fresh"
+    assert requests_mock.call_count == 2
+
+
+def katsu_ingest_callback(request, context):
+    # reject any batch that contains a donor without a gender
+    batch = request.json()
+    if any("gender" not in donor for donor in batch):
+        context.status_code = 400
+        return {"error": "gender is required"}
+    context.status_code = 201
+    return {}
+
+
+def test_adaptive_batching(requests_mock, monkeypatch):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", json=katsu_ingest_callback)
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01", "gender": "Man"} for i in range(0, 100)]
+    donors[42].pop("gender")
+
+    # with fixed batches, the bad donor sinks its whole batch:
+    result, status_code = katsu_ingest.ingest_schemas({"donors": [dict(d) for d in donors]}, batch_size=10)
+    assert result["results"] == ["Of 100 donors, 90 were created"]
+    assert len(result["errors"]) == 1
+    assert result["batch_sizes"]["donors"]["batches"] == 10
+
+    # adaptively, the failing batch is split until only the bad donor is left:
+    result, status_code = katsu_ingest.ingest_schemas({"donors": [dict(d) for d in donors]}, batch_size=10, adaptive=True)
+    assert result["results"] == ["Of 100 donors, 99 were created"]
+    assert result["errors"] == ["donors: 400 gender is required"]
+    assert result["batch_sizes"]["donors"]["adaptive"]
+    assert result["batch_sizes"]["donors"]["min"] == 1
+    assert result["batch_sizes"]["donors"]["max"] > 10
+
+    # isolating errors reports the rejected donor by its submitter ID:
+    result, status_code = katsu_ingest.ingest_schemas({"donors": [dict(d) for d in donors]}, batch_size=10, isolate_errors=True)
+    assert result["results"] == ["Of 100 donors, 99 were created"]
+    assert len(result["errors"]) == 0
+    assert result["record_errors"] == {"donors": {"DONOR_42": ["400 gender is required"]}}
+
+    # records without an ID of their own are reported by position, so siblings don't share an entry
+    def reject_radiations(request, context):
+        context.status_code = 400 if any("anatomical_site" not in radiation for radiation in request.json()) else 201
+        return {"error": "anatomical_site is required"}
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/radiations/", json=reject_radiations)
+    radiations = [{"submitter_donor_id": "DONOR_1", "submitter_treatment_id": "TR_1", "program_id": "SYNTH_01",
+                   "anatomical_site": "C01"} for i in range(0, 5)]
+    radiations[1].pop("anatomical_site")
+    radiations[3].pop("anatomical_site")
+    result, status_code = katsu_ingest.ingest_schemas({"radiations": radiations}, batch_size=5, isolate_errors=True)
+    assert list(result["record_errors"]["radiations"].keys()) == ["record 2", "record 4"]
+
+    # a rejected record doesn't shrink the batches, but server errors do, and aren't split
+    sizer = batching.BatchSizer(10, adaptive=True)
+    katsu_ingest.post_batch(f"{CANDIG_URL}/katsu/v3/ingest/donors/", {}, list(batching.serialize_records(donors[40:50])), sizer, split=True)
+    assert sizer.size == 11
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", status_code=503)
+    posts = requests_mock.call_count
+    created, failures = katsu_ingest.post_batch(f"{CANDIG_URL}/katsu/v3/ingest/donors/", {},
+                                                list(batching.serialize_records(donors[0:10])), sizer, split=True)
+    assert created == 0 and len(failures) == 1
+    assert requests_mock.call_count == posts + 1
+    assert sizer.size == 5
+
+
+def test_spooled_ingest(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", json=katsu_ingest_callback)
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01", "gender": "Man"} for i in range(0, 25)]
+
+    spool = batching.write_spool(donors, str(tmp_path / "donors.ndjson"))
+    assert spool["count"] == 25
+    assert list(batching.read_records(spool)) == list(batching.serialize_records(donors))
+
+    result, status_code = katsu_ingest.ingest_schemas({"donors": spool}, batch_size=10)
+    assert result["results"] == ["Of 25 donors, 25 were created"]
+    assert result["batch_sizes"]["donors"]["batches"] == 3
+    assert requests_mock.last_request.json() == donors[20:]
+    assert result["timings"]["katsu"]["donors"]["requests"] == 3
+    assert len(result["timings"]["katsu"]["donors"]["slowest_batches"]) == 3
+
+
+def test_spool_cleanup(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    monkeypatch.setattr(daemon, "DAEMON_PATH", str(tmp_path))
+    for directory in ["to_ingest", "results"]:
+        os.makedirs(tmp_path / directory)
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01"} for i in range(0, 5)]
+
+    # a request that fails after spooling leaves nothing behind
+    def fail(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(ingest_operations, "write_job_meta", fail)
+    with pytest.raises(OSError):
+        ingest_operations.add_to_queue({"katsu": {"SYNTH_01": {"schemas": {"donors": [dict(d) for d in donors]}}}})
+    assert os.listdir(tmp_path / "spool") == []
+
+    # nor does a job that raises
+    monkeypatch.setattr(ingest_operations, "write_job_meta", scheduler.write_job_meta)
+    queue_id = ingest_operations.add_to_queue({"katsu": {"SYNTH_01": {"schemas": {"donors": [dict(d) for d in donors]}}}})
+    monkeypatch.setattr(daemon, "ingest_program", fail)
+    with pytest.raises(OSError):
+        daemon.ingest_file(str(tmp_path / "to_ingest" / queue_id))
+    assert os.listdir(tmp_path / "spool") == []
+    assert os.listdir(tmp_path / "to_ingest") == []
+    with open(tmp_path / "results" / queue_id) as f:
+        assert json.load(f) == {"status": "failed", "errors": ["disk full"]}
+
+
+def test_delta_ingest(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    in_katsu = {"DONOR_0"}
+
+    def create_callback(request, context):
+        batch = request.json()
+        if any(donor["submitter_donor_id"] in in_katsu for donor in batch):
+            context.status_code = 400
+            return {"error": "donor with this submitter_donor_id already exists (unique)"}
+        context.status_code = 201
+        return {}
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", json=create_callback)
+    requests_mock.get(f"{CANDIG_URL}/katsu/v3/authorized/donors", json={"items": [{"submitter_donor_id": "DONOR_0"}], "count": 1})
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01", "gender": "Man"} for i in range(0, 20)]
+
+    # the first delta ingest lists the donors already in katsu: DONOR_0 is a conflict, and isn't sent
+    result, status_code = katsu_ingest.ingest_schemas({"donors": [dict(d) for d in donors]}, batch_size=10, delta=True)
+    assert result["results"] == ["Of 20 donors, 19 were created, 0 were unchanged and 1 conflicted with records already in katsu"]
+    assert result["conflicts"] == {"donors": ["DONOR_0"]}
+    assert len(result["errors"]) == 0
+    posted = [donor["submitter_donor_id"] for request in requests_mock.request_history if request.method == "POST" for donor in request.json()]
+    assert posted == [f"DONOR_{i}" for i in range(1, 20)]
+
+    # resubmitting with one change doesn't send the changed donor, and reports it as a conflict
+    donors[5]["gender"] = "Woman"
+    history = len(requests_mock.request_history)
+    result, status_code = katsu_ingest.ingest_schemas({"donors": [dict(d) for d in donors]}, batch_size=10, delta=True)
+    assert result["results"] == ["Of 20 donors, 0 were created, 18 were unchanged and 2 conflicted with records already in katsu"]
+    assert result["conflicts"] == {"donors": ["DONOR_0", "DONOR_5"]}
+    assert len(requests_mock.request_history) == history
+    assert not any(request.method == "PUT" for request in requests_mock.request_history)
+
+    # if the donors can't be listed, the donors that katsu reports as existing are conflicts
+    requests_mock.get(f"{CANDIG_URL}/katsu/v3/authorized/donors", status_code=500)
+    other = [dict(d, program_id="SYNTH_02") for d in donors[0:3]]
+    result, status_code = katsu_ingest.ingest_schemas({"donors": other}, batch_size=10, delta=True)
+    assert result["conflicts"] == {"donors": ["DONOR_0"]}
+    assert result["counts"]["donors"]["created"] == 2
+
+    # a program's statistics change with each submission, but it is not a conflict
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/programs/", status_code=201, json={})
+    requests_mock.get(f"{CANDIG_URL}/katsu/v3/authorized/programs", json={"items": [], "count": 0})
+    for donor_count in [20, 21]:
+        program = {"program_id": "SYNTH_03", "metadata": {"donors": donor_count}}
+        result, status_code = katsu_ingest.ingest_schemas({"programs": [program]}, delta=True)
+    assert result["counts"]["programs"] == {"records": 1, "created": 0, "unchanged": 1, "conflicts": 0}
+    assert "programs" not in result["conflicts"]
+
+
+def test_delta_ingest_unkeyed(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/radiations/", status_code=201, json={})
+    radiations = [{"program_id": "SYNTH_01", "submitter_treatment_id": f"TREATMENT_{i // 2}", "radiation_boost": i % 2 == 0}
+                  for i in range(0, 4)]
+    result, status_code = katsu_ingest.ingest_schemas({"radiations": [dict(r) for r in radiations]}, delta=True)
+    assert result["counts"]["radiations"] == {"records": 4, "created": 4, "unchanged": 0, "conflicts": 0}
+
+    # a changed radiation has no ID to be updated by: it is a conflict rather than a duplicate
+    radiations[3]["radiation_therapy_modality"] = "Brachytherapy"
+    radiations.append({"program_id": "SYNTH_01", "submitter_treatment_id": "TREATMENT_2", "radiation_boost": True})
+    posts = requests_mock.call_count
+    result, status_code = katsu_ingest.ingest_schemas({"radiations": [dict(r) for r in radiations]}, delta=True)
+    assert result["counts"]["radiations"] == {"records": 5, "created": 1, "unchanged": 3, "conflicts": 1}
+    assert result["conflicts"] == {"radiations": ["submitter_treatment_id:TREATMENT_1"]}
+    assert requests_mock.call_count == posts + 1
+    assert requests_mock.last_request.json() == [radiations[4]]
+
+
+def test_dry_run_plan(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", json=katsu_ingest_callback)
+    monkeypatch.setattr(katsu_ingest, "KATSU_PAGE_SIZE", 2)
+    pages = [{"items": [{"submitter_donor_id": "DONOR_3"}, {"submitter_donor_id": "OTHER"}], "count": 3},
+             {"items": [{"submitter_donor_id": "DONOR_4"}], "count": 3}]
+    requests_mock.get(f"{CANDIG_URL}/katsu/v3/authorized/donors",
+                      json=lambda request, context: pages[int(request.qs["page"][0]) - 1])
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01", "gender": "Man"} for i in range(0, 25)]
+
+    # a completed ingest provides the throughput for the estimate
+    result, status_code = katsu_ingest.ingest_schemas({"donors": [dict(d) for d in donors]}, batch_size=10)
+    assert result["timings"]["katsu"]["donors"]["records"] == 25
+    result["timings"]["katsu"]["donors"]["wall_seconds"] = 5
+    os.makedirs(tmp_path / "results")
+    (tmp_path / "results" / "job1").write_text(json.dumps({"SYNTH_01": result}))
+    throughput = katsu_ingest.recent_throughput(str(tmp_path / "results"))
+    assert throughput == {"donors": 5, "*": 5}
+
+    existing = katsu_ingest.existing_record_ids("SYNTH_01", ["donors", "radiations"], "token")
+    assert existing == {"donors": {"DONOR_3", "DONOR_4", "OTHER"}}
+    plan = katsu_ingest.plan_ingest({"donors": donors, "radiations": []}, 10, throughput=throughput, existing=existing)
+    assert plan["records"] == 25
+    assert plan["batches"] == 3
+    assert plan["bytes"] == sum(len(batching.batch_body(batch)) for batch in batching.iter_batches(batching.serialize_records(donors), batching.BatchSizer(10)))
+    assert plan["types"]["donors"]["existing_ids"] == ["DONOR_3", "DONOR_4"]
+    assert plan["estimated_seconds"] == 5
+    assert "radiations" not in plan["types"]
+    assert katsu_ingest.plan_ingest({"donors": donors}, 10)["estimated_seconds"] is None
+
+
 def callback(request, context):
     return request.json()
 
@@ -85,6 +368,894 @@ def test_htsget_ingest(requests_mock):
             }
         ]
     }
-    response = htsget_ingest.link_genomic_data(bad_s3_sample)
+    timings = {}
+    response = htsget_ingest.link_genomic_data(bad_s3_sample, timings=timings)
     print(json.dumps(response, indent=4))
     assert len(response["errors"]) == 2
+    assert "drs" in timings and "verify" in timings
+
+
+def test_bulk_verify(requests_mock, monkeypatch):
+    monkeypatch.setattr(htsget_ingest, "verify_cache", htsget_ingest.VerifyCache())
+    requests_mock.post(f"{HTSGET_URL}/ga4gh/drs/v1/objects", json=callback, status_code=200)
+    requests_mock.get(re.compile(f"{HTSGET_URL}/ga4gh/drs/v1/objects/.+"), status_code=404)
+    requests_mock.get(re.compile(f"{HTSGET_URL}/htsget/v1/.+/index"), status_code=200)
+    with open("tests/genomic_ingest.json", "r") as f:
+        data = json.load(f)
+    unreadable = data[0]["genomic_file_id"]
+
+    def verify(request, context):
+        if unreadable.lower() in request.path:
+            return {"result": False, "message": "access denied"}
+        return {"result": True}
+    verify_mock = requests_mock.get(re.compile(f"{HTSGET_URL}/htsget/v1/.+/verify"), json=verify)
+
+    result, status_code = htsget_ingest.htsget_ingest(data, do_not_index=True)
+    assert result["verification"] == {"verified": len(data) - 1, "cached": 0, "failed": 1}
+    assert result["errors"] == {unreadable: [{"error": "could not verify sample: access denied"}]}
+    assert result["results"][unreadable]["to_index"] == []
+    assert all(len(result["results"][sample["genomic_file_id"]]["to_index"]) == 1 for sample in data[1:])
+    assert verify_mock.call_count == len(data)
+
+    # only the file that failed is verified again
+    result, status_code = htsget_ingest.htsget_ingest(data, do_not_index=True)
+    assert result["verification"] == {"verified": len(data) - 1, "cached": len(data) - 1, "failed": 1}
+    assert verify_mock.call_count == len(data) + 1
+
+
+def test_s3_preflight(monkeypatch):
+    class FakeListingClient():
+        def __init__(self, objects):
+            self.objects = objects
+            self.listed = []
+
+        def list_objects(self, bucket, prefix="", recursive=False):
+            self.listed.append((bucket, prefix))
+            return [type("Object", (), {"object_name": name, "etag": etag})
+                    for name, etag in self.objects.items() if name.startswith(prefix) and "/" not in name[len(prefix):]]
+
+    client = FakeListingClient({"vcfs/s1.vcf.gz": "e1", "vcfs/s1.vcf.gz.tbi": "e2", "vcfs/s2.vcf.gz": "e3"})
+    credentials = []
+
+    def get_service_s3_credential(endpoint, bucket):
+        credentials.append((endpoint, bucket))
+        if bucket == "nocreds":
+            return {"error": "not found"}, 404
+        return {"access": "a", "secret": "s"}, 200
+    monkeypatch.setattr(auth, "get_service_s3_credential", get_service_s3_credential)
+    # users who aren't site admins have their files checked too
+    monkeypatch.setattr(auth.authx.auth, "is_site_admin", lambda *args, **kwargs: False)
+    monkeypatch.setattr(auth, "get_minio_client", lambda token, endpoint, bucket, **kwargs: {"client": client})
+
+    def sample(id, bucket, name):
+        return {"genomic_file_id": id,
+                "main": {"access_method": f"https://s3.example.org/{bucket}/vcfs/{name}", "name": name},
+                "index": {"access_method": f"https://s3.example.org/{bucket}/vcfs/{name}.tbi", "name": f"{name}.tbi"}}
+    samples = [sample("S1", "data", "s1.vcf.gz"), sample("S2", "data", "s2.vcf.gz"), sample("S3", "nocreds", "s3.vcf.gz"),
+               {"genomic_file_id": "S4", "main": {"access_method": "file:///data/s4.vcf.gz", "name": "s4.vcf.gz"}}]
+    cache = htsget_ingest.S3ListingCache()
+    errors = htsget_ingest.preflight_s3(samples, "token", cache=cache)
+    assert errors == {
+        "S2": ["https://s3.example.org/data/vcfs/s2.vcf.gz.tbi does not exist"],
+        "S3": ["no S3 credentials are stored for https://s3.example.org/nocreds"] * 2
+    }
+    # one credential per bucket and one listing per prefix
+    assert credentials == [("https://s3.example.org", "data"), ("https://s3.example.org", "nocreds")]
+    assert client.listed == [("data", "vcfs/")]
+    assert samples[0]["main"]["etag"] == "e1"
+
+    # a cached listing is reused only if it has every file: a missing one may have been uploaded since
+    htsget_ingest.preflight_s3(samples[0:1], "token", cache=cache)
+    assert client.listed == [("data", "vcfs/")]
+    client.objects["vcfs/s2.vcf.gz.tbi"] = "e4"
+    assert htsget_ingest.preflight_s3(samples[1:2], "token", cache=cache) == {}
+    assert client.listed == [("data", "vcfs/")] * 2
+    assert samples[1]["index"]["etag"] == "e4"
+
+
+def test_parse_s3_urls():
+    assert s3_urls.parse_s3_url("https://s3.example.org/data/vcfs/s1.vcf.gz?public=true") == {
+        "endpoint": "https://s3.example.org", "bucket": "data", "object": "vcfs/s1.vcf.gz?public=true"}
+    # URLs that don't fit the fast path are parsed as before
+    assert s3_urls.parse_s3_url("https://s3.example.org/data//s1.vcf.gz")["object"] == "/s1.vcf.gz"
+    with pytest.raises(Exception, match="does not contain a bucket name"):
+        s3_urls.parse_s3_url("https://s3.example.org/data")
+
+    samples = [
+        {"genomic_file_id": "S1", "main": {"access_method": "https://s3.example.org/data/s1.bam"},
+         "index": {"access_method": "s3://data/s1.bam.bai"}},
+        {"genomic_file_id": "S2", "main": {"access_method": "file:///data/s2.bam"}, "index": {"access_method": "data/s2.bam.bai"}}
+    ]
+    parsed, errors = s3_urls.parse_s3_urls(samples)
+    assert list(parsed.keys()) == [("S1", "main")]
+    assert [error["file"] for error in errors["S1"]] == ["index"]
+    assert errors["S1"][0]["error"].startswith("Incorrect URL format s3://data/s1.bam.bai")
+    assert errors["S2"] == [{"file": "index", "access_method": "data/s2.bam.bai",
+                             "error": "URI data/s2.bam.bai cannot be parsed as an S3-style URI"}]
+
+
+class FakeS3Client():
+    """
+    Stands in for the minio client's multipart upload calls; fails the upload of fail_part once.
+    """
+    class PartList():
+        def __init__(self, parts):
+            self.parts = parts
+            self.is_truncated = False
+
+    class WriteResult():
+        def __init__(self, object_name):
+            self.object_name = object_name
+
+    class Object():
+        def __init__(self, object_name, size, etag):
+            self.object_name = object_name
+            self.size = size
+            self.etag = etag
+
+    def __init__(self, fail_part=None):
+        self.uploads = {}
+        self.objects = {}
+        self.etags = {}
+        self.fail_part = fail_part
+        self.parts_uploaded = 0
+        self.listed = []
+
+    def put_object(self, bucket, name, fp, size):
+        self.objects[name] = fp.read(size)
+        self.etags[name] = hashlib.md5(self.objects[name]).hexdigest()
+        return self.WriteResult(name)
+
+    def _create_multipart_upload(self, bucket, name, headers):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return upload_id
+
+    def _list_parts(self, bucket, name, upload_id, part_number_marker=None):
+        parts = self.uploads[upload_id]
+        return self.PartList([s3_ingest.Part(str(n), f"etag-{n}", size=len(parts[n])) for n in parts])
+
+    def _upload_part(self, bucket, name, data, headers, upload_id, part_number):
+        if part_number == self.fail_part:
+            self.fail_part = None
+            raise IOError("connection reset")
+        self.uploads[upload_id][part_number] = data
+        self.parts_uploaded += 1
+        return f"etag-{part_number}"
+
+    def _complete_multipart_upload(self, bucket, name, upload_id, parts):
+        self.objects[name] = b"".join(self.uploads[upload_id][p.part_number] for p in parts)
+        digests = b"".join(hashlib.md5(self.uploads[upload_id][p.part_number]).digest() for p in parts)
+        self.etags[name] = f"{hashlib.md5(digests).hexdigest()}-{len(parts)}"
+        return self.WriteResult(name)
+
+    def list_objects(self, bucket, prefix=None, recursive=False):
+        self.listed.append(prefix)
+        for name in self.objects:
+            if name.startswith(prefix or "") and (recursive or "/" not in name[len(prefix or ""):]):
+                yield self.Object(name, len(self.objects[name]), self.etags[name])
+
+
+def test_s3_resumable_upload(monkeypatch, tmp_path):
+    monkeypatch.setattr(s3_ingest, "MIN_PART_SIZE", 10)
+    small = tmp_path / "sample.bai"
+    small.write_bytes(b"index")
+    large = tmp_path / "sample.bam"
+    large.write_bytes(bytes(range(0, 256)) * 4)
+    state_file = str(tmp_path / "state.json")
+
+    client = FakeS3Client(fail_part=3)
+    uploaded, errors = s3_ingest.upload_files(client, "bucket", [str(small), str(large)], parallel=2,
+                                              part_size=100, part_concurrency=1, state_file=state_file)
+    assert list(uploaded.keys()) == [str(small)]
+    assert str(large) in errors
+    assert client.parts_uploaded == 10
+
+    # the second run only uploads the parts that are missing:
+    uploaded, errors = s3_ingest.upload_files(client, "bucket", [str(large)], part_size=100, part_concurrency=4,
+                                              state_file=state_file)
+    assert len(errors) == 0
+    assert client.parts_uploaded == 11
+    assert client.objects["sample.bam"] == large.read_bytes()
+    with open(state_file) as f:
+        assert json.load(f) == {}
+
+
+def test_s3_object_names(monkeypatch, tmp_path):
+    monkeypatch.setattr(s3_ingest, "MIN_PART_SIZE", 10)
+    files = []
+    for run in ["run1", "run2"]:
+        os.makedirs(tmp_path / run)
+        (tmp_path / run / "sample.bam").write_bytes(run.encode() * 50)
+        files.append(str(tmp_path / run / "sample.bam"))
+    state_file = str(tmp_path / "state.json")
+
+    # files with the same name in different directories are different objects, with their own resume state
+    client = FakeS3Client(fail_part=2)
+    uploaded, errors = s3_ingest.upload_files(client, "bucket", files, part_size=100, part_concurrency=1, state_file=state_file)
+    with open(state_file) as f:
+        assert list(json.load(f).keys()) == ["bucket/run1/sample.bam"]
+    uploaded, errors = s3_ingest.upload_files(client, "bucket", files, part_size=100, state_file=state_file)
+    assert uploaded == {files[0]: "run1/sample.bam", files[1]: "run2/sample.bam"}
+    assert client.objects["run2/sample.bam"] == b"run2" * 50
+    assert s3_ingest.object_names(files[0:1]) == {files[0]: "sample.bam"}
+    assert s3_ingest.object_names(files[0:1], root=str(tmp_path)) == {files[0]: "run1/sample.bam"}
+
+
+def test_s3_sync(monkeypatch, tmp_path):
+    monkeypatch.setattr(s3_ingest, "MIN_PART_SIZE", 10)
+    files = []
+    for i in range(0, 3):
+        file = tmp_path / f"sample_{i}.bam"
+        file.write_bytes(bytes([i]) * (50 + 100 * i))
+        files.append(str(file))
+    client = FakeS3Client()
+    cache = s3_ingest.ChecksumCache(str(tmp_path / "checksums.json"))
+    uploaded, errors = s3_ingest.upload_files(client, "bucket", files[0:2], part_size=100)
+
+    to_upload, unchanged = s3_ingest.select_changed_files(client, "bucket", files, 100, cache)
+    assert to_upload == [files[2]]
+    assert list(unchanged.keys()) == files[0:2]
+
+    # a file with the same size but different contents is uploaded again:
+    with open(files[1], "r+b") as f:
+        f.write(b"changed")
+    to_upload, unchanged = s3_ingest.select_changed_files(client, "bucket", files, 100, cache)
+    assert to_upload == files[1:3]
+
+    uploaded, errors = s3_ingest.upload_files(client, "bucket", to_upload, part_size=100)
+    manifest = s3_ingest.write_manifest(str(tmp_path / "manifest.json"), "bucket", files, uploaded, unchanged, errors)
+    assert [f["status"] for f in manifest["files"].values()] == ["unchanged", "uploaded", "uploaded"]
+
+    # only the directories of the files are listed, even if they have no common prefix
+    client.objects["elsewhere/other.bam"] = b"x"
+    client.etags["elsewhere/other.bam"] = "e"
+    client.listed = []
+    remote = s3_ingest.list_remote_objects(client, "bucket", ["run1/a.bam", "run2/b.bam", "c.bam"])
+    assert client.listed == ["", "run1/", "run2/"]
+    assert "elsewhere/other.bam" not in remote
+
+
+def test_s3_manifest(tmp_path):
+    object_names = [
+        "run1/HG00096.cnv.vcf.gz", "run1/HG00096.cnv.vcf.gz.tbi",
+        "run1/NA12878.bai", "run1/NA12878.bam",
+        "run1/NA12879.cram", "run1/NA12879.cram.crai",
+        "run1/unindexed.bam", "run1/README.txt"
+    ]
+    samples = list(s3_manifest.build_manifest(object_names, "http://s3.us-east-1.amazonaws.com/", "1000genomes", "SYNTH_01"))
+    errors = [s for s in samples if "error" in s]
+    samples = [s for s in samples if "error" not in s]
+    assert len(errors) == 1 and errors[0]["name"] == "run1/unindexed.bam"
+    assert [s["genomic_file_id"] for s in samples] == ["HG00096.cnv", "NA12878", "NA12879"]
+    assert [s["metadata"]["data_type"] for s in samples] == ["variant", "read", "read"]
+    assert samples[1]["index"]["access_method"] == "http://s3.us-east-1.amazonaws.com/1000genomes/run1/NA12878.bai"
+    assert htsget_ingest.parse_s3_url(samples[0]["main"]["access_method"])["object"] == "run1/HG00096.cnv.vcf.gz"
+
+    paths, errors = s3_manifest.write_manifest_chunks(iter(samples), str(tmp_path / "genomic"), 2)
+    assert len(paths) == 2
+    with open(paths[1]) as f:
+        assert json.load(f)[0]["genomic_file_id"] == "NA12879"
+
+    # files with the same id under different prefixes are reported instead of overwriting each other
+    object_names = ["run1/NA12878.bam", "run1/NA12878.bai", "run2/NA12878.bam", "run2/NA12878.bai", "run2/NA12879.bam", "run2/NA12879.bai"]
+    samples = list(s3_manifest.build_manifest(object_names, "http://s3.us-east-1.amazonaws.com", "1000genomes", "SYNTH_01"))
+    assert [s["name"] for s in samples if "error" in s] == ["run1/NA12878.bam", "run2/NA12878.bam"]
+    assert [s["genomic_file_id"] for s in samples if "error" not in s] == ["NA12879"]
+
+
+def test_upload_session(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    response, status_code = upload_sessions.start_session({"type": "genomic", "do_not_index": True}, "user1")
+    upload_id = response["upload_id"]
+    with open("tests/genomic_ingest.json", "r") as f:
+        samples = json.load(f)
+    lines = [json.dumps(sample).encode() for sample in samples]
+
+    # a part with an invalid line is rejected, with errors by line number:
+    response, status_code = upload_sessions.add_part(upload_id, 1, b"\n".join([lines[0], b"{\"program_id\": 1}"]), "user1")
+    assert status_code == 422
+    assert list(response["errors"].keys()) == [2]
+
+    # parts can arrive in any order and can be re-sent:
+    response, status_code = upload_sessions.add_part(upload_id, 2, b"\n".join(lines[2:]), "user1")
+    assert status_code == 200
+    response, status_code = upload_sessions.add_part(upload_id, 1, b"\n".join(lines[0:2]), "user1")
+    assert response["records"] == 2
+    response, status_code = upload_sessions.get_session(upload_id, "user1")
+    assert response["records"] == len(samples)
+    assert upload_sessions.get_session(upload_id, "user2")[1] == 403
+
+    # concurrent re-sends of the same part leave one of them whole, and no temp files
+    bodies = [b"\n".join(lines[0:2]), b"\n".join(reversed(lines[0:2]))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: upload_sessions.add_part(upload_id, 1, bodies[i % 2], "user1"), range(16)))
+    with open(os.path.join(upload_sessions.upload_path(upload_id), "part_000001.ndjson"), "rb") as f:
+        assert f.read().rstrip(b"\n") in bodies
+    assert not any(name.endswith(".tmp") for name in os.listdir(upload_sessions.upload_path(upload_id)))
+
+    programs = upload_sessions.split_by_program(upload_id)
+    assert sum(count for path, count in programs.values()) == len(samples)
+    assert [sample for path, count in programs.values() for sample in upload_sessions.read_program(path)] == \
+        sorted(samples, key=lambda sample: list(programs.keys()).index(sample["program_id"]))
+    upload_sessions.remove_session(upload_id, "user1")
+    assert upload_sessions.get_session(upload_id, "user1")[1] == 404
+
+    # sessions can't be started, or used, without a user
+    assert upload_sessions.start_session({"type": "genomic"}, None)[1] == 403
+    response, status_code = upload_sessions.start_session({"type": "genomic"}, "user1")
+    assert upload_sessions.get_session(response["upload_id"], None)[1] == 403
+
+
+def test_commit_upload(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    monkeypatch.setattr(auth, "get_user_name", lambda token: "user1")
+    for directory in ["to_ingest", "results"]:
+        os.makedirs(tmp_path / directory)
+    with open("tests/clinical_ingest.json", "r") as f:
+        clinical = json.load(f)
+    response, status_code = upload_sessions.start_session({"type": "clinical", "openapi_url": clinical["openapi_url"]}, "user1")
+    upload_id = response["upload_id"]
+    lines = [json.dumps(donor).encode() for donor in clinical["donors"]]
+    upload_sessions.add_part(upload_id, 1, b"\n".join(lines[0:2]), "user1")
+    upload_sessions.add_part(upload_id, 2, b"\n".join(lines[2:]), "user1")
+
+    # each program is spooled as it is checked, and the job refers to the spool files
+    session, status_code = upload_sessions.read_session(upload_id, "user1")
+    response, status_code = ingest_operations.queue_upload(session, upload_sessions.split_by_program(upload_id), "token")
+    assert status_code == 200
+    with open(tmp_path / "to_ingest" / response["queue_id"]) as f:
+        job = json.load(f)
+    assert job["batch_size"] == 1000
+    assert job["katsu"]["SYNTH_01"]["schemas"]["systemic_therapies"]["count"] == 16
+    assert os.path.exists(job["katsu"]["SYNTH_01"]["schemas"]["donors"]["spool"])
+
+
+def test_ndjson_gzip_body():
+    with open("tests/clinical_ingest.json", "r") as f:
+        clinical = json.load(f)
+    with open("tests/genomic_ingest.json", "r") as f:
+        genomic = json.load(f)
+
+    body = gzip.compress(b"\n".join(json.dumps(donor).encode() for donor in clinical["donors"]))
+    dataset = ingest_body.read_clinical_body(body, "application/x-ndjson", "gzip", clinical["openapi_url"])
+    assert dataset["donors"] == clinical["donors"]
+    dataset = ingest_body.read_clinical_body(gzip.compress(json.dumps(clinical).encode()), "application/json", "gzip")
+    assert dataset == clinical
+
+    body = "\n".join(json.dumps(sample) for sample in genomic).encode() + b"\n\n"
+    assert ingest_body.read_genomic_body(body, "application/x-ndjson") == genomic
+
+    # errors name the line that could not be parsed:
+    with pytest.raises(ValueError, match="line 2"):
+        ingest_body.read_genomic_body(b"{}\n{not json", "application/x-ndjson")
+    with pytest.raises(ValueError):
+        ingest_body.read_clinical_body(json.dumps({"donors": {}}).encode(), "application/json")
+
+    # a small compressed body cannot decompress past the limit:
+    bomb = gzip.compress(b"[" + b" " * 100000 + b"]")
+    assert len(bomb) < 1000
+    with pytest.raises(ingest_body.BodyTooLarge):
+        ingest_body.read_genomic_body(bomb, "application/json", "gzip", max_bytes=1000)
+    with pytest.raises(ingest_body.BodyTooLarge):
+        ingest_body.read_genomic_body(gzip.compress(b"\n" * 100000), "application/x-ndjson", "gzip", max_bytes=1000)
+    assert ingest_body.read_genomic_body(bomb, "application/json", "gzip", max_bytes=100002) == []
+
+
+def test_genomic_body_validation(monkeypatch):
+    monkeypatch.setattr(auth, "get_user_name", lambda token: "user1")
+    monkeypatch.setattr(ingest_operations, "check_admission", lambda user: None)
+    with open("tests/genomic_ingest.json", "r") as f:
+        genomic = json.load(f)
+    sample = dict(genomic[0])
+    sample.pop("main")
+    body = "\n".join(json.dumps(s) for s in [genomic[1], sample]).encode()
+
+    # a sample without a main file is refused with a 400 before it reaches check_genomic_data
+    with pytest.raises(ValueError, match="sample 1"):
+        ingest_body.read_genomic_body(body, "application/x-ndjson")
+    with ingest_operations.app.test_request_context("/ingest/genomic", method="POST", data=body,
+                                                    content_type="application/x-ndjson", headers={"Authorization": "Bearer token"}):
+        response, status_code = ingest_operations.add_genomic_linkages()
+    assert status_code == 400
+    assert "main" in response["error"]
+
+
+SYNTHETIC_SCHEMA = {
+    "components": {
+        "schemas": {
+            "DonorWithClinicalDataSchema": {
+                "type": "object",
+                "required": ["submitter_donor_id", "program_id"],
+                "properties": {
+                    "submitter_donor_id": {"type": "string"},
+                    "program_id": {"type": "string"},
+                    "gender": {"oneOf": [{"$ref": "#/components/schemas/GenderEnum"}, {"$ref": "#/components/schemas/NullEnum"}]},
+                    "date_of_birth": {"$ref": "#/components/schemas/DateInterval"},
+                    "is_deceased": {"$ref": "#/components/schemas/DeceasedEnum"},
+                    "date_of_death": {"$ref": "#/components/schemas/DateInterval"},
+                    "cause_of_death": {"type": "string"},
+                    "primary_diagnoses": {"type": "array", "items": {"$ref": "#/components/schemas/NestedPrimaryDiagnosis"}},
+                    "biomarkers": {"type": "array", "items": {"$ref": "#/components/schemas/Biomarker"}}
+                }
+            },
+            "NestedPrimaryDiagnosis": {
+                "type": "object",
+                "required": ["submitter_primary_diagnosis_id"],
+                "properties": {
+                    "submitter_primary_diagnosis_id": {"type": "string", "maxLength": 64},
+                    "specimens": {"type": "array", "items": {"$ref": "#/components/schemas/NestedSpecimen"}},
+                    "treatments": {"type": "array", "items": {"$ref": "#/components/schemas/Treatment"}}
+                }
+            },
+            "NestedSpecimen": {
+                "type": "object",
+                "required": ["submitter_specimen_id"],
+                "properties": {
+                    "submitter_specimen_id": {"type": "string"},
+                    "sample_registrations": {"type": "array", "items": {
+                        "type": "object",
+                        "required": ["submitter_sample_id"],
+                        "properties": {"submitter_sample_id": {"type": "string"}, "submitter_specimen_id": {"type": "string"}}
+                    }}
+                }
+            },
+            "Biomarker": {
+                "type": "object",
+                "properties": {"submitter_specimen_id": {"type": "string"}, "psa_level": {"type": "integer"}}
+            },
+            "Treatment": {
+                "type": "object",
+                "required": ["submitter_treatment_id"],
+                "properties": {
+                    "submitter_treatment_id": {"type": "string"},
+                    "treatment_type": {"type": "array", "items": {"$ref": "#/components/schemas/TreatmentTypeEnum"}},
+                    "radiations": {"type": "array", "items": {"type": "object", "properties": {"radiation_boost": {"type": "boolean"}}}},
+                    "surgeries": {"type": "array", "items": {"type": "object", "properties": {"surgery_site": {"type": "string"}}}}
+                }
+            },
+            "TreatmentTypeEnum": {"enum": ["Radiation therapy", "Surgery", "Systemic therapy", "Other"], "type": "string"},
+            "DeceasedEnum": {"enum": ["Yes", "No"], "type": "string"},
+            "GenderEnum": {"enum": ["Man", "Woman", "Non-binary"], "type": "string"},
+            "NullEnum": {"enum": [None]},
+            "DateInterval": {"type": "object", "properties": {"month_interval": {"type": "integer"}, "day_interval": {"type": "integer"}}}
+        }
+    }
+}
+
+
+def test_synthetic_data():
+    generator = synthetic_data.SchemaGenerator(SYNTHETIC_SCHEMA, seed=1, fill=1.0, breadth=2, depth=3)
+    donors = list(synthetic_data.generate_donors(10, programs=2, generator=generator))
+    assert [donor["program_id"] for donor in donors[0:2]] == ["SYNTH_01", "SYNTH_02"]
+    assert all(donor["gender"] in ["Man", "Woman", "Non-binary"] for donor in donors)
+
+    # nested objects reuse their parents' IDs and every sample ID is unique:
+    for donor in donors:
+        for diagnosis in donor["primary_diagnoses"]:
+            for specimen in diagnosis["specimens"]:
+                for sample in specimen["sample_registrations"]:
+                    assert sample["submitter_specimen_id"] == specimen["submitter_specimen_id"]
+    ids = [sample_id for donor in donors for sample_id in synthetic_data.sample_ids(donor)]
+    assert len(ids) == len(set(ids)) and len(ids) > 10
+
+    # the same seed generates the same donors:
+    generator = synthetic_data.SchemaGenerator(SYNTHETIC_SCHEMA, seed=1, fill=1.0, breadth=2, depth=3)
+    assert list(synthetic_data.generate_donors(10, programs=2, generator=generator)) == donors
+
+    # depth limits nesting:
+    generator = synthetic_data.SchemaGenerator(SYNTHETIC_SCHEMA, seed=1, depth=1)
+    donor = generator.donor("DONOR_1", "SYNTH_01")
+    assert all(diagnosis.get("specimens", []) == [] for diagnosis in donor.get("primary_diagnoses", []))
+
+    samples = list(synthetic_data.generate_genomic_samples(donors))
+    assert len(samples) == len(donors)
+
+    # the MoH rules that the schema doesn't express are followed:
+    for donor in donors:
+        specimen_ids = [specimen["submitter_specimen_id"] for diagnosis in donor["primary_diagnoses"] for specimen in diagnosis["specimens"]]
+        assert all(biomarker.get("submitter_specimen_id", specimen_ids[0]) in specimen_ids for biomarker in donor["biomarkers"])
+        assert donor["date_of_birth"]["month_interval"] < 0
+        if donor["is_deceased"] == "Yes":
+            assert donor["date_of_death"]["month_interval"] > 0
+        else:
+            assert "date_of_death" not in donor and "cause_of_death" not in donor
+        for diagnosis in donor["primary_diagnoses"]:
+            for treatment in diagnosis["treatments"]:
+                assert ("Radiation therapy" in treatment["treatment_type"]) == ("radiations" in treatment)
+                assert ("Surgery" in treatment["treatment_type"]) == ("surgeries" in treatment)
+                assert "Systemic therapy" not in treatment["treatment_type"]
+
+
+def test_synthetic_data_is_valid():
+    # generated and cloned donors both pass MoHSchemaV3 validation against katsu's schema
+    try:
+        openapi = synthetic_data.read_openapi(config.DEFAULT_OPENAPI_URL)
+    except requests.RequestException as e:
+        pytest.skip(f"katsu's schema is not available: {e}")
+    with open("tests/clinical_ingest.json", "r") as f:
+        template = json.load(f)
+    generator = synthetic_data.SchemaGenerator(openapi, seed=1)
+    for donors in [synthetic_data.generate_donors(20, programs=2, generator=generator),
+                   synthetic_data.generate_donors(20, programs=2, template=template)]:
+        stream = io.BytesIO("\n".join(json.dumps(donor) for donor in donors).encode())
+        report = validate.validate_clinical(stream, ndjson=True, openapi_url=config.DEFAULT_OPENAPI_URL, workers=1)
+        assert report["errors"] == []
+        assert report["valid"]
+
+
+def test_bench_daemon_stage(tmp_path):
+    # the daemon stage queues jobs in, and runs them from, the benchmark's own DAEMON_PATH
+    schema_path = os.path.join("benchmarks", "schema.yml")
+    if not os.path.exists(schema_path):
+        try:
+            response = requests.get(config.DEFAULT_OPENAPI_URL)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            pytest.skip(f"katsu's schema is not available: {e}")
+        schema_path = str(tmp_path / "schema.yml")
+        with open(schema_path, "wb") as f:
+            f.write(response.content)
+    env = {key: value for key, value in os.environ.items() if key not in ["DAEMON_PATH", "KATSU_URL", "HTSGET_URL"]}
+    process = subprocess.run([sys.executable, os.path.realpath("benchmarks/bench_ingest.py"), "--run_stage", "daemon",
+                              "--donors", "2", "--schema", os.path.realpath(schema_path)],
+                             capture_output=True, text=True, cwd=tmp_path, env=env)
+    assert process.returncode == 0, process.stderr
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    assert result["records"] > 0 and result["errors"] == 0
+    assert not os.path.exists(tmp_path / "~")
+
+
+def test_metrics(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    os.makedirs(tmp_path / "to_ingest")
+    (tmp_path / "to_ingest" / "job1").write_text("{}")
+
+    # other tests make calls too, so compare the counters before and after
+    def errors(service, operation, status):
+        return metrics.REGISTRY.get_sample_value("ingest_service_errors_total", {"service": service, "operation": operation, "status": status}) or 0
+    def calls(service, operation):
+        return metrics.REGISTRY.get_sample_value("ingest_service_request_duration_seconds_count", {"service": service, "operation": operation}) or 0
+    before = {
+        "katsu_errors": errors("katsu", "authorized", "503"),
+        "katsu_calls": calls("katsu", "authorized"),
+        "opa_errors": errors("opa", "failing_call", "403"),
+        "admin_checks": calls("opa", "is_site_admin"),
+        "credential_reads": calls("vault", "get_aws_credential")
+    }
+
+    requests_mock.get(f"{CANDIG_URL}/katsu/v3/authorized/programs", status_code=503)
+    response = metrics.request("katsu", "authorized", "GET", f"{CANDIG_URL}/katsu/v3/authorized/programs")
+    assert response.status_code == 503
+    assert errors("katsu", "authorized", "503") == before["katsu_errors"] + 1
+    assert calls("katsu", "authorized") == before["katsu_calls"] + 1
+
+    @metrics.observe_call("opa")
+    def failing_call():
+        return {"error": "no"}, 403
+    failing_call()
+    assert errors("opa", "failing_call", "403") == before["opa_errors"] + 1
+
+    # calls to authx are counted once each, and permission checks that fail aren't service errors
+    monkeypatch.setattr(auth.authx.auth, "is_site_admin", lambda *args, **kwargs: False)
+    assert auth.get_s3_credential("endpoint", "bucket", "token")[1] == 403
+    assert calls("opa", "is_site_admin") == before["admin_checks"] + 1
+    assert calls("vault", "get_aws_credential") == before["credential_reads"]
+    assert errors("vault", "get_s3_credential", "403") == 0
+
+    text = metrics.generate_metrics().decode()
+    assert "ingest_queue_depth 1.0" in text
+
+
+def test_profiling(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    monkeypatch.setattr(profiling, "INGEST_PROFILE_MAX_FILES", 2)
+    with profiling.profiled("not_enabled") as profile:
+        assert profile is None
+    for i in range(3):
+        with profiling.profiled(f"job {i}", enabled=True) as profile:
+            # only one profile can run at a time
+            with profiling.profiled("nested", enabled=True) as nested:
+                sum(range(1000))
+            assert nested.stop() is None
+    profiles = sorted(os.listdir(profiling.profile_dir()))
+    assert len(profiles) == 2
+    assert all(name.endswith(".prof") and "nested" not in name for name in profiles)
+    assert not any("job_0" in name for name in profiles)
+
+    # work handed to worker threads through in_profile is part of the profile
+    def worker_thread_work(n):
+        return sum(range(n))
+    with profiling.profiled("threads", enabled=True) as profile:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            assert list(executor.map(profiling.in_profile(worker_thread_work), [10, 20])) == [45, 190]
+        path = profile.stop()
+    functions = [function for filename, line, function in pstats.Stats(path).stats]
+    assert "worker_thread_work" in functions
+    assert profiling.in_profile(worker_thread_work) is worker_thread_work
+
+
+def test_scheduler():
+    def meta(type, programs, records, submitter, queued_at):
+        return {"type": type, "programs": programs, "records": records, "submitter": submitter, "queued_at": queued_at}
+    jobs = scheduler.Scheduler(max_per_program=1)
+    jobs.add("big_a1", meta("clinical", ["A"], 2000000, "alice", 1))
+    jobs.add("big_a2", meta("clinical", ["A"], 2000000, "alice", 2))
+    jobs.add("big_b", meta("clinical", ["B"], 2000000, "bob", 3))
+    jobs.add("small_c", meta("clinical", ["C"], 10, "carol", 4))
+    jobs.add("genomic_a", meta("genomic", ["A"], 5, "alice", 5))
+
+    # small jobs first, and program A has only one job running at a time
+    assert jobs.next_job()[0] == "small_c"
+    path, genomic_meta = jobs.next_job()
+    assert path == "genomic_a"
+    assert jobs.pick() == "big_b"
+    jobs.done(path, genomic_meta, 60)
+
+    # program A has used more time than B, so B's job goes first
+    assert jobs.next_job()[0] == "big_b"
+    assert jobs.next_job()[0] == "big_a1"
+    assert jobs.pick() is None
+
+
+def test_pause_resume_cancel(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    monkeypatch.setattr(daemon, "DAEMON_PATH", str(tmp_path))
+    for directory in ["to_ingest", "results"]:
+        os.makedirs(tmp_path / directory)
+    created = []
+
+    def pause_after_first_batch(request, context):
+        created.extend(donor["submitter_donor_id"] for donor in request.json())
+        if len(created) == 10:
+            job_control.request_action("job1", job_control.PAUSE)
+        context.status_code = 201
+        return {}
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", json=pause_after_first_batch)
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01", "gender": "Man"} for i in range(0, 30)]
+    job = {"katsu": {"SYNTH_01": {"schemas": {"donors": donors}}}, "batch_size": 10}
+    (tmp_path / "to_ingest" / "job1").write_text(json.dumps(job))
+
+    # the job stops after the first batch and leaves the queue
+    results, status_code = daemon.ingest_file(str(tmp_path / "to_ingest" / "job1"))
+    assert results["SYNTH_01"]["status"] == "paused"
+    assert results["SYNTH_01"]["results"] == ["Of 10 donors, 10 were created"]
+    assert not os.path.exists(tmp_path / "to_ingest" / "job1")
+    assert job_control.requested_action("job1") is None
+
+    # resuming carries on from the checkpoint
+    os.rename(job_control.paused_path("job1"), tmp_path / "to_ingest" / "job1")
+    results, status_code = daemon.ingest_file(str(tmp_path / "to_ingest" / "job1"))
+    assert "status" not in results["SYNTH_01"]
+    assert results["SYNTH_01"]["results"] == ["Of 30 donors, 30 were created"]
+    assert created == [donor["submitter_donor_id"] for donor in donors]
+
+    # a cancelled job doesn't ingest anything and reports that it was cancelled
+    (tmp_path / "to_ingest" / "job2").write_text(json.dumps(job))
+    job_control.request_action("job2", job_control.CANCEL)
+    results, status_code = daemon.ingest_file(str(tmp_path / "to_ingest" / "job2"))
+    assert results["SYNTH_01"]["status"] == "cancelled"
+    assert len(created) == 30
+    assert not os.path.exists(tmp_path / "to_ingest" / "job2")
+    with open(tmp_path / "results" / "job2") as f:
+        assert json.load(f)["SYNTH_01"]["status"] == "cancelled"
+
+
+def test_admission(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    monkeypatch.setattr(admission, "INGEST_MIN_FREE_BYTES", 0)
+    monkeypatch.setattr(admission, "INGEST_MAX_QUEUED_RECORDS", 1000)
+    monkeypatch.setattr(admission, "INGEST_USER_MAX_QUEUED_JOBS", 2)
+    ingest_json = {"katsu": {"SYNTH_01": {"schemas": {"donors": [{}] * 300}}}, "submitter": "alice", "queued_at": 1}
+    scheduler.write_job_meta("job1", ingest_json)
+    scheduler.write_job_meta("job2", ingest_json)
+    assert admission.check_admission(100, "bob") is None
+
+    # alice has used her quota of jobs
+    response, status_code, headers = admission.check_admission(100, "alice")
+    assert status_code == 429
+    assert headers["Retry-After"] == str(admission.RETRY_AFTER_DEFAULT)
+
+    # the queue is full; Retry-After is how long the daemon takes to drain the excess at recent throughput
+    os.makedirs(tmp_path / "results")
+    (tmp_path / "results" / "done").write_text(json.dumps({"SYNTH_01": {"timings": {"katsu": {"donors": {"records": 100, "wall_seconds": 10}}}}}))
+    response, status_code, headers = admission.check_admission(600, "bob")
+    assert status_code == 429
+    assert headers["Retry-After"] == "20"
+    assert admission.check_admission(2000, "bob")[1] == 413
+
+
+def test_distributed_tasks(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    monkeypatch.setattr(config, "DAEMON_PATH", str(tmp_path))
+    monkeypatch.setattr(distributed, "INGEST_TASK_RECORDS", 10)
+    for directory in ["to_ingest", "results", "spool"]:
+        os.makedirs(tmp_path / directory)
+    created = []
+
+    def create(request, context):
+        created.extend(record["submitter_donor_id"] for record in request.json())
+        context.status_code = 201
+        return {}
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/donors/", json=create)
+    requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/primary_diagnoses/", json=create)
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01"} for i in range(0, 25)]
+    diagnoses = [{"submitter_donor_id": f"DONOR_{i}", "submitter_primary_diagnosis_id": f"PD_{i}", "program_id": "SYNTH_01"}
+                 for i in range(0, 12)]
+    job = {"katsu": {"SYNTH_01": {"schemas": {
+        "donors": batching.write_spool(donors, str(tmp_path / "spool" / "donors.ndjson")),
+        "primary_diagnoses": batching.write_spool(diagnoses, str(tmp_path / "spool" / "primary_diagnoses.ndjson"))
+    }}}, "batch_size": 5}
+    (tmp_path / "to_ingest" / "job1").write_text(json.dumps(job))
+
+    tasks = distributed.TaskQueue()
+    distributed.add_queued_jobs(tasks, str(tmp_path / "to_ingest"))
+    assert not os.path.exists(tmp_path / "to_ingest" / "job1")
+    assert len(tasks.task_results("job1")) == 5
+
+    # a worker that claims a task and dies loses it once its lease expires
+    monkeypatch.setattr(distributed, "INGEST_LEASE_SECONDS", -1)
+    lost = tasks.claim("worker_a")
+    monkeypatch.setattr(distributed, "INGEST_LEASE_SECONDS", 300)
+    stolen = tasks.claim("worker_b")
+    assert stolen["id"] == lost["id"]
+    assert stolen["attempts"] == 1
+    assert not tasks.renew(lost, {})
+
+    # while a task runs, its lease is renewed even if no batch finishes in time
+    monkeypatch.setattr(distributed, "INGEST_LEASE_SECONDS", 0.3)
+    with distributed.TaskControl(tasks, stolen, {}) as control:
+        time.sleep(0.6)
+        row = tasks.db.execute("SELECT worker, lease_expires FROM tasks WHERE id = ?", (stolen["id"],)).fetchone()
+        assert row["worker"] == "worker_b" and row["lease_expires"] > time.time()
+        assert control() is None
+    with distributed.TaskControl(tasks, lost, {}) as control:
+        time.sleep(0.2)
+        assert control() == distributed.LOST
+    monkeypatch.setattr(distributed, "INGEST_LEASE_SECONDS", 300)
+    assert tasks.renew(stolen, {})
+
+    # diagnoses wait until every donor task is done
+    claimed = [stolen, tasks.claim("worker_b"), tasks.claim("worker_b")]
+    assert all(json.loads(task["payload"])["fields"].keys() == {"donors"} for task in claimed)
+    assert tasks.claim("worker_b") is None
+    assert [distributed.run_task(tasks, task) for task in claimed] == [False, False, False]
+    assert distributed.run_task(tasks, lost) is False
+
+    last = False
+    while (task := tasks.claim("worker_b")) is not None:
+        last = distributed.run_task(tasks, task)
+    assert last
+    results = distributed.complete_job(tasks, "job1")
+    assert results["SYNTH_01"]["results"] == ["Of 25 donors, 25 were created", "Of 12 primary_diagnoses, 12 were created"]
+    assert created == [donor["submitter_donor_id"] for donor in donors + diagnoses]
+    assert len(tasks.task_results("job1")) == 0
+
+    # a job with no tasks is complete as soon as it is queued
+    (tmp_path / "to_ingest" / "job2").write_text(json.dumps({"htsget": {}}))
+    distributed.add_queued_jobs(tasks, str(tmp_path / "to_ingest"))
+    assert json.loads((tmp_path / "results" / "job2").read_text()) == {}
+    assert tasks.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
+
+    # a task that keeps raising is retried, then fails its job
+    def broken(*args, **kwargs):
+        raise RuntimeError("katsu is broken")
+    monkeypatch.setattr(distributed, "ingest_schemas", broken)
+    (tmp_path / "to_ingest" / "job3").write_text(json.dumps({"katsu": {"SYNTH_01": {"schemas": {"donors": donors[0:5]}}}}))
+    distributed.add_queued_jobs(tasks, str(tmp_path / "to_ingest"))
+    attempts = []
+    while (task := tasks.claim("worker_b")) is not None:
+        attempts.append(distributed.attempt_task(tasks, task))
+    assert attempts == [False] * (distributed.INGEST_TASK_ATTEMPTS - 1) + [True]
+    assert distributed.complete_job(tasks, "job3") is None
+    assert json.loads((tmp_path / "results" / "job3").read_text()) == {"status": "failed", "errors": ["katsu is broken"]}
+    assert len(tasks.task_results("job3")) == 0
+
+
+def test_sharded_ingest(requests_mock, monkeypatch, tmp_path):
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", f"{CANDIG_URL}/katsu")
+    monkeypatch.setattr(auth, "get_service_token", lambda: "test")
+    posted = []
+
+    def create(request, context):
+        posted.extend((request.path.split("/")[-2], record.get("submitter_donor_id")) for record in request.json())
+        context.status_code = 201
+        return {}
+    for type in ["programs", "donors", "primary_diagnoses", "treatments"]:
+        requests_mock.post(f"{CANDIG_URL}/katsu/v3/ingest/{type}/", json=create)
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01"} for i in range(0, 10)]
+    # diagnoses out of donor order end up in their donor's shard
+    diagnoses = [{"submitter_donor_id": f"DONOR_{i % 10}", "submitter_primary_diagnosis_id": f"PD_{i}", "program_id": "SYNTH_01"}
+                 for i in reversed(range(0, 20))]
+    treatments = [{"submitter_donor_id": f"DONOR_{i}", "submitter_treatment_id": f"TR_{i}", "program_id": "SYNTH_01"}
+                  for i in range(0, 3)]
+    schemas = {"programs": [{"program_id": "SYNTH_01"}], "donors": donors,
+               "primary_diagnoses": diagnoses, "treatments": treatments}
+    assert sharding.spool_program(dict(schemas), str(tmp_path), donors_per_shard=10) is None
+    program = {"schemas": schemas, "shards": sharding.spool_program(schemas, str(tmp_path), donors_per_shard=4)}
+    assert [{type: records["count"] for type, records in shard.items()} for shard in program["shards"]] == [
+        {"primary_diagnoses": 8, "treatments": 3}, {"primary_diagnoses": 8}, {"primary_diagnoses": 4}]
+    for i, shard in enumerate(program["shards"]):
+        records = [json.loads(record) for record in batching.read_records(shard["primary_diagnoses"])]
+        assert all(int(record["submitter_donor_id"].split("_")[1]) // 4 == i for record in records)
+
+    tasks = distributed.job_tasks({"katsu": {"SYNTH_01": program}})
+    assert [stage for program_id, stage, payload in tasks] == [0, 1, 2, 2, 2]
+
+    checkpoint = {}
+    result, status_code = sharding.ingest_program(program, batch_size=3, checkpoint=checkpoint, workers=3, processes=False)
+    assert result["results"] == ["Of 1 programs, 1 were created", "Of 10 donors, 10 were created",
+                                 "Of 20 primary_diagnoses, 20 were created", "Of 3 treatments, 3 were created"]
+    assert result["timings"]["shards"]["shards"] == 3
+    # the shards start once every donor is in
+    assert [type for type, donor in posted[:11]] == ["programs"] + ["donors"] * 10
+    assert len(posted) == 34
+    assert checkpoint["shards"][0] == {"primary_diagnoses": 8, "treatments": 3}
+
+
+def test_sharded_ingest_processes(monkeypatch, tmp_path):
+    # the shards can be ingested in separate processes, which share the daemon's service token
+    donors = [{"submitter_donor_id": f"DONOR_{i}", "program_id": "SYNTH_01"} for i in range(0, 10)]
+    diagnoses = [{"submitter_donor_id": f"DONOR_{i % 10}", "submitter_primary_diagnosis_id": f"PD_{i}", "program_id": "SYNTH_01"}
+                 for i in range(0, 20)]
+    schemas = {"programs": [{"program_id": "SYNTH_01"}], "donors": donors, "primary_diagnoses": diagnoses}
+    program = {"schemas": schemas, "shards": sharding.spool_program(schemas, str(tmp_path), donors_per_shard=4)}
+    stand_in_config = StandInConfig()
+    server = start_stand_ins(stand_in_config)
+    katsu_url = f"http://127.0.0.1:{server.server_port}/katsu"
+    monkeypatch.setattr(katsu_ingest, "KATSU_URL", katsu_url)
+    monkeypatch.setenv("KATSU_URL", katsu_url)
+    monkeypatch.setattr(auth.service_token_provider, "token", "test")
+    monkeypatch.setattr(auth.service_token_provider, "expires_at", time.monotonic() + 3600)
+    try:
+        checkpoint = {}
+        result, status_code = sharding.ingest_program(program, batch_size=3, checkpoint=checkpoint, workers=3, processes=True)
+    finally:
+        server.shutdown()
+    assert result["results"] == ["Of 1 programs, 1 were created", "Of 10 donors, 10 were created",
+                                 "Of 20 primary_diagnoses, 20 were created"]
+    assert stand_in_config.ingested == {"programs": 1, "donors": 10, "primary_diagnoses": 20}
+    assert checkpoint["shards"] == [{"primary_diagnoses": 8}, {"primary_diagnoses": 8}, {"primary_diagnoses": 4}]
+
+
+def test_validate_clinical():
+    with open("tests/clinical_ingest.json", "rb") as f:
+        report = validate.validate_clinical(f, ndjson=False, workers=2, chunk_size=2)
+    assert report["valid"]
+    assert report["programs"]["SYNTH_01"]["donors"] == 4
+    assert report["programs"]["SYNTH_01"]["records"]["systemic_therapies"] == 16
+
+    donors = [{"program_id": "SYNTH_01", "submitter_donor_id": "DONOR_1"}, {"program_id": "SYNTH_02", "submitter_donor_id": "DONOR_1"},
+              {"submitter_donor_id": "DONOR_2"}, {"program_id": "SYNTH_01", "submitter_donor_id": "DONOR_1"}]
+    stream = io.BytesIO("\n".join(json.dumps(donor) for donor in donors).encode())
+    report = validate.validate_clinical(stream, ndjson=True, workers=2)
+    assert not report["valid"]
+    assert [error["record"] for error in report["errors"]] == [3, 4]
+    assert {program_id: program["donors"] for program_id, program in report["programs"].items()} == {"SYNTH_01": 1, "SYNTH_02": 1}
+
+
+def test_validate_offline():
+    # validate.py runs without a token or any CanDIG services, so it doesn't load their clients
+    code = "import sys, validate; print(sorted({'auth', 'authx', 'metrics', 'htsget_ingest', 'katsu_ingest'} & set(sys.modules)))"
+    process = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    assert process.stdout.strip() == "[]"
+
+
+def test_validate_genomic():
+    with open("tests/genomic_ingest.json") as f:
+        samples = json.load(f)
+    samples[1]["main"]["access_method"] = "s3://s3.example.org/bucket/file.vcf.gz"
+    samples[2]["genomic_file_id"] = samples[2]["main"]["name"]
+    samples.append({"genomic_file_id": "incomplete"})
+    stream = io.BytesIO("\n".join(json.dumps(sample) for sample in samples).encode() + b"\nnot json\n")
+    report = validate.validate_genomic(stream, ndjson=True, workers=2, chunk_size=2)
+    assert not report["valid"]
+    assert report["samples"] == len(samples)
+    assert report["errors"][0]["error"].startswith("could not read input: line 6")
+    errors = {error["record"]: error["errors"] for error in report["errors"][1:]}
+    assert list(errors.keys()) == [2, 3, 5]
+    assert errors[2][0].startswith("main: Incorrect URL format")
+    assert "cannot have the same name as one of its files" in errors[3][0]
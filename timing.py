@@ -0,0 +1,24 @@
+import contextlib
+import time
+
+
+def add_time(timings, seconds, *keys):
+    """
+    Add seconds to the stage at timings[keys[0]][keys[1]]..., creating nested dicts as needed.
+    """
+    for key in keys[:-1]:
+        timings = timings.setdefault(key, {})
+    timings[keys[-1]] = round(timings.get(keys[-1], 0) + seconds, 4)
+
+
+@contextlib.contextmanager
+def timed(timings, *keys):
+    """
+    Time the enclosed block and add it to a stage in timings. Does nothing if timings is None.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            add_time(timings, time.monotonic() - start, *keys)
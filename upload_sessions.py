@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import jsonschema
+import config
+from ingest_body import get_request_schema
+
+
+UPLOAD_MAX_PART_BYTES = int(os.getenv("UPLOAD_MAX_PART_BYTES", 64 * 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 7 * 24 * 3600))
+
+
+def upload_path(upload_id):
+    return os.path.join(config.DAEMON_PATH, "uploads", os.path.basename(upload_id))
+
+
+def read_session(upload_id, user):
+    """
+    Returns the session for upload_id and a status code: 404 if it does not exist, 403 if it belongs to
+    someone else or to no one.
+    """
+    try:
+        with open(os.path.join(upload_path(upload_id), "session.json")) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        return {"error": f"no such upload_id {upload_id}"}, 404
+    if session["user"] is None or session["user"] != user:
+        return {"error": f"upload {upload_id} was started by another user"}, 403
+    return session, 200
+
+
+def remove_expired_sessions():
+    uploads_dir = os.path.join(config.DAEMON_PATH, "uploads")
+    if not os.path.exists(uploads_dir):
+        return
+    now = time.time()
+    for upload_id in os.listdir(uploads_dir):
+        try:
+            # adding a part updates the directory's mtime, so this is the time of the last activity
+            if now - os.path.getmtime(os.path.join(uploads_dir, upload_id)) > UPLOAD_SESSION_TTL:
+                shutil.rmtree(os.path.join(uploads_dir, upload_id), ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+
+def start_session(request, user):
+    """
+    Start a chunked upload of clinical donors or genomic samples. request holds the type of the upload
+    and the options that would otherwise be passed to /clinical or /genomic. Sessions belong to the
+    user who started them, so user must be known.
+    """
+    if user is None:
+        return {"error": "could not identify the user from the token, so the upload could not be started"}, 403
+    remove_expired_sessions()
+    upload_id = str(uuid.uuid1())
+    session = {
+        "upload_id": upload_id,
+        "type": request["type"],
+        "user": user,
+        "created": time.time(),
+        "options": {}
+    }
+    if request["type"] == "clinical":
+        session["openapi_url"] = request.get("openapi_url", config.DEFAULT_OPENAPI_URL)
+        session["options"]["batch_size"] = request.get("batch_size", 1000)
+        session["options"]["adaptive_batching"] = request.get("adaptive_batching", False)
+        session["options"]["isolate_errors"] = request.get("isolate_errors", False)
+        session["options"]["delta"] = request.get("delta", False)
+    else:
+        session["options"]["do_not_index"] = request.get("do_not_index", False)
+    os.makedirs(upload_path(upload_id))
+    with open(os.path.join(upload_path(upload_id), "session.json"), "w") as f:
+        json.dump(session, f)
+    return {"upload_id": upload_id}, 200
+
+
+def validate_line(validator, record):
+    """
+    Lightweight checks for a single donor, or schema validation for a genomic sample; donors are fully
+    validated when the upload is committed.
+    """
+    if validator is None:
+        if not isinstance(record, dict):
+            return ["donor is not an object"]
+        return [f"missing required field {key}" for key in ["program_id", "submitter_donor_id"] if key not in record]
+    errors = []
+    for error in validator.iter_errors(record):
+        if len(error.path) > 0:
+            errors.append(f"{' > '.join(map(str, error.path))}: {error.message}")
+        else:
+            errors.append(error.message)
+    return errors
+
+
+def add_part(upload_id, part_number, body, user):
+    """
+    Validate a part of NDJSON records line by line and store it in the upload's spool. Re-sending a
+    part replaces it, so an interrupted upload can be resumed by re-sending the parts that failed.
+    """
+    session, status_code = read_session(upload_id, user)
+    if status_code != 200:
+        return session, status_code
+    if len(body) > UPLOAD_MAX_PART_BYTES:
+        return {"error": f"part is larger than the maximum of {UPLOAD_MAX_PART_BYTES} bytes"}, 413
+
+    validator = None
+    if session["type"] == "genomic":
+        validator = jsonschema.Draft202012Validator(get_request_schema("GenomicSample"))
+    errors = {}
+    records = 0
+    part_path = os.path.join(upload_path(upload_id), f"part_{part_number:06d}.ndjson")
+    # each request writes its own temp file, so concurrent PUTs of the same part cannot interleave
+    fd, tmp_path = tempfile.mkstemp(dir=upload_path(upload_id), prefix=".part_", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        for line_number, line in enumerate(body.splitlines(), start=1):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                line_errors = validate_line(validator, json.loads(line))
+            except ValueError as e:
+                line_errors = [f"invalid JSON: {e}"]
+            if len(line_errors) > 0:
+                errors[line_number] = line_errors
+                continue
+            f.write(line.strip())
+            f.write(b"\n")
+            records += 1
+    if len(errors) > 0:
+        os.remove(tmp_path)
+        return {"part_number": part_number, "errors": errors}, 422
+    os.replace(tmp_path, part_path)
+    fd, tmp_path = tempfile.mkstemp(dir=upload_path(upload_id), prefix=".part_", suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"records": records, "bytes": len(body)}, f)
+    os.replace(tmp_path, f"{part_path}.meta")
+    return {"part_number": part_number, "records": records}, 200
+
+
+def list_parts(upload_id):
+    parts = {}
+    for name in sorted(os.listdir(upload_path(upload_id))):
+        if name.startswith("part_") and name.endswith(".meta"):
+            with open(os.path.join(upload_path(upload_id), name)) as f:
+                parts[int(name[5:11])] = json.load(f)
+    return parts
+
+
+def get_session(upload_id, user):
+    session, status_code = read_session(upload_id, user)
+    if status_code != 200:
+        return session, status_code
+    parts = list_parts(upload_id)
+    session["parts"] = parts
+    session["records"] = sum(part["records"] for part in parts.values())
+    return session, 200
+
+
+def split_by_program(upload_id):
+    """
+    Copy the uploaded records, in part order, into one NDJSON file per program in the upload's
+    directory, reading the parts line by line. Returns a dict of program_id to (path, record count).
+    """
+    programs = {}
+    files = {}
+    try:
+        for part_number in list_parts(upload_id):
+            with open(os.path.join(upload_path(upload_id), f"part_{part_number:06d}.ndjson"), "rb") as f:
+                for line in f:
+                    program_id = json.loads(line)["program_id"]
+                    if program_id not in files:
+                        path = os.path.join(upload_path(upload_id), f"program_{len(files):06d}.ndjson")
+                        files[program_id] = open(path, "wb")
+                        programs[program_id] = (path, 0)
+                    files[program_id].write(line)
+                    programs[program_id] = (programs[program_id][0], programs[program_id][1] + 1)
+    finally:
+        for f in files.values():
+            f.close()
+    return programs
+
+
+def read_program(path):
+    """
+    The records of one program, from a file written by split_by_program.
+    """
+    with open(path, "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+def remove_session(upload_id, user):
+    session, status_code = read_session(upload_id, user)
+    if status_code != 200:
+        return session, status_code
+    shutil.rmtree(upload_path(upload_id), ignore_errors=True)
+    return {"upload_id": upload_id, "status": "removed"}, 200
@@ -0,0 +1,241 @@
+import argparse
+import functools
+import gzip
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import jsonschema
+from clinical_etl.mohschemav3 import MoHSchemaV3
+from ingest_body import iter_ndjson, get_request_schema
+from clinical_flatten import validate_program
+from s3_urls import parse_s3_urls
+from upload_sessions import validate_line
+from config import DEFAULT_OPENAPI_URL
+
+
+# Validate clinical or genomic ingest files locally, without a token or any CanDIG services, with
+# the same checks that the ingest server runs before it queues a submission.
+
+NDJSON_EXTENSIONS = [".ndjson", ".jsonl"]
+# genomic samples are independent of each other, so they are always validated in chunks
+GENOMIC_CHUNK_SIZE = 1000
+
+
+def open_input(path):
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def is_ndjson(path):
+    return any(path.removesuffix(".gz").endswith(extension) for extension in NDJSON_EXTENSIONS)
+
+
+def read_input(stream, ndjson):
+    """
+    Returns the fields of a JSON object other than its records, and an iterator over the records: the
+    lines of an NDJSON stream, which are read as they are needed, or the items of a JSON array or of
+    the "donors" of a JSON object.
+    """
+    if ndjson:
+        return {}, iter_ndjson(stream)
+    body = json.load(stream)
+    if isinstance(body, list):
+        return {}, iter(body)
+    return {key: value for key, value in body.items() if key != "donors"}, iter(body.get("donors", []))
+
+
+def read_records(records, report):
+    """
+    Yield records until the input ends or a line isn't valid JSON, which is added to the report's errors.
+    """
+    try:
+        yield from records
+    except ValueError as e:
+        report["errors"].append({"error": f"could not read input: {e}"})
+
+
+@functools.cache
+def load_schema(openapi_url):
+    schema = MoHSchemaV3(openapi_url)
+    types = ["programs"]
+    types.extend(schema.validation_schema.keys())
+    return schema, types
+
+
+@functools.cache
+def genomic_validator():
+    return jsonschema.Draft202012Validator(get_request_schema("GenomicSample"))
+
+
+def validate_clinical_chunk(openapi_url, program_id, first, last, donors):
+    """
+    Validate and flatten a chunk of one program's donors, which are between record numbers first and
+    last of the input.
+    """
+    schema, types = load_schema(openapi_url)
+    donor_count = len(donors)
+    fields, errors, warnings = validate_program(schema, types, program_id, {"donors": donors, "errors": []})
+    # validation errors come as one list
+    errors = [error for entry in errors for error in (entry if isinstance(entry, list) else [entry])]
+    return {
+        "program_id": program_id,
+        "donors": donor_count,
+        "record_range": [first, last],
+        "records": {type: len(records) for type, records in (fields or {}).items() if len(records) > 0},
+        "errors": errors,
+        "warnings": warnings
+    }
+
+
+def validate_genomic_chunk(first, samples):
+    """
+    Check a chunk of GenomicSamples, the first of which is record number first of the input.
+    """
+    results = []
+    for i, sample in enumerate(samples):
+        errors = validate_line(genomic_validator(), sample)
+        if isinstance(sample, dict):
+            files = [sample.get(file, {}).get("name") for file in ("main", "index") if isinstance(sample.get(file), dict)]
+            if sample.get("genomic_file_id") in files:
+                errors.append(f"Sample {sample['genomic_file_id']} cannot have the same name as one of its files.")
+            if len(errors) == 0:
+                parsed, url_errors = parse_s3_urls([sample])
+                errors.extend(f"{error['file']}: {error['error']}" for error in url_errors.get(sample["genomic_file_id"], []))
+        if len(errors) > 0:
+            genomic_file_id = sample.get("genomic_file_id") if isinstance(sample, dict) else None
+            results.append({"record": first + i, "genomic_file_id": genomic_file_id, "errors": errors})
+    return {"errors": results}
+
+
+class ChunkRunner():
+    """
+    Runs chunks of records on a pool of worker processes, keeping at most twice as many chunks in
+    flight as there are workers so that a large input is never all in memory, and collects their
+    results in the order the chunks were submitted.
+    """
+    def __init__(self, workers):
+        self.executor = ProcessPoolExecutor(max_workers=max(1, workers))
+        self.max_pending = 2 * max(1, workers)
+        self.pending = []
+        self.results = []
+
+    def submit(self, fn, *args):
+        self.pending.append(self.executor.submit(fn, *args))
+        while len(self.pending) > self.max_pending:
+            self.results.append(self.pending.pop(0).result())
+
+    def finish(self):
+        self.results.extend(future.result() for future in self.pending)
+        self.executor.shutdown()
+        return self.results
+
+
+def validate_clinical(stream, ndjson, openapi_url=None, workers=os.cpu_count(), chunk_size=0):
+    """
+    Validate a ClinicalDonor JSON file, or NDJSON with one DonorWithClinicalData per line. Donors are
+    grouped by program, and the programs are validated in parallel, each as a whole, as the server
+    does. With chunk_size set, programs are validated in chunks of chunk_size donors instead, which
+    uses less memory but misses the schema's checks between donors in different chunks; donors are
+    still checked for duplicate IDs across the whole program.
+    """
+    header, donors = read_input(stream, ndjson)
+    report = {"type": "clinical", "valid": True, "donors": 0, "errors": [], "programs": {}}
+    header_errors = [error.message for error in jsonschema.Draft202012Validator(get_request_schema("ClinicalDonor")).iter_errors(header)]
+    report["errors"].extend(header_errors)
+    openapi_url = openapi_url or header.get("openapi_url") or DEFAULT_OPENAPI_URL
+
+    runner = ChunkRunner(workers)
+    chunks = {}
+    seen = {}
+    for record_number, donor in enumerate(read_records(donors, report), start=1):
+        report["donors"] += 1
+        if not isinstance(donor, dict) or "program_id" not in donor or "submitter_donor_id" not in donor:
+            report["errors"].append({"record": record_number, "error": "donor must be an object with program_id and submitter_donor_id"})
+            continue
+        program_id = donor["program_id"]
+        program_seen = seen.setdefault(program_id, {})
+        if donor["submitter_donor_id"] in program_seen:
+            report["errors"].append({"record": record_number, "error": f"donor {donor['submitter_donor_id']} is also record "
+                                                                        f"{program_seen[donor['submitter_donor_id']]}"})
+            continue
+        program_seen[donor["submitter_donor_id"]] = record_number
+        # each program's chunk is [first record, last record, donors]
+        chunk = chunks.setdefault(program_id, [record_number, record_number, []])
+        chunk[1] = record_number
+        chunk[2].append(donor)
+        if chunk_size > 0 and len(chunk[2]) >= chunk_size:
+            runner.submit(validate_clinical_chunk, openapi_url, program_id, *chunks.pop(program_id))
+    for program_id, chunk in chunks.items():
+        runner.submit(validate_clinical_chunk, openapi_url, program_id, *chunk)
+
+    for result in runner.finish():
+        program = report["programs"].setdefault(result["program_id"], {"donors": 0, "records": {}, "errors": [], "warnings": []})
+        program["donors"] += result["donors"]
+        for type, count in result["records"].items():
+            program["records"][type] = program["records"].get(type, 0) + count
+        # locate each error by the records of its chunk, since the schema's messages don't say which record they are about
+        program["errors"].extend({"records": result["record_range"], "error": error} for error in result["errors"])
+        program["warnings"].extend(result["warnings"])
+    report["valid"] = len(report["errors"]) == 0 and all(len(program["errors"]) == 0 for program in report["programs"].values())
+    return report
+
+
+def validate_genomic(stream, ndjson, workers=os.cpu_count(), chunk_size=GENOMIC_CHUNK_SIZE):
+    """
+    Validate a JSON array of GenomicSamples, or NDJSON with one GenomicSample per line, in chunks of
+    chunk_size samples in parallel.
+    """
+    header, samples = read_input(stream, ndjson)
+    report = {"type": "genomic", "valid": True, "samples": 0, "errors": []}
+    runner = ChunkRunner(workers)
+    chunk = []
+    first = 1
+    for record_number, sample in enumerate(read_records(samples, report), start=1):
+        report["samples"] += 1
+        chunk.append(sample)
+        if len(chunk) >= max(1, chunk_size):
+            runner.submit(validate_genomic_chunk, first, chunk)
+            chunk = []
+            first = record_number + 1
+    if len(chunk) > 0:
+        runner.submit(validate_genomic_chunk, first, chunk)
+    for result in runner.finish():
+        report["errors"].extend(result["errors"])
+    report["valid"] = len(report["errors"]) == 0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A script that checks clinical or genomic ingest files without ingesting them. "
+                                                 "Prints a JSON report and exits with status 1 if the input is not valid.")
+    parser.add_argument("type", choices=["clinical", "genomic"], help="the kind of data in the input")
+    parser.add_argument("--input", required=True, help="JSON or NDJSON file to check (optionally gzipped), or - for stdin")
+    parser.add_argument("--ndjson", action="store_true", help="read the input as NDJSON even if it isn't named .ndjson or .jsonl")
+    parser.add_argument("--openapi_url", help="schema URL for clinical NDJSON, or to override the one in a clinical JSON file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunk_size", type=int, default=0,
+                        help="number of records validated together; by default, each clinical program is validated as a "
+                             f"whole and genomic samples in chunks of {GENOMIC_CHUNK_SIZE}")
+    parser.add_argument("--output", help="file to write the report to, instead of stdout")
+    args = parser.parse_args()
+
+    ndjson = args.ndjson or is_ndjson(args.input)
+    with open_input(args.input) as stream:
+        if args.type == "clinical":
+            report = validate_clinical(stream, ndjson, args.openapi_url, args.workers, args.chunk_size)
+        else:
+            report = validate_genomic(stream, ndjson, args.workers, args.chunk_size or GENOMIC_CHUNK_SIZE)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    sys.exit(0 if report["valid"] else 1)
+
+
+if __name__ == "__main__":
+    main()